@@ -1,8 +1,39 @@
-import shapely as sp
-import gdsfactory as gf
-from gdsfactory.generic_tech import get_generic_pdk
+import functools
+import importlib
+import inspect
+import math
+import os
+import sys
+
+from cmr_cache import CellCache, cell_key, cell_name, live_cell, name_cells
+from cmr_profile import profiled, stage
+
+class _LazyModule:
+    '''Stand-in that imports the real module on first attribute access, so importing the builders
+    (e.g. to read defaults or label formats) does not pay for importing gdsfactory and NumPy.'''
+
+    def __init__(self, name, setup=None):
+        self._name = name
+        self._setup = setup
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            if self._setup is not None:
+                self._setup(module)
+            self._module = module
+        return getattr(self._module, attr)
+
+def _activate_pdk(gdsfactory):
+    #activating the PDK clears gdsfactory's cell name counters, so it must happen before the first cell is named,
+    #not lazily on the first layer lookup; otherwise later cells reuse names of cells that are already built
+    gdsfactory.get_active_pdk()
+
+gf = _LazyModule("gdsfactory", setup=_activate_pdk)
+gdstk = _LazyModule("gdstk")
+cmr_geometry = _LazyModule("cmr_geometry")
 
-gf.clear_cache()
 ###################################
 #General gds properties
 
@@ -18,6 +49,7 @@ pad_width = 100
 pad_height = 50
 
 arm_width= 15 #width of arm between pad and taper
+pad_route_height = 2*29.75 #height of the pads above originy, fixed by the longest bus length with 60 fingers
 
 ########################################
 #Etch window properties
@@ -43,7 +75,7 @@ electrode_end_margin = 10  #distance between bus and electrode of opposite poten
 bus_width = 5 #width of metal electrode connecting idt fingers
 bus_length = electrode_number*(electrode_width+electrode_separation)-electrode_separation 
 
-angle = 0 #angle of the entire CMR component - label #DOESN'T WORK
+angle = 0 #rotation of the CMR in degrees about its centre, applied to its reference; the label stays upright below it
 k = etch_window_gap/2 #curvature factor, r2 of ellipse used to construct curved etch window
 
 radius = 25 #outer radius of undercut ring test structure
@@ -51,19 +83,102 @@ width = 20 #width of test ring
 
 undercut = True #define if undercut is to be used or not, for debug structures
 
+def set_constants(**values):
+    '''Override global dimensions, keeping the derived tether_length and bus_length consistent unless given.'''
+    unknown = [name for name in values if name not in globals()]
+    if unknown:
+        raise ValueError(f"unknown constants {unknown}")
+    globals().update(values)
+    if "tether_length" not in values:
+        globals()["tether_length"] = etch_window_gap + etch_buffer
+    if "bus_length" not in values:
+        globals()["bus_length"] = electrode_number*(electrode_width+electrode_separation)-electrode_separation
+
 ######################################################################
-#                      Flat-edge CMR Method                          #
-######################################################################   
-'''Instead of porting each individual IDT finger to the bus, a union is done between all metallized parts to create one solid metal layer component.
- The etch windows are also defined using unions instead of ports. The bus/pad and route are done using ports and defined more correctly.'''
+#                            Cell Cache                              #
+######################################################################
+'''Every subcomponent below is cached on the geometric parameters that define it (see cmr_cache.py).
+Devices in a sweep that share e.g. a bus length and tether width share one bus/pad/route cell,
+which is built once and placed by reference everywhere else.'''
+
+cell_cache_limit = 256 #maximum number of distinct cells kept in the cache, None for unbounded
+
+cell_cache = CellCache(limit=cell_cache_limit)
+
+'''outline_engine = "analytic" writes the merged IDT combs and etch windows as closed-form outlines (cmr_geometry.py).
+outline_engine = "boolean" falls back to polygon booleans (merged/subtracted); check_outline_engines() compares the two.'''
+
+outline_engine = "analytic"
+
+def merged(component, layer, precision=1e-4):
+    '''gf.geometry.union(component, by_layer=False, layer=layer), but not through gdsfactory's cell cache: that cache
+    is keyed on the name of the input, and the scratch components below share their names ("etch_window_union",
+    "complete_component"...), so a cached union of one device's component could stand in for another's.'''
+    union = gf.Component("union")
+    polygons = gdstk.boolean(component.get_polygons(), [], "or", precision=precision)
+    if polygons:
+        union.add_polygon(polygons, layer=layer)
+    return union
+
+def subtracted(a, b, layer, precision=1e-6):
+    '''gf.geometry.boolean(A=a, B=b, operation="not"), not cached for the same reason as merged.'''
+    difference = gf.Component("boolean")
+    polygons = gdstk.boolean(a.get_polygons(), b.get_polygons(), "not", precision=precision)
+    if polygons:
+        difference.add_polygon(polygons, layer=layer)
+    return difference
+
+#largest distance (um) between the analytic biconvex curve and its chords, well below the EBL beam step.
+#None samples the curve like gf.components.ellipse (2.5 degree polar steps, up to ~0.4 um off at the tips).
+curve_tolerance = 0.005
+
+#global dimensions and settings the cached cells depend on, part of every cache key
+constant_names = ("originx", "originy", "metal_layer", "resist_layer", "pad_width", "pad_height", "arm_width", "pad_route_height",
+                  "etch_window_gap", "etch_buffer", "tether_length", "taper_length", "electrode_length", "electrode_end_margin", "bus_width",
+                  "outline_engine", "curve_tolerance", "ring_tether_overlap", "ring_frame_margin", "local_marker_length", "local_marker_width",
+                  "label_style", "label_engine", "label_size")
+
+def geometry_constants():
+    return tuple(globals()[name] for name in constant_names)
+
+cached_cell = cell_cache.cached(geometry_constants)
+
+'''Devices are named the same way: their top cell is <builder>_<digest of the arguments and constants> and the
+cells inside it are named after their contents, so a device keeps its cell names from run to run and a mask
+can be patched in place (cmr_patch.py) by comparing names.'''
+
+def device_name(kind, args, kwargs=None, builder=None):
+    '''Stable top cell name of the device builders[kind](*args, **kwargs) builds, without building it.'''
+    bound = inspect.signature(builder or builders[kind]).bind(*args, **(kwargs or {}))
+    bound.apply_defaults()
+    values = dict(bound.arguments)
+    if values.get("idt_mode", "") is None:
+        values["idt_mode"] = default_idt_mode
+    return cell_name(cell_key(kind, tuple(values.values()), geometry_constants()))
+
+def named_device(kind):
+    '''Decorator: name the device a builder returns, and the cells in it, after device_name. The same arguments
+    build the same device, so one that is still in use is returned again rather than built twice under one name.'''
+    def decorator(builder):
+        @functools.wraps(builder)
+        def wrapper(*args, **kwargs):
+            name = device_name(kind, args, kwargs, builder)
+            device = live_cell(name)
+            if device is None:
+                device = builder(*args, **kwargs)
+                name_cells(device, name)
+            return device
+        return wrapper
+    return decorator
 
-def flat_cmr(destinationx,destinationy,electrode_number,electrode_separation,electrode_width,tether_width,angle,undercut):
-    #c = gf.Component("pad_and_bus")
-    
-    ################Add one bus, tether, taper + port###################
-    bus = gf.Component("bus")
+######################################################################
+#                      Shared CMR Subcomponents                      #
+######################################################################
 
-    bus_length = electrode_number*(electrode_width+electrode_separation)-electrode_separation #length of metal electrode connecting idt fingers
+################Add one bus, tether, taper + port###################
+@cached_cell
+def bus_cell(bus_length,tether_width):
+    bus = gf.Component("bus")
 
     p1 = bus.add_polygon(
         [(originx,originx,bus_width,bus_width),(originy,bus_length,bus_length,originy)],layer=metal_layer
@@ -72,21 +187,27 @@ def flat_cmr(destinationx,destinationy,electrode_number,electrode_separation,ele
     bus.add_port(
         name="bus_port",center=[originx,bus_length/2],width=tether_width,orientation=180,layer=metal_layer #standard orientation of port is parallel to y axis
     )
+    return bus
 
+@cached_cell
+def tether_cell(tether_width):
     tether = gf.Component("tether")
 
     p2 = tether.add_polygon(
-        [(originx,originx,originx+tether_length,originx+tether_length),(originy,originy+tether_width,originy+tether_width,originy)]
+        [(originx,originx,originx+tether_length,originx+tether_length),(originy,originy+tether_width,originy+tether_width,originy)],layer=metal_layer
     )
-    
+
     tether.add_port(
         name="tether_port1",center=[originx,tether_width/2],width=tether_width,orientation=180,layer=metal_layer #standard orientation of port is parallel to y axis
     )
     tether.add_port(
         name="tether_port2",center=[originx+tether_length,tether_width/2],width=tether_width,orientation=0,layer=metal_layer #standard orientation of port is parallel to y axis
     )
-    
-    taper =  gf.components.taper(
+    return tether
+
+@cached_cell
+def taper_cell(tether_width):
+    return gf.components.taper(
         length = taper_length,
         width1 = arm_width,
         width2 = tether_width,
@@ -95,24 +216,32 @@ def flat_cmr(destinationx,destinationy,electrode_number,electrode_separation,ele
         layer = metal_layer
     )
 
+@cached_cell
+def connect_parts_cell(bus_length,tether_width,with_bus):
+    #without the bus only the tether and taper are kept, positioned as if the bus were there
     connect_parts = gf.Component("connect_parts")
-    c1 = connect_parts << bus
-    c2 = connect_parts << tether
-    c3 = connect_parts << taper
+    bus = bus_cell(bus_length,tether_width)
+    if with_bus:
+        bus = connect_parts << bus
+    c2 = connect_parts << tether_cell(tether_width)
+    c3 = connect_parts << taper_cell(tether_width)
 
-    c2.connect("tether_port2",c1.ports["bus_port"])
+    c2.connect("tether_port2",bus.ports["bus_port"])
     c3.connect("taper_port2",c2.ports["tether_port1"])
 
     #must add component-level reference to uderlying subcomponent port
     connect_parts.add_port(
-       name="taper_port",port=c3.ports["taper_port1"] 
+       name="taper_port",port=c3.ports["taper_port1"]
     )
+    return connect_parts
 
-    ##############Add one pad + port #######################
+##############Add one pad + port #######################
+@cached_cell
+def pad_cell():
     pad = gf.Component("pad")
-    
+
     pad_originx = originx-3*pad_width/4
-    pad_originy = originy+2*29.75 #fixed height based on longest bus length with 60 fingers
+    pad_originy = originy+pad_route_height
 
     pad.add_polygon(
         [(pad_originx,pad_originx,pad_originx+pad_width,pad_originx+pad_width),(pad_originy,pad_originy+pad_height,pad_originy+pad_height,pad_originy)],layer=metal_layer
@@ -120,258 +249,327 @@ def flat_cmr(destinationx,destinationy,electrode_number,electrode_separation,ele
     pad.add_port(
         name="pad_port",center=[pad_originx+arm_width/2,pad_originy],width=arm_width,orientation=270,layer=metal_layer
     )
+    return pad
 
-    ##########Get route between bus and pad#################
+##########Get route between bus and pad#################
+@cached_cell
+def pad_and_bus_cell(bus_length,tether_width,with_bus):
     pad_and_bus = gf.Component("pad_and_bus")
 
-    port1 = pad_and_bus << connect_parts
-    port2 = pad_and_bus << pad
+    port1 = pad_and_bus << connect_parts_cell(bus_length,tether_width,with_bus)
+    port2 = pad_and_bus << pad_cell()
 
-    route = gf.routing.get_route(
-        port1.ports["taper_port"], 
-        port2.ports["pad_port"],
-        width = arm_width
-    )
+    with stage("route"):
+        route = gf.routing.get_route(
+            port1.ports["taper_port"],
+            port2.ports["pad_port"],
+            width = arm_width
+        )
     pad_and_bus.add(route.references)
+    return pad_and_bus
 
-    ##########Mirror bus and pad about center of IDT#############
+##########Mirror bus and pad about center of IDT#############
+@cached_cell
+def pad_and_bus_mirrored_cell(bus_length,tether_width,with_bus):
     mirror_originx = originx+  bus_width + (electrode_length + electrode_end_margin)/2
     mirror_originy = originy + bus_length/2
 
     pad_and_bus_complete = gf.Component("pad_and_bus_mirrored")
-    bus_and_pad_1 = pad_and_bus_complete << pad_and_bus
-    bus_and_pad_2 = pad_and_bus_complete << pad_and_bus
+    bus_and_pad_1 = pad_and_bus_complete << pad_and_bus_cell(bus_length,tether_width,with_bus)
+    bus_and_pad_2 = pad_and_bus_complete << pad_and_bus_cell(bus_length,tether_width,with_bus)
     bus_and_pad_2.mirror(p1=[mirror_originx,0],p2=[mirror_originx,mirror_originy])
+    return pad_and_bus_complete
 
-    ##########Add IDT electrodes###########################
-    idt_array = gf.Component("idt_electrodes")
-    electrodes = []
-
-    for i in range(electrode_number):
-        # Calculate x-coordinate for the current electrode
-        x1 = originx + bus_width
-        x2 = x1 + electrode_length
-        y1 = originy + ((i)*(electrode_width+electrode_separation))
-        y2 = y1 + electrode_width
-        
-        # Check if the current electrode should be offset
-        if i % 2 == 1:
-            x1 += electrode_end_margin  # Offset for every second electrode
-            x2 += electrode_end_margin
-        
-        electrode_i = idt_array.add_polygon([(x1,y1),(x1,y2),(x2,y2),(x2,y1)],layer = (1,0))
-        electrodes.append(electrode_i)
-    
-    union_component = gf.Component("complete_component")
-    union_component << pad_and_bus_complete
-    union_component << idt_array
-    union_component = gf.geometry.union(union_component, by_layer=False, layer=metal_layer)
+##########Add IDT electrodes###########################
+'''The fingers are two interleaved combs, each a single finger cell stepped at the IDT period
+2*(electrode_width+electrode_separation) as a GDS array reference (AREF), instead of one polygon per finger.'''
 
-    ################Create etch windows#######################
-    if undercut:
-        etch_window = gf.Component("etch_window") #define top etch window subcomponents
+@cached_cell
+def finger_cell(electrode_width):
+    finger = gf.Component("idt_finger")
+    finger.add_polygon([(0,0),(0,electrode_width),(electrode_length,electrode_width),(electrode_length,0)],layer = metal_layer)
+    return finger
 
-        etch_window_length = 2*bus_width + electrode_length + electrode_end_margin + 2*(etch_buffer + etch_window_gap) #horizontal window length
-        etch_window_height = bus_length/2 - tether_width/2 #vertical window length
-    
-        top_x1 = originx-(etch_buffer + etch_window_gap)
-        top_x2 = top_x1 + etch_window_length
-        top_y1 = bus_length + etch_buffer
-        top_y2 = top_y1 + etch_window_gap
-
-        left_x1 = originx - etch_window_gap - etch_buffer
-        left_x2 = left_x1 + etch_window_gap
-        left_y1 = bus_length/2 + tether_width/2 + etch_buffer
-        left_y2 = left_y1 + etch_window_height
-
-        right_x1 = originx + 2*bus_width + electrode_length + electrode_end_margin + etch_buffer
-        right_x2 = right_x1 + etch_window_gap
-        right_y1 = bus_length/2 + tether_width/2 + etch_buffer
-        right_y2 = right_y1 + etch_window_height
-
-        #union acting weird and only taking two arguments so I have to make this dodgy fix and do two unions, sorry 
-    
-        etch_window_union1 = gf.Component("etch_window_union") #make union so there is one continuous top etch window
-        top_window = etch_window_union1.add_polygon([(top_x1,top_y1),(top_x1,top_y2),(top_x2,top_y2),(top_x2,top_y1)],layer=resist_layer)
-        left_window = etch_window_union1.add_polygon([(left_x1,left_y1),(left_x1,left_y2),(left_x2,left_y2),(left_x2,left_y1)],layer=resist_layer)
-        etch_window_union1 = gf.geometry.union(etch_window_union1, by_layer=False, layer=resist_layer)
+@cached_cell
+def idt_cell(electrode_number,electrode_separation,electrode_width):
+    idt_array = gf.Component("idt_electrodes")
+    period = 2*(electrode_width+electrode_separation)
 
-        etch_window_union2 = gf.Component("etch_window_union2") #make union so there is one continuous top etch window
-        etch_window_union2 << etch_window_union1
-        right_window = etch_window_union2.add_polygon([(right_x1,right_y1),(right_x1,right_y2),(right_x2,right_y2),(right_x2,right_y1)],layer=resist_layer)
-        etch_window_union2 = gf.geometry.union(etch_window_union2, by_layer=False, layer=resist_layer)
+    #even fingers start at the bus, every second finger is offset by the end margin
+    even_fingers = idt_array.add_array(finger_cell(electrode_width), columns=1, rows=(electrode_number+1)//2, spacing=(0,period))
+    even_fingers.move(destination=(originx + bus_width, originy))
+    if electrode_number > 1:
+        odd_fingers = idt_array.add_array(finger_cell(electrode_width), columns=1, rows=electrode_number//2, spacing=(0,period))
+        odd_fingers.move(destination=(originx + bus_width + electrode_end_margin, originy + electrode_width + electrode_separation))
+    return idt_array
 
-        etch_window_complete = gf.Component("etch_window_complete") #mirror top etch window so there are two etch windows top and bottom
-    
-        mirror_originx = originx 
-        mirror_originy = originy + bus_length/2
-        mirror_p1 = mirror_originx + etch_window_length/2
-    
-        top_window = etch_window_complete << etch_window_union2
-        bottom_window = etch_window_complete << etch_window_union2
-        bottom_window.mirror(p1=[mirror_originx,mirror_originy],p2=[mirror_p1,mirror_originy])
+##########Union of all metallized parts###################
+'''idt_mode = "union" merges fingers, buses, routes and pads into one solid metal polygon per device.
+idt_mode = "aref" keeps them hierarchical: the finger arrays and the bus/pad cell are placed by reference.'''
 
-    ###########Make component including etch windows and CMR and rotate if necessary##################
-    CMR_component = gf.Component("CMR_component")
-    CMR_component << union_component
-    if undercut:
-        CMR_component << etch_window_complete
-    CMR_component.rotate(angle)
+default_idt_mode = "union" #used when a builder is called without idt_mode
 
+@cached_cell
+def cmr_metal_cell(electrode_number,electrode_separation,electrode_width,tether_width,idt_mode):
+    bus_length = electrode_number*(electrode_width+electrode_separation)-electrode_separation #length of metal electrode connecting idt fingers
 
-    ############Create label for flat-edge CMR###################
+    if idt_mode not in ("union", "aref"):
+        raise ValueError(f"idt_mode must be 'union' or 'aref', got {idt_mode!r}")
+
+    union_component = gf.Component("complete_component")
+    if idt_mode == "union" and outline_engine == "analytic":
+        #the combs (bus + fingers) are written as two closed-form outlines, pads and routes abut them by reference
+        union_component << pad_and_bus_mirrored_cell(bus_length,tether_width,False)
+        with stage("comb_outlines"):
+            for outline in cmr_geometry.idt_outlines(originx,originy,bus_width,electrode_length,electrode_end_margin,
+                                                     electrode_width,electrode_separation,electrode_number):
+                union_component.add_polygon(outline,layer=metal_layer)
+        return union_component
+
+    union_component << pad_and_bus_mirrored_cell(bus_length,tether_width,True)
+    union_component << idt_cell(electrode_number,electrode_separation,electrode_width)
+    if idt_mode == "aref":
+        return union_component
+    with stage("metal_union"):
+        return merged(union_component, metal_layer)
+
+############Device label###################
+flat_label_format = "Pair num = {pairs}\nPeriod = {period}\nTether w = {tether}"
+biconvex_label_format = flat_label_format + "\nk = {k}"
+
+'''label_style = "id" writes a compact one-line ID instead, the builder's letter and its values (parse_label_id reads it back).
+label_engine = "glyphs" builds each character once per size and layer (glyph_cell) and assembles the labels from references,
+label_engine = "polygons" writes every label as its own polygons (gf.components.text).'''
+
+label_style = "text"
+label_engine = "glyphs"
+label_size = 5 #character height in um
+flat_id_format = "F{pairs:g}-{period:g}-{tether:g}"
+biconvex_id_format = "B{pairs:g}-{period:g}-{tether:g}-{k:g}"
+_id_fields = {"F": ("pairs", "period", "tether"), "B": ("pairs", "period", "tether", "k")}
+
+def label_text(kind, **values):
+    '''The label of a flat or biconvex CMR in the current label_style.'''
+    if label_style == "id":
+        return (flat_id_format if kind == "flat_cmr" else biconvex_id_format).format(**values)
+    return (flat_label_format if kind == "flat_cmr" else biconvex_label_format).format(**values)
+
+def parse_label_id(text):
+    '''(builder name, {field: value}) of a compact label ID, e.g. "F20-1-7" -> ("flat_cmr", {"pairs": 20.0, ...}).'''
+    kind, values = text[0], text[1:].split("-")
+    if kind not in _id_fields or len(values) != len(_id_fields[kind]):
+        raise ValueError(f"{text!r} is not a CMR label ID")
+    return {"F": "flat_cmr", "B": "biconvex_cmr"}[kind], dict(zip(_id_fields[kind], map(float, values)))
+
+@cached_cell
+def glyph_cell(character,size,layer):
+    from gdsfactory.components.text import _glyph
+    glyph = gf.Component("glyph")
+    scaling = size/1000 #glyphs are drawn 1000 units high
+    for points in _glyph[ord(character)]:
+        glyph.add_polygon([(x*scaling, y*scaling) for x, y in points], layer=layer)
+    return glyph
+
+def label_position():
+    return (originx - 3*pad_width/4, originy - 15) #top left of the label, below the CMR
+
+def label_glyphs(text):
+    '''(character, x, y) of every printed character of a label, left justified at label_position() like gf.components.text.'''
+    from gdsfactory.components.text import _indent, _width
+    scaling = label_size/1000
+    x0, y = label_position()
+    for line in text.split("\n"):
+        x = x0
+        for character in line:
+            code = ord(character)
+            if character == " ":
+                x += 500*scaling
+                continue
+            if not 33 <= code <= 126:
+                raise ValueError(f"No character with ascii value {code!r}")
+            yield character, x, y
+            x += (_width[code] + _indent[code])*scaling
+        y -= 1500*scaling
+
+@cached_cell
+def label_cell(text):
     label = gf.Component("label")
-    text = f"Pair num = {electrode_number/2}\nPeriod = {2*(electrode_width+electrode_separation)}\nTether w = {tether_width+2*etch_buffer}"
-    
-    label_contents = label << gf.components.text(
-        text=text,
-        size=5,
-        position=[originx - 3*pad_width/4, originy - 15],
-        justify='left',
-        layer=metal_layer
-    )
 
-    #########Define final flat-edge CMR component#############
-    CMR_and_label = gf.Component("final_component")
-    CMR_and_label << CMR_component
-    CMR_and_label << label
+    with stage("label_text"):
+        if label_engine == "polygons":
+            label << gf.components.text(text=text, size=label_size, position=label_position(), justify='left', layer=metal_layer)
+            return label
+        for character, x, y in label_glyphs(text):
+            (label << glyph_cell(character, label_size, metal_layer)).move((x, y))
+    return label
+
+def place_with_label(component, cmr, label, angle):
+    '''Reference the CMR cell into component rotated by angle (degrees, about its centre) and the label upright,
+    as far below the rotated device's bounding box as it is below the unrotated one. Every angle shares one CMR cell.'''
+    ref = component << cmr
+    label_ref = component << label
+    if angle % 360:
+        (x0, y0), _ = cmr.bbox
+        ref.rotate(angle, center=cmr.center)
+        #origins on the 1 nm grid, as write_gds would leave them, so every build path places the device alike
+        (x, y), (snapped_x, snapped_y) = ref.origin, gf.snap.snap_to_grid(ref.origin)
+        ref.move((snapped_x - x, snapped_y - y))
+        label_ref.move(gf.snap.snap_to_grid((ref.xmin - x0, ref.ymin - y0)))
+    return ref
 
-    final_component = gf.Component("final_component")
-    fc = final_component << CMR_and_label
-    fc.move(origin=[originx,originy],destination=[destinationx,destinationy])
+######################################################################
+#                      Flat-edge CMR Method                          #
+######################################################################
+'''Instead of porting each individual IDT finger to the bus, a union is done between all metallized parts to create one solid metal layer component.
+ The etch windows are also defined using unions instead of ports. The bus/pad and route are done using ports and defined more correctly.'''
 
-    return final_component
+################Create etch windows#######################
+def flat_window_outlines(bus_length,tether_width):
+    '''The top and bottom etch windows as closed-form outlines, None unless outline_engine = "analytic" can write them.'''
+    if outline_engine != "analytic" or tether_width > bus_length: #wider tethers poke the legs through the top window
+        return None
+    etch_window_length = 2*bus_width + electrode_length + electrode_end_margin + 2*(etch_buffer + etch_window_gap)
+    top_x1 = originx-(etch_buffer + etch_window_gap)
+    top_y1 = bus_length + etch_buffer
+    left_x2 = originx - etch_buffer
+    left_y1 = bus_length/2 + tether_width/2 + etch_buffer
+    right_x1 = originx + 2*bus_width + electrode_length + electrode_end_margin + etch_buffer
+    with stage("window_outline"):
+        top_window = cmr_geometry.window_outline(top_x1,top_x1 + etch_window_length,left_y1,top_y1 + etch_window_gap,etch_window_gap,
+                                                 [(left_x2,top_y1),(right_x1,top_y1)])
+    return [top_window, cmr_geometry.mirror_y(top_window,originy + bus_length/2)]
 
+@cached_cell
+def flat_etch_window_cell(bus_length,tether_width):
+    etch_window = gf.Component("etch_window") #define top etch window subcomponents
 
-######################################################################
-#                      Biconvex-edge CMR Method                      #
-######################################################################   
-'''The curvature is defined by subtracting an ellipse with two radii r1,r2 from a rectangle. 
-That means adding curvature adds area to the resonator and substracts area from the etch window.'''
+    etch_window_length = 2*bus_width + electrode_length + electrode_end_margin + 2*(etch_buffer + etch_window_gap) #horizontal window length
+    etch_window_height = bus_length/2 - tether_width/2 #vertical window length
 
-def biconvex_cmr(destinationx,destinationy,electrode_number,electrode_separation,electrode_width,tether_width,angle,k):
-    #c = gf.Component("pad_and_bus")
-    
-    ################Add one bus, tether, taper + port###################
-    bus = gf.Component("bus")
+    top_x1 = originx-(etch_buffer + etch_window_gap)
+    top_x2 = top_x1 + etch_window_length
+    top_y1 = bus_length + etch_buffer
+    top_y2 = top_y1 + etch_window_gap
 
-    bus_length = electrode_number*(electrode_width+electrode_separation)-electrode_separation #length of metal electrode connecting idt fingers
+    left_x1 = originx - etch_window_gap - etch_buffer
+    left_x2 = left_x1 + etch_window_gap
+    left_y1 = bus_length/2 + tether_width/2 + etch_buffer
+    left_y2 = left_y1 + etch_window_height
 
-    p1 = bus.add_polygon(
-        [(originx,originx,bus_width,bus_width),(originy,bus_length,bus_length,originy)],layer=metal_layer
-    )
+    right_x1 = originx + 2*bus_width + electrode_length + electrode_end_margin + etch_buffer
+    right_x2 = right_x1 + etch_window_gap
+    right_y1 = bus_length/2 + tether_width/2 + etch_buffer
+    right_y2 = right_y1 + etch_window_height
 
-    bus.add_port(
-        name="bus_port",center=[originx,bus_length/2],width=tether_width,orientation=180,layer=metal_layer #standard orientation of port is parallel to y axis
-    )
+    outlines = flat_window_outlines(bus_length,tether_width)
+    if outlines is not None:
+        etch_window_complete = gf.Component("etch_window_complete")
+        for outline in outlines:
+            etch_window_complete.add_polygon(outline,layer=resist_layer)
+        return etch_window_complete
 
-    tether = gf.Component("tether")
+    #union acting weird and only taking two arguments so I have to make this dodgy fix and do two unions, sorry
 
-    p2 = tether.add_polygon(
-        [(originx,originx,originx+tether_length,originx+tether_length),(originy,originy+tether_width,originy+tether_width,originy)]
-    )
-    
-    tether.add_port(
-        name="tether_port1",center=[originx,tether_width/2],width=tether_width,orientation=180,layer=metal_layer #standard orientation of port is parallel to y axis
-    )
-    tether.add_port(
-        name="tether_port2",center=[originx+tether_length,tether_width/2],width=tether_width,orientation=0,layer=metal_layer #standard orientation of port is parallel to y axis
-    )
-    
-    taper =  gf.components.taper(
-        length = taper_length,
-        width1 = arm_width,
-        width2 = tether_width,
-        with_two_ports = True,
-        port_order_name = ("taper_port1","taper_port2"),
-        layer = metal_layer
-    )
+    etch_window_union1 = gf.Component("etch_window_union") #make union so there is one continuous top etch window
+    top_window = etch_window_union1.add_polygon([(top_x1,top_y1),(top_x1,top_y2),(top_x2,top_y2),(top_x2,top_y1)],layer=resist_layer)
+    left_window = etch_window_union1.add_polygon([(left_x1,left_y1),(left_x1,left_y2),(left_x2,left_y2),(left_x2,left_y1)],layer=resist_layer)
+    with stage("etch_window_union"):
+        etch_window_union1 = merged(etch_window_union1, resist_layer)
 
-    connect_parts = gf.Component("connect_parts")
-    c1 = connect_parts << bus
-    c2 = connect_parts << tether
-    c3 = connect_parts << taper
+    etch_window_union2 = gf.Component("etch_window_union2") #make union so there is one continuous top etch window
+    etch_window_union2 << etch_window_union1
+    right_window = etch_window_union2.add_polygon([(right_x1,right_y1),(right_x1,right_y2),(right_x2,right_y2),(right_x2,right_y1)],layer=resist_layer)
+    with stage("etch_window_union"):
+        etch_window_union2 = merged(etch_window_union2, resist_layer)
 
-    c2.connect("tether_port2",c1.ports["bus_port"])
-    c3.connect("taper_port2",c2.ports["tether_port1"])
+    etch_window_complete = gf.Component("etch_window_complete") #mirror top etch window so there are two etch windows top and bottom
 
-    #must add component-level reference to underlying subcomponent port
-    connect_parts.add_port(
-       name="taper_port",port=c3.ports["taper_port1"] 
-    )
+    mirror_originx = originx
+    mirror_originy = originy + bus_length/2
+    mirror_p1 = mirror_originx + etch_window_length/2
 
-    ##############Add one pad + port #######################
-    pad = gf.Component("pad")
-    
-    pad_originx = originx-3*pad_width/4
-    pad_originy = originy+2*29.75 #fixed height based on longest bus length with 60 fingers
+    top_window = etch_window_complete << etch_window_union2
+    bottom_window = etch_window_complete << etch_window_union2
+    bottom_window.mirror(p1=[mirror_originx,mirror_originy],p2=[mirror_p1,mirror_originy])
+    return etch_window_complete
 
-    pad.add_polygon(
-        [(pad_originx,pad_originx,pad_originx+pad_width,pad_originx+pad_width),(pad_originy,pad_originy+pad_height,pad_originy+pad_height,pad_originy)],layer=metal_layer
-    )
-    pad.add_port(
-        name="pad_port",center=[pad_originx+arm_width/2,pad_originy],width=arm_width,orientation=270,layer=metal_layer
-    )
+###########Make component including etch windows and CMR##################
+@cached_cell
+def flat_cmr_cell(electrode_number,electrode_separation,electrode_width,tether_width,undercut,idt_mode):
+    bus_length = electrode_number*(electrode_width+electrode_separation)-electrode_separation #length of metal electrode connecting idt fingers
 
-    ##########Get route between bus and pad#################
-    pad_and_bus = gf.Component("pad_and_bus")
+    CMR_component = gf.Component("CMR_component")
+    CMR_component << cmr_metal_cell(electrode_number,electrode_separation,electrode_width,tether_width,idt_mode)
+    if undercut:
+        CMR_component << flat_etch_window_cell(bus_length,tether_width)
+    return CMR_component
 
-    port1 = pad_and_bus << connect_parts
-    port2 = pad_and_bus << pad
+@profiled("flat_cmr")
+@named_device("flat_cmr")
+def flat_cmr(destinationx,destinationy,electrode_number,electrode_separation,electrode_width,tether_width,angle,undercut,idt_mode=None):
+    if idt_mode is None:
+        idt_mode = default_idt_mode
 
-    route = gf.routing.get_route(
-        port1.ports["taper_port"], 
-        port2.ports["pad_port"],
-        width = arm_width
-    )
-    pad_and_bus.add(route.references)
+    ############Create label for flat-edge CMR###################
+    text = label_text("flat_cmr",pairs=electrode_number/2,period=2*(electrode_width+electrode_separation),tether=tether_width+2*etch_buffer)
 
-    ##########Mirror bus and pad about center of IDT#############
-    mirror_originx = originx+  bus_width + (electrode_length + electrode_end_margin)/2
-    mirror_originy = originy + bus_length/2
+    #########Define final flat-edge CMR component#############
+    CMR_and_label = gf.Component("final_component")
+    place_with_label(CMR_and_label, flat_cmr_cell(electrode_number,electrode_separation,electrode_width,tether_width,undercut,idt_mode), label_cell(text), angle)
 
-    pad_and_bus_complete = gf.Component("pad_and_bus_mirrored")
-    bus_and_pad_1 = pad_and_bus_complete << pad_and_bus
-    bus_and_pad_2 = pad_and_bus_complete << pad_and_bus
-    bus_and_pad_2.mirror(p1=[mirror_originx,0],p2=[mirror_originx,mirror_originy])
+    final_component = gf.Component("final_component")
+    fc = final_component << CMR_and_label
+    fc.move(origin=[originx,originy],destination=[destinationx,destinationy])
+
+    return final_component
 
-    ##########Add IDT electrodes###########################
-    idt_array = gf.Component("idt_electrodes")
-    electrodes = []
-
-    for i in range(electrode_number):
-        # Calculate x-coordinate for the current electrode
-        x1 = originx + bus_width
-        x2 = x1 + electrode_length
-        y1 = originy + ((i)*(electrode_width+electrode_separation))
-        y2 = y1 + electrode_width
-        
-        # Check if the current electrode should be offset
-        if i % 2 == 1:
-            x1 += electrode_end_margin  # Offset for every second electrode
-            x2 += electrode_end_margin
-        
-        electrode_i = idt_array.add_polygon([(x1,y1),(x1,y2),(x2,y2),(x2,y1)],layer = (1,0))
-        electrodes.append(electrode_i)
-    
-    union_component = gf.Component("complete_component")
-    union_component << pad_and_bus_complete
-    union_component << idt_array
-    union_component = gf.geometry.union(union_component, by_layer=False, layer=metal_layer)
 
-    ################Create top curved etch window#######################
+######################################################################
+#                      Biconvex-edge CMR Method                      #
+######################################################################
+'''The curvature is defined by subtracting an ellipse with two radii r1,r2 from a rectangle.
+That means adding curvature adds area to the resonator and substracts area from the etch window.'''
+
+################Create top curved etch window#######################
+def biconvex_window_outlines(bus_length,tether_width,k):
+    '''The curved top and bottom etch windows as closed-form outlines, None unless outline_engine = "analytic" can write them.'''
+    if outline_engine != "analytic" or k >= etch_window_gap or tether_width > bus_length: #otherwise the window is not a single inverted U
+        return None
+    etch_window_length = 2*bus_width + electrode_length + electrode_end_margin + 2*etch_buffer
+    left_x2 = originx - etch_buffer
+    left_y1 = bus_length/2 + tether_width/2 + etch_buffer
+    top_y1 = left_y1 + bus_length/2 - tether_width/2
+    with stage("window_outline"):
+        if curve_tolerance is None:
+            curve = cmr_geometry.ellipse_cap(etch_window_length,k) + (left_x2,top_y1)
+        else:
+            curve = cmr_geometry.ellipse_cap_adaptive(etch_window_length,k,curve_tolerance) + (left_x2,top_y1)
+        top_window = cmr_geometry.window_outline(left_x2-etch_window_gap,left_x2+etch_window_length+etch_window_gap,left_y1,
+                                                 top_y1+etch_window_gap,etch_window_gap,curve)
+    return [top_window, cmr_geometry.mirror_y(top_window,originy + bus_length/2)]
+
+@cached_cell
+def biconvex_etch_window_cell(bus_length,tether_width,k):
     #method:subtract ellipse with radii r1,r2 from rectangle to create curved edge
 
     etch_window_length = 2*bus_width + electrode_length + electrode_end_margin + 2*etch_buffer #horizontal window length
     etch_window_height = bus_length/2 - tether_width/2 + etch_window_gap #vertical window length
 
+    outlines = biconvex_window_outlines(bus_length,tether_width,k)
+    if outlines is not None:
+        etch_window_union = gf.Component("etch_window_union")
+        for outline in outlines:
+            etch_window_union.add_polygon(outline,layer=resist_layer)
+        return etch_window_union
+
     E = gf.components.ellipse(radii=(etch_window_length/2, k), layer=(1, 0))
     R = gf.components.rectangle(size=[etch_window_length, etch_window_gap], layer=(2, 0))
     bool = gf.Component("bool")
     E_ref = bool << E
     E_ref.movex(etch_window_length/2)
-    R_ref = bool << R 
-    bool_obj = gf.geometry.boolean(A=R_ref, B=E_ref, operation="not", precision=1e-6, layer=(3, 0))
+    R_ref = bool << R
+    with stage("ellipse_boolean"):
+        bool_obj = subtracted(R_ref, E_ref, (3, 0))
 
     bool = gf.Component("bool")
     bool << bool_obj
@@ -416,68 +614,121 @@ def biconvex_cmr(destinationx,destinationy,electrode_number,electrode_separation
     c1.connect("tw2",c3.ports["rw"])
 
     etch_window_complete = gf.Component("etch_window_complete") #mirror top etch window so there are two etch windows top and bottom
-    
-    mirror_originx = originx 
+
+    mirror_originx = originx
     mirror_originy = originy + bus_length/2
     mirror_p1 = mirror_originx + etch_window_length/2
-    
+
     top_etch_window = etch_window_complete << top_window
     bottom_etch_window = etch_window_complete << top_window
     bottom_etch_window.mirror(p1=[mirror_originx,mirror_originy],p2=[mirror_p1,mirror_originy])
 
-    etch_window_union = gf.Component("etch_window_union") #make union so there is one continuous top etch window
-    etch_window_union << etch_window_complete
-    etch_window_union = gf.geometry.union(etch_window_complete, by_layer=False, layer=resist_layer)
+    with stage("etch_window_union"):
+        return merged(etch_window_complete, resist_layer)
+
+###########Make component including etch windows and CMR and rotate if necessary##################
+@cached_cell
+def biconvex_cmr_cell(electrode_number,electrode_separation,electrode_width,tether_width,k,idt_mode):
+    bus_length = electrode_number*(electrode_width+electrode_separation)-electrode_separation #length of metal electrode connecting idt fingers
 
-    ###########Make component including etch windows and CMR and rotate if necessary##################
     CMR_component = gf.Component("CMR_component")
-    CMR_component << union_component
-    CMR_component << etch_window_union
-    CMR_component.rotate(angle)
+    CMR_component << cmr_metal_cell(electrode_number,electrode_separation,electrode_width,tether_width,idt_mode)
+    CMR_component << biconvex_etch_window_cell(bus_length,tether_width,k)
+    return CMR_component
 
+@profiled("biconvex_cmr")
+@named_device("biconvex_cmr")
+def biconvex_cmr(destinationx,destinationy,electrode_number,electrode_separation,electrode_width,tether_width,angle,k,idt_mode=None):
+    if idt_mode is None:
+        idt_mode = default_idt_mode
 
     ############Create label for biconvex-edge CMR###################
-    label = gf.Component("label")
-    text = f"Pair num = {electrode_number/2}\nPeriod = {2*(electrode_width+electrode_separation)}\nTether w = {tether_width+2*etch_buffer}\nk = {k}"
-    
-    label_contents = label << gf.components.text(
-        text=text,
-        size=5,
-        position=[originx - 3*pad_width/4, originy - 15],
-        justify='left',
-        layer=metal_layer
-    )
+    text = label_text("biconvex_cmr",pairs=electrode_number/2,period=2*(electrode_width+electrode_separation),tether=tether_width+2*etch_buffer,k=k)
 
     #########Define final biconvex-edge CMR component#############
     CMR_and_label = gf.Component("CMR and label")
-    CMR_and_label << CMR_component
-    CMR_and_label << label
+    place_with_label(CMR_and_label, biconvex_cmr_cell(electrode_number,electrode_separation,electrode_width,tether_width,k,idt_mode), label_cell(text), angle)
 
     final_component = gf.Component("final_component")
     fc = final_component << CMR_and_label
     fc.move(origin=[originx,originy],destination=[destinationx,destinationy])
-    
+
     return final_component
 
+
+######################################################################
+#                      Outline Engine Check                          #
+######################################################################
+
+def check_outline_engines(electrode_number,electrode_separation,electrode_width,tether_width,k=None,tolerance=1e-3):
+    '''Build one CMR with both outline engines and return the XOR area per layer.
+    k=None checks a flat-edge CMR, otherwise a biconvex one. Raises ValueError if on any layer the XOR area divided by
+    the outline perimeter, i.e. the mean edge displacement, exceeds tolerance (um, default one 1 nm grid step).
+    The analytic curve is sampled like the boolean path's ellipse for the comparison (curve_tolerance = None).'''
+    global outline_engine, curve_tolerance
+    previous_engine, previous_tolerance = outline_engine, curve_tolerance
+    polygons = {}
+    try:
+        curve_tolerance = None
+        for engine in ("analytic","boolean"):
+            outline_engine = engine
+            if k is None:
+                cmr = flat_cmr_cell(electrode_number,electrode_separation,electrode_width,tether_width,True,"union")
+            else:
+                cmr = biconvex_cmr_cell(electrode_number,electrode_separation,electrode_width,tether_width,k,"union")
+            polygons[engine] = cmr.get_polygons(by_spec=True)
+    finally:
+        outline_engine, curve_tolerance = previous_engine, previous_tolerance
+
+    areas = cmr_geometry.xor_area(polygons["analytic"],polygons["boolean"])
+    mismatched = {layer: area for layer, area in areas.items()
+                  if area > tolerance*sum(cmr_geometry.perimeter(p) for p in polygons["boolean"].get(layer,[]))}
+    if mismatched:
+        raise ValueError(f"analytic and boolean outlines differ (XOR area per layer in um^2): {mismatched}")
+    return areas
+
 ###########################################################
 #            Undercut Test Structures Method              #
 ###########################################################
 
-def undercut_ring(destinationx,destinationy,radius,width):
-    #radius is center radius of ring between inner radius and outer radius
-    radius = 25 - width/2 
+'''The resist frame is the bounding box of the tethered ring (ring_frame_margin taller at top and bottom) minus the ring
+and its tethers, i.e. the disk inside the ring and the frame above and below the tethers. outline_engine = "analytic"
+writes these three outlines from the ring and tether dimensions (cmr_geometry.ring_frame), "boolean" clips the box
+with subtracted. Either way the frame is a cached cell per (radius, width, tether_width, angle_resolution).'''
+
+ring_tether_overlap = 0.5 #tethers reach this far into the ring
+ring_frame_margin = 3 #resist frame extends this far above and below the ring
 
-    tether_width = 10
+def ring_frame_outlines(radius,width,tether_width,angle_resolution):
+    '''The resist frame as closed-form outlines around (originx, originy), None unless outline_engine = "analytic" can write them.'''
+    if outline_engine != "analytic" or ring_tether_overlap >= width or tether_width/2 >= radius - ring_tether_overlap:
+        return None
+    with stage("ring_frame"):
+        frame = cmr_geometry.ring_frame(radius,width,tether_width,etch_window_gap + etch_buffer,ring_tether_overlap,ring_frame_margin,angle_resolution)
+    return [outline + (originx,originy) for outline in frame]
+
+@cached_cell
+def undercut_ring_cell(radius,width,tether_width,angle_resolution):
     tether_length = etch_window_gap + etch_buffer
 
-    left_port_x = originx-radius-width/2+0.5
+    outlines = ring_frame_outlines(radius,width,tether_width,angle_resolution)
+    if outlines is not None:
+        ring_frame = gf.Component("ring_frame")
+        for outline in outlines:
+            ring_frame.add_polygon(outline,layer=resist_layer)
+        return ring_frame
+
+    center_radius = radius - width/2 #gf ring radius is measured to the middle of the ring
+
+    left_port_x = originx-center_radius-width/2+ring_tether_overlap
     left_port_y = originy
 
-    right_port_x = originx+radius+width/2-0.5
+    right_port_x = originx+center_radius+width/2-ring_tether_overlap
     right_port_y = originy
 
     ring =gf.Component("ring")
-    c1 = ring << gf.components.ring(radius=radius, width=width, angle_resolution=2.5, layer=metal_layer)
+    c1 = ring << gf.components.ring(radius=center_radius, width=width, angle_resolution=angle_resolution, layer=metal_layer)
+    c1.move(destination=(originx,originy))
     ring.add_port(
         name="left_port", center=[left_port_x,left_port_y], width=tether_width, orientation=180, layer=metal_layer
     )
@@ -509,21 +760,29 @@ def undercut_ring(destinationx,destinationy,radius,width):
     rt.connect("rp",r.ports["right_port"])
     
     tethered_ring = gf.Component("tethered_ring")
-    tethered_ring << gf.geometry.union(ring_and_tethers, layer=metal_layer)
+    with stage("ring_union"):
+        tethered_ring << merged(ring_and_tethers, metal_layer)
     
     #get bound box
     boundary = gf.Component("boundary")
     boundary << tethered_ring
-    p1 = boundary.get_polygon_bbox(top=3, bottom=3)
+    p1 = boundary.get_polygon_bbox(top=ring_frame_margin, bottom=ring_frame_margin)
     p2 = boundary.add_polygon(p1, layer=resist_layer)
 
     difference_resist = gf.Component("difference")
     R = difference_resist << tethered_ring
     P = difference_resist << boundary
-    difference_box = gf.geometry.boolean(A=P, B=R, operation="not", precision=1e-6, layer=resist_layer)
+    with stage("resist_boolean"):
+        difference_box = subtracted(P, R, resist_layer)
+
+    return difference_box
 
+@profiled("undercut_ring")
+@named_device("undercut_ring")
+def undercut_ring(destinationx,destinationy,radius,width,tether_width=10,angle_resolution=2.5):
+    #radius is the outer radius of the ring, width its radial width
     ring_and_resist = gf.Component("ring_and_resist")
-    fc = ring_and_resist << difference_box
+    fc = ring_and_resist << undercut_ring_cell(radius,width,tether_width,angle_resolution)
 
     fc.move(origin=[originx,originy],destination=[destinationx,destinationy])
 
@@ -533,7 +792,18 @@ def undercut_ring(destinationx,destinationy,radius,width):
 #            Alignment Marker Method                #
 #####################################################    
 
-def alignment_marker(originx,originy):
+'''Every marker type is one cached cell built around (originx, originy). Marks are placed as references to it,
+single marks with place_markers and lattices of marks (e.g. one per write field) as GDS array references with
+place_marker_arrays, so a mask with hundreds of marks still holds one definition per marker type.'''
+
+write_field = None #(width, height) of the EBL write field in um, fields tile the plane from (originx, originy); None for no local marks
+local_marker_inset = 10 #local marks sit this far inside each write field corner
+local_marker_length = 20
+local_marker_width = 1
+
+@cached_cell
+def alignment_marker_cell():
+    #global mark around (originx, originy), built once and placed by reference
     
     alignment = gf.Component("alignment_2")  
    
@@ -567,45 +837,200 @@ def alignment_marker(originx,originy):
     align_component << mirror3
     return align_component
 
+@cached_cell
+def local_marker_cell():
+    #write field mark: a plain cross centred on (originx, originy)
+    local = gf.Component("local_marker")
+    cross = local << gf.components.cross(length=local_marker_length, width=local_marker_width, layer=metal_layer)
+    cross.move(destination=(originx,originy))
+    return local
+
+marker_library = {"global": alignment_marker_cell, "local": local_marker_cell}
+
+def place_markers(component, marker, positions):
+    '''Reference the marker_library cell `marker` into component, centred on every (x, y) of positions.'''
+    cell = marker_library[marker]()
+    for x, y in positions:
+        ref = component << cell
+        ref.move(origin=(originx,originy),destination=(x,y))
+
+def place_marker_arrays(component, marker, arrays):
+    '''Reference the marker_library cell `marker` as one array per (origin, columns, rows, spacing) of arrays.'''
+    cell = marker_library[marker]()
+    for (x, y), columns, rows, spacing in arrays:
+        ref = component.add_array(cell, columns=columns, rows=rows, spacing=spacing)
+        ref.move(origin=(originx,originy),destination=(x,y))
+
+def write_field_marker_arrays(bbox, field_size, inset):
+    '''Local mark lattices for every write field touching bbox ((xmin, ymin), (xmax, ymax)): one mark inset from each
+    field corner, as four (origin, columns, rows, spacing) arrays, one per corner.'''
+    (xmin, ymin), (xmax, ymax) = bbox
+    field_x, field_y = field_size
+    first_column, first_row = math.floor((xmin - originx)/field_x), math.floor((ymin - originy)/field_y)
+    columns = max(1, math.ceil((xmax - originx)/field_x) - first_column)
+    rows = max(1, math.ceil((ymax - originy)/field_y) - first_row)
+    x0, y0 = originx + first_column*field_x, originy + first_row*field_y
+    return [((x0 + dx, y0 + dy), columns, rows, (field_x, field_y))
+            for dx in (inset, field_x - inset) for dy in (inset, field_y - inset)]
+
+@profiled("alignment_marker")
+@named_device("alignment_marker")
+def alignment_marker(x,y):
+    #global mark centred on (x, y)
+    alignment = gf.Component("alignment_marker")
+    place_markers(alignment, "global", [(x,y)])
+    return alignment
+
 #############################################################################
 #             Create grid with parametric sweep                             #
 #############################################################################
-components_list = []
-for w in [2.5,5,10,15,20]:
-    A = undercut_ring(originx,originy,radius,w)
-    components_list.append(A)
-for t in [1.25,2.5,5,10,bus_length]:
-    C = flat_cmr(originx,originy,electrode_number,electrode_separation,electrode_width,t,angle,undercut)
-    components_list.append(C)
-for r in [0.5,1,1.5,2,2.5]:
-    for t in [1.25,2.5,5,10,bus_length]:
-        B = biconvex_cmr(originx,originy,electrode_number,electrode_separation,electrode_width,t,angle,r)
-        components_list.append(B)
-components_list.append(flat_cmr(originx,originy,electrode_number,0.125,0.125,tether_width,angle,False))
-components_list.append(flat_cmr(originx,originy,electrode_number,electrode_separation,electrode_width,tether_width,45,False))
-components_list.append(flat_cmr(originx,originy,electrode_number,electrode_separation,electrode_width,tether_width,angle,False))
-components_list.append(flat_cmr(originx,originy,electrode_number,electrode_separation,electrode_width,tether_width,45,undercut))
-components_list.append(flat_cmr(originx,originy,electrode_number,0.375,0.375,tether_width,angle,False))
-
-
-grid = gf.grid(
-    components_list,
-    spacing =(20,20),
-    separation=True,
-    shape=(8,5),
-    align_x="x",
-    align_y="y",
-    edge_x="x",
-    edge_y="ymax"
-)
-
-all_components = gf.Component("all_components")
-all_components << grid
-all_components << alignment_marker(1400,1400)
-all_components << alignment_marker(1400,-300)
-all_components << alignment_marker(-350,1400)
-all_components << alignment_marker(-350,-300)
-
-
-all_components.write_gds("all_components.gds")
-all_components.show()
\ No newline at end of file
+'''A sweep is a list of (builder name, args) jobs, expanded from a spec file (cmr_sweep.py), so it can be built
+serially or, with sweep_workers > 1, across a process pool (cmr_parallel.py). Both give the same devices in the same order.
+With sweep_cache_dir set, every device is kept as a GDS fragment there and only changed devices are rebuilt.'''
+
+builders = {"flat_cmr": flat_cmr, "biconvex_cmr": biconvex_cmr, "undercut_ring": undercut_ring}
+
+sweep_spec = os.path.join(os.path.dirname(os.path.abspath(__file__)), "default_sweep.json")
+sweep_workers = 1 #number of processes used to build the sweep, None for one per core
+sweep_cache_dir = None #directory of per-device GDS fragments reused across runs, None to always rebuild
+device_backend = "gf" #"direct" streams devices as flat cells written from NumPy arrays (cmr_direct.py), in one process
+
+def default_sweep():
+    import cmr_sweep
+    return cmr_sweep.load_sweep(sweep_spec, sys.modules[__name__])
+
+def build_settings():
+    #module globals a device depends on, handed to worker processes and hashed into the sweep cache
+    return dict(zip(constant_names, geometry_constants()), default_idt_mode=default_idt_mode)
+
+@profiled("build_sweep")
+def build_sweep(jobs,workers=1,cache_dir=None):
+    if cache_dir is not None:
+        import cmr_sweep
+        return cmr_sweep.build_sweep_cached(jobs, cache_dir, max_workers=workers, settings=build_settings())
+    if workers == 1:
+        return [builders[builder](*args) for builder, args in jobs]
+
+    import cmr_parallel
+    return cmr_parallel.build_sweep_parallel(jobs, max_workers=workers, settings=build_settings())
+
+#############################################################################
+#                     Assemble mask with alignment markers                 #
+#############################################################################
+
+'''mask_placement = "grid" places the devices with gf.grid in mask_grid_shape, in sweep order.
+mask_placement = "fields" packs them into write fields (cmr_place.py): every device inside a single field, clear of
+the local marks and the global marks, fields written in serpentine order. It needs write_field. A device too large
+for a field keeps only its core (device_core) inside one, its pads and routes are stitched.'''
+
+mask_placement = "grid"
+mask_grid_shape = (-1,5) #rows, columns; one of them may be -1 for as many as needed (8 rows for the default sweep)
+mask_grid_spacing = (20,20) #also the spacing between devices placed in write fields
+mask_markers = [(1400,1400),(1400,-300),(-350,1400),(-350,-300)]
+field_margin = 25 #devices keep this far from the write field edges, clear of the local marks
+
+def marker_keepouts():
+    #boxes of the global marks, which field placement keeps devices away from
+    (x0, y0), (x1, y1) = marker_library["global"]().bbox
+    return [((x0 + x - originx, y0 + y - originy), (x1 + x - originx, y1 + y - originy)) for x, y in mask_markers]
+
+def _core_corners(builder, values):
+    #corners of the device core in the cell the builder rotates (about originx, originy), and that cell or None
+    if builder == "undercut_ring":
+        r = values["radius"]
+        return [(originx - r, originy - r), (originx + r, originy - r), (originx + r, originy + r), (originx - r, originy + r)], None
+    n, s, w = values["electrode_number"], values["electrode_separation"], values["electrode_width"]
+    x1, y1 = originx + 2*bus_width + electrode_length + electrode_end_margin, originy + n*(w + s) - s #both combs and their buses
+    corners = [(originx, originy), (x1, originy), (x1, y1), (originx, y1)]
+    if builder == "flat_cmr":
+        return corners, lambda: flat_cmr_cell(n, s, w, values["tether_width"], values["undercut"], values["idt_mode"] or default_idt_mode)
+    return corners, lambda: biconvex_cmr_cell(n, s, w, values["tether_width"], values["k"], values["idt_mode"] or default_idt_mode)
+
+def _rotated(corners, angle, center=(0, 0)):
+    cos, sin = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+    return [(center[0] + cos*(x - center[0]) - sin*(y - center[1]), center[1] + sin*(x - center[0]) + cos*(y - center[1])) for x, y in corners]
+
+def device_core(builder, args):
+    '''Box ((xmin, ymin), (xmax, ymax)) of the part of the device builders[builder](*args) that must not be stitched:
+    the combs (fingers and buses) of a CMR, the ring of an undercut ring. Computed from the arguments; a rotated CMR
+    builds its CMR cell (cached) for the centre it is rotated about.'''
+    bound = inspect.signature(builders[builder]).bind(*args)
+    bound.apply_defaults()
+    values = bound.arguments
+    corners, cmr_cell = _core_corners(builder, values)
+    if values.get("angle", 0) % 360: #as place_with_label rotates the CMR reference, its origin snapped to 1 nm
+        center = cmr_cell().center
+        (x, y) = _rotated([(0, 0)], values["angle"], center)[0]
+        snapped_x, snapped_y = gf.snap.snap_to_grid((x, y))
+        corners = [(cx + snapped_x - x, cy + snapped_y - y) for cx, cy in _rotated(corners, values["angle"], center)]
+    shift = (values["destinationx"] - originx, values["destinationy"] - originy)
+    xs, ys = [x + shift[0] for x, _ in corners], [y + shift[1] for _, y in corners]
+    return ((min(xs), min(ys)), (max(xs), max(ys)))
+
+def device_cores(jobs):
+    return [device_core(builder, args) for builder, args in jobs]
+
+def check_field_fit(jobs):
+    '''Raise ValueError, before anything is built, if the core of a device in the sweep jobs cannot fit in a write field.'''
+    import cmr_place
+    if write_field is None:
+        raise ValueError("mask_placement = 'fields' needs write_field = (width, height)")
+    sizes = []
+    for builder, args in jobs: #the size of a rotated core does not depend on the centre of rotation
+        bound = inspect.signature(builders[builder]).bind(*args)
+        bound.apply_defaults()
+        corners = _rotated(_core_corners(builder, bound.arguments)[0], bound.arguments.get("angle", 0))
+        sizes.append((max(x for x, _ in corners) - min(x for x, _ in corners), max(y for _, y in corners) - min(y for _, y in corners)))
+    cmr_place.check_fit(sizes, write_field, field_margin, "core of device")
+
+def field_offsets(bboxes, cores=None):
+    '''Offsets and write field index of every device for mask_placement = "fields"; cores as from device_cores.'''
+    import cmr_place
+    if write_field is None:
+        raise ValueError("mask_placement = 'fields' needs write_field = (width, height)")
+    return cmr_place.field_offsets(bboxes, write_field, field_margin, mask_grid_spacing, marker_keepouts(), (originx,originy), cores=cores)
+
+def place_in_fields(components_list, cores=None):
+    offsets, fields = field_offsets([component.bbox for component in components_list], cores)
+    placed = gf.Component("field_placement")
+    for i in sorted(range(len(components_list)), key=lambda i: fields[i]): #references in the order the fields are written
+        ref = placed << components_list[i]
+        ref.move(tuple(offsets[i]))
+    return placed
+
+@profiled("assemble_mask")
+def assemble_mask(components_list, jobs=None):
+    #jobs, the sweep components_list was built from, lets field placement stitch the pads of devices larger than a field
+    if mask_placement not in ("grid", "fields"):
+        raise ValueError(f"mask_placement must be 'grid' or 'fields', got {mask_placement!r}")
+
+    with stage("grid"):
+        if mask_placement == "fields":
+            grid = place_in_fields(components_list, None if jobs is None else device_cores(jobs))
+        else:
+            import cmr_stream
+            #a -1 is resolved here: gf.grid adds an empty row when the devices fill the last one
+            grid = gf.grid(
+                components_list,
+                spacing =mask_grid_spacing,
+                separation=True,
+                shape=cmr_stream.grid_shape(len(components_list), mask_grid_shape),
+                align_x="x",
+                align_y="y",
+                edge_x="x",
+                edge_y="ymax"
+            )
+
+    all_components = gf.Component("all_components")
+    all_components << grid
+    with stage("markers"):
+        place_markers(all_components, "global", mask_markers)
+        if write_field is not None:
+            place_marker_arrays(all_components, "local", write_field_marker_arrays(grid.bbox, write_field, local_marker_inset))
+    name_cells(all_components, "all_components") #the grid or field placement cell below it
+    return all_components
+
+
+if __name__ == "__main__":
+    import cmr_cli
+    cmr_cli.main()
\ No newline at end of file
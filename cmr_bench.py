@@ -0,0 +1,221 @@
+'''Benchmark suite for the CMR builders and mask assembly.
+
+Every case runs in a fresh process so peak RSS is not polluted by earlier cases, and records wall time
+(per stage where it applies), peak RSS, the RSS the case added on top of an imported gdsfactory and the size
+of the GDS it writes. Results are appended to a JSON lines history; each new result is compared with the
+median of the last few runs of the same case on the same host and flagged when it is slower, bigger or
+hungrier by more than the threshold.
+
+    python cmr_bench.py                       #all cases
+    python cmr_bench.py --quick               #small sizes only
+    python cmr_bench.py --case flat_cmr --fail-on-regression'''
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+electrode_numbers = [40, 160, 640, 2560, 5120]
+sweep_sizes = [10, 100, 1000, 10000]
+quick_electrode_numbers = [40, 160]
+quick_sweep_sizes = [10, 100]
+
+metrics = ("wall_s", "rss_delta_mb", "gds_bytes") #compared against the history; peak RSS is mostly the gdsfactory import
+noise_floor = {"rss_delta_mb": 5.0} #smaller increases are not flagged, whatever the ratio
+
+#####################################################
+#                    Cases                          #
+#####################################################
+
+def synthetic_jobs(cmr, n):
+    '''n sweep jobs mixing the three device families, with the parameter sharing of a real sweep. Every block of
+    40 jobs scales the tether and ring widths a little, so the number of distinct devices grows with n.'''
+    tethers = [1.25, 2.5, 5, 10, cmr.bus_length]
+    jobs = []
+    for i in range(n):
+        scale = 1 - 0.001*(i//40)
+        t = tethers[i % len(tethers)]*scale
+        pitch = 0.125*(1 + (i//len(tethers)) % 3)
+        if i % 8 == 0:
+            jobs.append(("undercut_ring", (0, 0, cmr.radius, [2.5, 5, 10, 15, 20][(i//8) % 5]*scale)))
+        elif i % 2:
+            jobs.append(("flat_cmr", (0, 0, cmr.electrode_number, pitch, pitch, t, 0, True)))
+        else:
+            jobs.append(("biconvex_cmr", (0, 0, cmr.electrode_number, pitch, pitch, t, 0, [0.5, 1, 1.5, 2, 2.5][i % 5])))
+    return jobs
+
+def _case_flat_cmr(cmr, stages, electrode_number):
+    return cmr.flat_cmr(0, 0, electrode_number, cmr.electrode_separation, cmr.electrode_width, cmr.tether_width, 0, True)
+
+def _case_biconvex_cmr(cmr, stages, electrode_number):
+    return cmr.biconvex_cmr(0, 0, electrode_number, cmr.electrode_separation, cmr.electrode_width, cmr.tether_width, 0, cmr.k)
+
+def _case_undercut_ring(cmr, stages, width):
+    return cmr.undercut_ring(0, 0, cmr.radius, width)
+
+def _case_alignment_marker(cmr, stages):
+    return cmr.alignment_marker(0, 0)
+
+def _case_sweep(cmr, stages, devices):
+    start = time.perf_counter()
+    components_list = cmr.build_sweep(synthetic_jobs(cmr, devices))
+    stages["build_s"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    grid = cmr.gf.grid(components_list, spacing=(20, 20), separation=True, align_x="x", align_y="y", edge_x="x", edge_y="ymax")
+    stages["grid_s"] = time.perf_counter() - start
+    return grid
+
+case_functions = {
+    "flat_cmr": _case_flat_cmr,
+    "biconvex_cmr": _case_biconvex_cmr,
+    "undercut_ring": _case_undercut_ring,
+    "alignment_marker": _case_alignment_marker,
+    "sweep": _case_sweep,
+}
+
+def default_cases(quick=False):
+    numbers = quick_electrode_numbers if quick else electrode_numbers
+    sizes = quick_sweep_sizes if quick else sweep_sizes
+    cases = [("flat_cmr", {"electrode_number": n}) for n in numbers]
+    cases += [("biconvex_cmr", {"electrode_number": n}) for n in numbers]
+    cases += [("undercut_ring", {"width": w}) for w in (2.5, 20)]
+    cases += [("alignment_marker", {})]
+    cases += [("sweep", {"devices": n}) for n in sizes]
+    return cases
+
+#####################################################
+#                 Case runner                       #
+#####################################################
+
+def _peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/1024**2 if sys.platform == "darwin" else peak/1024 #bytes on macOS, KiB elsewhere
+
+def _run_case(case):
+    name, params, repeat = case
+    import All_components_CMR as cmr
+    import cmr_parallel
+
+    #warm up gdsfactory (import, PDK activation) outside the measurement
+    cmr.flat_cmr(0, 0, 2, cmr.electrode_separation, cmr.electrode_width, cmr.tether_width, 0, True)
+    baseline_rss = _peak_rss_mb()
+
+    best = None
+    for _ in range(repeat): #best of repeat, each from empty caches
+        cmr.cell_cache.clear()
+        cmr_parallel.clear_gf_cache(cmr.gf)
+        stages = {}
+        start = time.perf_counter()
+        component = case_functions[name](cmr, stages, **params)
+        stages["total_build_s"] = time.perf_counter() - start
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.gds")
+            start = time.perf_counter()
+            component.write_gds(path)
+            stages["write_gds_s"] = time.perf_counter() - start
+            gds_bytes = os.path.getsize(path)
+
+        wall = stages["total_build_s"] + stages["write_gds_s"]
+        if best is None or wall < best["wall_s"]:
+            best = {"wall_s": wall, "stages": stages, "gds_bytes": gds_bytes}
+        del component
+
+    best["peak_rss_mb"] = _peak_rss_mb()
+    best["rss_delta_mb"] = best["peak_rss_mb"] - baseline_rss
+    if name == "sweep":
+        best["unique_devices"] = len(set(synthetic_jobs(cmr, params["devices"])))
+    return best
+
+def run_case(name, params, repeat=3):
+    '''Run one case in a fresh process and return its best-of-repeat measurements.'''
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(_run_case, (name, params, repeat)).result()
+
+#####################################################
+#              History and regressions              #
+#####################################################
+
+def case_key(name, params):
+    return name + "".join(f" {k}={v}" for k, v in sorted(params.items()))
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def append_history(path, records):
+    with open(path, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+def regressions(history, record, window=5, threshold=0.25):
+    '''Metrics of record that exceed the median of the last `window` runs of the same case on the same host by more than threshold.
+    Sweeps are only compared with runs that built as many distinct devices.'''
+    previous = [r for r in history if r["case"] == record["case"] and r["host"] == record["host"]
+                and r.get("unique_devices") == record.get("unique_devices")][-window:]
+    flagged = {}
+    for metric in metrics:
+        values = [r[metric] for r in previous if r.get(metric) is not None]
+        if not values:
+            continue
+        reference = statistics.median(values)
+        if reference > 0 and record[metric] > reference*(1 + threshold) and record[metric] - reference > noise_floor.get(metric, 0):
+            flagged[metric] = (reference, record[metric])
+    return flagged
+
+#####################################################
+#                     Main                          #
+#####################################################
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the CMR builders.")
+    parser.add_argument("--quick", action="store_true", help="small electrode counts and sweep sizes only")
+    parser.add_argument("--case", action="append", choices=sorted(case_functions), help="only run these case types")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the fastest is recorded")
+    parser.add_argument("--history", default="bench_history.jsonl", help="JSON lines file results are appended to")
+    parser.add_argument("--window", type=int, default=5, help="number of previous runs the median is taken over")
+    parser.add_argument("--threshold", type=float, default=0.25, help="relative increase flagged as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with status 1 if anything regressed")
+    args = parser.parse_args(argv)
+
+    history = load_history(args.history)
+    commit, host, stamp = _git_commit(), platform.node(), time.strftime("%Y-%m-%dT%H:%M:%S")
+    records, regressed = [], False
+    for name, params in default_cases(args.quick):
+        if args.case and name not in args.case:
+            continue
+        record = {"case": case_key(name, params), "params": params, "commit": commit, "host": host, "time": stamp}
+        record.update(run_case(name, params, args.repeat))
+        flagged = regressions(history, record, args.window, args.threshold)
+        regressed |= bool(flagged)
+        records.append(record)
+
+        line = f"{record['case']:<32} {record['wall_s']:9.3f} s {record['peak_rss_mb']:9.1f} MB (+{record['rss_delta_mb']:.1f}) {record['gds_bytes']:>12} B"
+        for metric, (reference, value) in flagged.items():
+            line += f"  REGRESSION {metric} {reference:.4g} -> {value:.4g}"
+        print(line, flush=True)
+
+    append_history(args.history, records)
+    return 1 if regressed and args.fail_on_regression else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+'''Content-addressed cell cache for the CMR builders.
+
+Cells are keyed on the geometric parameters that define them, so a bus, pad or route that
+appears in many devices of a sweep is built once and placed by reference everywhere else.
+The cache is a plain LRU: once it holds more than `limit` cells the least recently used one
+is dropped (devices that already reference it keep it alive, and while they do, asking for it again returns
+that same cell rather than a second one of the same name).
+
+Cached cells are named after their key (cell_name), not by gdsfactory's name counters, so the
+same parameters give the same cell name in every run and every worker process.'''
+
+from collections import OrderedDict
+import functools
+import hashlib
+import re
+import weakref
+
+#####################################################
+#                   Cache keys                      #
+#####################################################
+
+def normalize(value, digits=9):
+    #round floats so that e.g. 0.1+0.2 and 0.3 address the same cell, and 5 and 5.0 hash alike
+    if isinstance(value, bool) or value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)):
+        value = round(float(value), digits)
+        return int(value) if value.is_integer() else value
+    if isinstance(value, (list, tuple)):
+        return tuple(normalize(v, digits) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, normalize(v, digits)) for k, v in value.items()))
+    return value
+
+def cell_key(kind, params, constants=()):
+    '''Hashable key for a cell of type `kind` built from `params` under the global `constants`.'''
+    return (kind, normalize(params), normalize(constants))
+
+def key_digest(key, length=16):
+    '''Stable hex digest of a cell key (unlike hash(), identical across interpreter runs).'''
+    return hashlib.sha256(repr(key).encode()).hexdigest()[:length]
+
+#####################################################
+#                 Stable cell names                 #
+#####################################################
+
+_stable = re.compile(r"_[0-9a-f]{10}$")
+
+def is_stable(name):
+    '''True for names given by cell_name/name_cells (or cmr_parallel.content_rename): they end in _<10 hex digits>.'''
+    return bool(_stable.search(name))
+
+def cell_name(key, kind=None):
+    '''<kind>_<10 hex digits> for a cell key, kind defaulting to the key's own.'''
+    return f"{kind or key[0]}_{key_digest(key, 10)}"
+
+_components = weakref.WeakValueDictionary() #cell name -> the gf Component references of that name point to
+
+def _share_cells(component):
+    #point references to cells of one name (so of one content) at one Component, so gdsfactory does not find two
+    #cells of the same name when writing, e.g. the identical unions of two etch windows cached under different keys
+    for ref in component.references:
+        shared = _components.get(ref.parent.name)
+        if shared is None:
+            _components[ref.parent.name] = ref.parent
+            _share_cells(ref.parent)
+        elif shared is not ref.parent:
+            ref.parent = shared
+
+def live_cell(name):
+    '''The gf Component name_cells named name, if something still holds it, else None.'''
+    return _components.get(name)
+
+def name_cells(cell, name):
+    '''Rename a gdstk.Cell (or gf Component) to name, and every cell below it that still has a gdsfactory
+    name after its contents (cmr_parallel.content_rename), so a whole build is named deterministically: cells
+    gdsfactory shares between builds (bends, straights...) get the same name whichever build made them first.'''
+    import cmr_parallel
+    component, cell = cell, getattr(cell, "_cell", cell)
+    cell.name = name
+    for ref in cell.references:
+        if not isinstance(ref.cell, str):
+            cmr_parallel.content_rename(ref.cell)
+    if component is not cell:
+        _components.setdefault(name, component)
+        _share_cells(component)
+    return cell
+
+#####################################################
+#                   LRU cell cache                  #
+#####################################################
+
+class CellCache:
+
+    def __init__(self, limit=256):
+        self.limit = limit  #maximum number of cells held, None for unbounded
+        self._cells = OrderedDict()
+        self._named = weakref.WeakValueDictionary() #name -> cell, evicted cells included while something holds them
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._cells)
+
+    def __contains__(self, key):
+        return key in self._cells
+
+    def get(self, key, build):
+        '''Return the cell stored under `key`, calling `build()` to create it on a miss.'''
+        try:
+            cell = self._cells[key]
+        except KeyError:
+            self.misses += 1
+            cell = build()
+            self._cells[key] = cell
+            self._evict()
+            return cell
+        self.hits += 1
+        self._cells.move_to_end(key)
+        return cell
+
+    def _evict(self):
+        if self.limit is None:
+            return
+        while len(self._cells) > max(self.limit, 0):
+            self._cells.popitem(last=False)
+
+    def resize(self, limit):
+        self.limit = limit
+        self._evict()
+
+    def clear(self):
+        self._cells.clear()
+        self._named.clear()
+        _components.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {"cells": len(self._cells), "limit": self.limit, "hits": self.hits, "misses": self.misses}
+
+    def cached(self, constants=tuple):
+        '''Decorator: memoize a cell builder on its arguments plus the tuple returned by `constants()`.
+
+        The cell is named after its key: bus_cell(...) builds "bus_<digest>".'''
+        def decorator(builder):
+            kind = builder.__name__[:-len("_cell")] if builder.__name__.endswith("_cell") else builder.__name__
+            def build(key, args):
+                name = cell_name(key, kind)
+                cell = self._named.get(name) #evicted, but still referenced: rebuilding it would give two cells one name
+                if cell is None:
+                    cell = builder(*args)
+                    name_cells(cell, name)
+                    self._named[name] = cell
+                return cell
+            @functools.wraps(builder)
+            def wrapper(*args):
+                key = cell_key(builder.__name__, args, constants())
+                return self.get(key, lambda: build(key, args))
+            wrapper.uncached = builder
+            return wrapper
+        return decorator
@@ -0,0 +1,155 @@
+'''Command line entry point: build a sweep, write the mask GDS and optionally open it in KLayout.
+
+    python cmr_cli.py --spec default_sweep.json --out all_components.gds --workers 8 --cache-dir .cmr_cache --no-show
+
+gdsfactory is only imported once a build starts, so --help and argument errors return immediately.'''
+
+import argparse
+import os
+import sys
+
+import All_components_CMR as cmr
+import cmr_profile
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build the CMR EBL mask from a sweep spec.")
+    parser.add_argument("--spec", default=cmr.sweep_spec, help="sweep spec file (.json, .toml or .yaml)")
+    parser.add_argument("--out", default="all_components.gds", help="output GDS path")
+    parser.add_argument("--workers", type=int, default=cmr.sweep_workers, help="worker processes, 0 for one per core")
+    parser.add_argument("--cache-dir", default=cmr.sweep_cache_dir, help="reuse per-device GDS fragments from this directory")
+    parser.add_argument("--idt-mode", choices=("union", "aref"), default=cmr.default_idt_mode)
+    parser.add_argument("--outline-engine", choices=("analytic", "boolean"), default=cmr.outline_engine)
+    parser.add_argument("--curve-tolerance", type=float, default=cmr.curve_tolerance,
+                        help="largest chord error of the biconvex etch window curve in um, 0 to sample it like gf.components.ellipse")
+    parser.add_argument("--labels", choices=("text", "id"), default=cmr.label_style,
+                        help="device labels: the parameters spelled out, or a compact one-line ID")
+    parser.add_argument("--label-engine", choices=("glyphs", "polygons"), default=cmr.label_engine,
+                        help="glyphs: one cell per character placed by reference; polygons: every label drawn in full")
+    parser.add_argument("--placement", choices=("grid", "fields"), default=cmr.mask_placement,
+                        help="gf.grid in a fixed shape, or packed so every device sits inside one write field")
+    parser.add_argument("--grid-shape", type=int, nargs=2, metavar=("ROWS", "COLUMNS"),
+                        help="rows and columns of --placement grid, one of them -1 for as many as the sweep needs")
+    parser.add_argument("--write-field", type=float, nargs="+", metavar="UM",
+                        help="write field width [height] in um, adds local marks at the field corners")
+    parser.add_argument("--stream", action="store_true",
+                        help="write each device to the GDS as soon as it is built (bounded memory, implies --no-show)")
+    parser.add_argument("--backend", choices=("gf", "direct"), default=cmr.device_backend,
+                        help="direct: write the devices as flat cells from NumPy arrays, gdsfactory only where needed (implies --stream)")
+    parser.add_argument("--patch", action="store_true",
+                        help="rewrite an existing --out mask, building only the devices whose parameters changed (implies --stream)")
+    parser.add_argument("--wafer", metavar="WAFER.json",
+                        help="step the die across a wafer as laid out in this wafer spec (cmr_wafer.py) and write the wafer to --out")
+    parser.add_argument("--exposure", metavar="REPORT.json",
+                        help="write exposure area, shot count and write time estimates per device and write field")
+    parser.add_argument("--drc", metavar="REPORT.json",
+                        help="check the design rules (cmr_drc.py) on the written mask and write the violations to this file")
+    parser.add_argument("--pec", metavar="OUT.gds",
+                        help="also write a proximity-corrected copy of the mask (cmr_pec.py), dose classes as datatypes")
+    parser.add_argument("--preview", metavar="DIR",
+                        help="render an overview PNG, device thumbnails and a zoomable tile pyramid (cmr_preview.py) instead of needing KLayout")
+    parser.add_argument("--preview-levels", type=int, metavar="N",
+                        help="only write the N coarsest levels of the preview pyramid (all by default)")
+    parser.add_argument("--preview-pixel", type=float, metavar="UM",
+                        help="pixel size of the finest preview pyramid level in um (cmr_preview.finest_pixel by default)")
+    parser.add_argument("--golden", metavar="GOLDEN.gds",
+                        help="XOR the written mask against this known-good GDS (cmr_diff.py) and exit with status 1 if they differ")
+    parser.add_argument("--no-show", action="store_true", help="do not send the layout to KLayout")
+    parser.add_argument("--profile", metavar="REPORT.json",
+                        help="write per-stage timings to this JSON file and collapsed stacks (flamegraph input) next to it as .folded")
+    parser.add_argument("--profile-memory", action="store_true", help="also record allocation deltas per stage (tracemalloc, slow)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    cmr.default_idt_mode = args.idt_mode
+    cmr.outline_engine = args.outline_engine
+    cmr.curve_tolerance = args.curve_tolerance or None
+    cmr.label_style = args.labels
+    cmr.label_engine = args.label_engine
+    cmr.sweep_spec = args.spec
+    cmr.mask_placement = args.placement
+    cmr.device_backend = args.backend
+    if args.grid_shape:
+        cmr.mask_grid_shape = tuple(args.grid_shape)
+    if args.write_field:
+        if len(args.write_field) > 2:
+            raise SystemExit("--write-field takes a width and an optional height")
+        cmr.write_field = (args.write_field[0], args.write_field[-1])
+
+    if args.profile:
+        cmr_profile.enable(memory=args.profile_memory)
+
+    import cmr_parallel
+    cmr_parallel.clear_gf_cache(cmr.gf)
+    if cmr.mask_placement == "fields" and not args.wafer:
+        cmr.check_field_fit(cmr.default_sweep()) #fail before building, not once every device is out
+    if args.wafer:
+        import cmr_wafer
+        all_components = None
+        summary = cmr_wafer.write_wafer(args.wafer, args.out, args.workers or None, args.cache_dir)
+        print(f"wafer {args.out}: " + ", ".join(f"{count} {die} dies" for die, count in summary["dies"].items()))
+    elif args.patch and os.path.exists(args.out):
+        import cmr_patch
+        all_components = None
+        counts = cmr_patch.patch_mask(cmr.default_sweep(), args.out, cmr=cmr)
+        print(f"patched {args.out}: {counts['reused']} devices reused, {counts['built']} built")
+    elif args.stream or args.patch or args.backend == "direct":
+        import cmr_stream
+        all_components = None
+        cmr_stream.write_mask_streaming(cmr.default_sweep(), args.out, args.workers or None, args.cache_dir)
+    else:
+        jobs = cmr.default_sweep()
+        if cmr.mask_placement == "grid":
+            import cmr_stream
+            cmr_stream.grid_shape(len(jobs), cmr.mask_grid_shape) #fail before building, not in gf.grid
+        components_list = cmr.build_sweep(jobs, args.workers or None, args.cache_dir)
+        all_components = cmr.assemble_mask(components_list, jobs)
+        with cmr_profile.stage("write_gds"):
+            all_components.write_gds(args.out)
+
+    if args.exposure:
+        import json
+        import cmr_exposure
+        with open(args.exposure, "w") as f:
+            json.dump(cmr_exposure.exposure_report(args.out, cmr.write_field, (cmr.metal_layer, cmr.resist_layer), (cmr.originx, cmr.originy)), f, indent=2)
+    if args.drc:
+        import json
+        import cmr_drc
+        violations = cmr_drc.check_mask(args.out, dict(cmr_drc.rules, metal_resist_clearance=cmr.etch_buffer), args.workers or None)
+        with open(args.drc, "w") as f:
+            json.dump(violations, f, indent=2)
+        for rule, entry in cmr_drc.summary(violations).items():
+            print(f"DRC {rule}: {entry['count']} violations, closest {entry['min_distance']:.4f} um (limit {entry['limit']} um)")
+    if args.pec:
+        import cmr_pec
+        for datatype, level in cmr_pec.correct_mask(args.out, args.pec, args.workers or None)["doses"].items():
+            print(f"PEC datatype {datatype}: dose x{level:.3f}")
+    if args.preview:
+        import cmr_preview
+        layout = cmr_preview.load_layout(args.out)
+        os.makedirs(args.preview, exist_ok=True)
+        cmr_preview.write_overview(layout, os.path.join(args.preview, "overview.png"))
+        cmr_preview.write_thumbnails(layout, os.path.join(args.preview, "thumbnails"))
+        cmr_preview.write_pyramid(layout, args.preview, pixel=args.preview_pixel, workers=args.workers or None, levels=args.preview_levels)
+    differs = False
+    if args.golden:
+        import cmr_diff
+        report = cmr_diff.diff_masks(args.golden, args.out, args.workers or None)
+        for layer, entry in report["layers"].items():
+            print(f"diff {layer}: {entry['regions']} regions, {entry['missing_um2']:.4f} um^2 missing, {entry['extra_um2']:.4f} um^2 extra")
+        for cell, entry in sorted(report["devices"].items(), key=lambda item: -item[1]["area_um2"])[:10]:
+            print(f"diff device {entry['device']} {cell}: {entry['area_um2']:.4f} um^2")
+        differs = bool(report["regions"])
+        print(f"{args.out} {'differs from' if differs else 'matches'} {args.golden}")
+    if args.profile:
+        cmr_profile.write_json(args.profile)
+        cmr_profile.write_collapsed(os.path.splitext(args.profile)[0] + ".folded")
+        cmr_profile.disable()
+    if all_components is not None and not args.no_show:
+        all_components.show()
+    if differs:
+        raise SystemExit(1)
+    return all_components
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,173 @@
+'''Geometric diff of a mask against a golden GDS, tile by tile across a process pool.
+
+Both layouts are flattened once (gdstk) and cut into tiles as in cmr_drc. Every tile gets the polygons of
+both layouts that reach into it; where the two are vertex for vertex the same the tile is done, otherwise
+a worker computes per layer what the golden layout has and the mask lacks ("missing") and the reverse
+("extra"), clipped to the tile so every region is reported by one tile only. Regions thinner than
+tolerance on average (2*area/perimeter, i.e. rounding on the 1 nm grid) or smaller than min_area are
+dropped; the others are attributed to the device of the mask (or, failing that, of the golden layout) they
+lie in, see cmr_exposure.device_references.
+
+    python cmr_diff.py golden.gds all_components.gds --workers 4 --json diff.json
+
+exits with status 1 if anything differs, so it can gate a regeneration (cmr_cli.py --golden golden.gds).'''
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import sys
+
+import numpy as np
+import gdstk
+
+from cmr_drc import _pack, _take, _tile_members, tiles
+from cmr_exposure import device_references, _top_cell
+from cmr_profile import stage
+
+tile_size = 500.0 #um
+tolerance = 1e-3 #um, mean width of a difference below which it is rounding
+min_area = 1e-4 #um^2
+precision = 1e-4 #um, of the gdstk booleans
+
+#####################################################
+#                  Tile diffs                       #
+#####################################################
+
+def _polygons(points, counts):
+    if len(counts) == 0:
+        return []
+    return [gdstk.Polygon(p) for p in np.split(points, np.cumsum(counts)[:-1])]
+
+def _diff_tile(job):
+    '''Whether the polygons of the tile ((x0, y0), (x1, y1)) differ at all, and the difference regions in it,
+    each {"layer", "kind", "area", "width", "bbox", "centroid"}.'''
+    tile, layers, tile_tolerance, tile_min_area = job
+    clip = gdstk.rectangle(*tile)
+    differs, found = False, []
+    for layer, golden, layout in layers:
+        if len(golden[1]) == len(layout[1]) and np.array_equal(golden[1], layout[1]) and np.array_equal(golden[0], layout[0]):
+            continue
+        differs = True
+        golden, layout = _polygons(*golden), _polygons(*layout)
+        for kind, first, second in (("missing", golden, layout), ("extra", layout, golden)):
+            regions = gdstk.boolean(gdstk.boolean(first, second, "not", precision=precision), clip, "and", precision=precision)
+            for region in regions:
+                area = region.area()
+                width = 2*area/region.perimeter()
+                if area < tile_min_area or width < tile_tolerance:
+                    continue
+                found.append({"layer": list(layer), "kind": kind, "area": area, "width": width,
+                              "bbox": np.asarray(region.bounding_box()).tolist(), "centroid": region.points.mean(axis=0).tolist()})
+    return differs, found
+
+#####################################################
+#                   Mask diff                       #
+#####################################################
+
+def _layers(top):
+    #{(layer, datatype): packed polygons} of a flattened cell
+    grouped = {}
+    for polygon in top.get_polygons():
+        grouped.setdefault((polygon.layer, polygon.datatype), []).append(polygon.points)
+    return {layer: _pack(polygons) for layer, polygons in grouped.items()}
+
+def _tile_jobs(golden, layout, tile_boxes, halos, job_tolerance, job_min_area):
+    empty = _pack([])
+    layers = sorted(set(golden) | set(layout))
+    members = {layer: (_tile_members(golden.get(layer, empty), halos), _tile_members(layout.get(layer, empty), halos)) for layer in layers}
+    for i, tile in enumerate(tile_boxes):
+        tile_layers = []
+        for layer in layers:
+            golden_index, layout_index = members[layer][0][i], members[layer][1][i]
+            if len(golden_index) or len(layout_index):
+                tile_layers.append((layer, _take(golden.get(layer, empty), golden_index), _take(layout.get(layer, empty), layout_index)))
+        if tile_layers:
+            yield tile.tolist(), tile_layers, job_tolerance, job_min_area
+
+def _attribute(regions, top):
+    #index and cell name of the device of top holding each region's centroid, -1 outside every device
+    import shapely
+    devices = device_references(top)
+    owner = np.full(len(regions), -1)
+    if regions and devices:
+        boxes = np.array([np.array(ref.bounding_box()) + offset for ref, offset in devices]).reshape(-1, 2, 2)
+        tree = shapely.STRtree(shapely.box(boxes[:, 0, 0], boxes[:, 0, 1], boxes[:, 1, 0], boxes[:, 1, 1]))
+        point, box = tree.query(shapely.points(np.array([region["centroid"] for region in regions])), predicate="intersects")
+        owner[point[::-1]] = box[::-1] #first box wins where boxes touch
+    return [(int(i), devices[i][0].cell.name if i >= 0 else None) for i in owner.tolist()]
+
+def diff_masks(golden, layout, workers=1, size=None, diff_tolerance=None, diff_min_area=None):
+    '''Geometric differences of layout against golden (GDS paths, gdstk.Cells or gf Components).
+
+    Returns {"regions": [...], "layers": {"l/d": {"missing_um2", "extra_um2", "regions"}}, "devices": {cell:
+    {"device", "area_um2", "regions"}}, "tiles", "differing_tiles"}; regions are sorted by area, largest first, and
+    carry the device index and cell in the layout ("device" -1 and "golden_device" set when only the golden layout
+    has a device there). Tiles are diffed in `workers` processes (None for one per core).'''
+    size = tile_size if size is None else size
+    diff_tolerance = tolerance if diff_tolerance is None else diff_tolerance
+    diff_min_area = min_area if diff_min_area is None else diff_min_area
+
+    with stage("diff_flatten"):
+        golden_top, layout_top = _top_cell(golden), _top_cell(layout)
+        golden_layers, layout_layers = _layers(golden_top), _layers(layout_top)
+    boxes = [np.array(top.bounding_box()) for top in (golden_top, layout_top) if top.bounding_box() is not None]
+    if not boxes:
+        return {"regions": [], "layers": {}, "devices": {}, "tiles": 0, "differing_tiles": 0}
+    bbox = (np.min([box[0] for box in boxes], axis=0), np.max([box[1] for box in boxes], axis=0))
+    tile_boxes, halos = tiles(bbox, size, 0.0)
+
+    with stage("diff_tiles"):
+        jobs = list(_tile_jobs(golden_layers, layout_layers, tile_boxes, halos, diff_tolerance, diff_min_area))
+        if workers == 1:
+            results = [_diff_tile(job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_diff_tile, jobs, chunksize=max(1, len(jobs)//(4*(workers or 8)))))
+    regions = sorted((region for _, found in results for region in found), key=lambda region: -region["area"])
+
+    with stage("diff_attribute"):
+        layers, devices = {}, {}
+        for region, (index, cell), (golden_index, golden_cell) in zip(regions, _attribute(regions, layout_top), _attribute(regions, golden_top)):
+            region["device"], region["cell"] = index, cell
+            if index < 0 and golden_index >= 0:
+                region["golden_device"], region["cell"] = golden_index, golden_cell
+            layer = layers.setdefault("{}/{}".format(*region["layer"]), {"missing_um2": 0.0, "extra_um2": 0.0, "regions": 0})
+            layer[region["kind"] + "_um2"] += region["area"]
+            layer["regions"] += 1
+            if region["cell"] is not None:
+                device = devices.setdefault(region["cell"], {"device": index, "area_um2": 0.0, "regions": 0})
+                device["area_um2"] += region["area"]
+                device["regions"] += 1
+    return {"regions": regions, "layers": layers, "devices": devices, "tiles": len(tile_boxes),
+            "differing_tiles": sum(differs for differs, _ in results)}
+
+#####################################################
+#                     Main                          #
+#####################################################
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="XOR a mask GDS against a golden copy, tile by tile.")
+    parser.add_argument("golden", help="known-good GDS")
+    parser.add_argument("gds", help="GDS to check")
+    parser.add_argument("--workers", type=int, default=1, help="processes diffing tiles, 0 for one per core")
+    parser.add_argument("--tile", type=float, default=tile_size, help="tile size in um")
+    parser.add_argument("--tolerance", type=float, default=tolerance, help="mean width (um) below which a difference is rounding")
+    parser.add_argument("--min-area", type=float, default=min_area, help="smallest difference reported, um^2")
+    parser.add_argument("--json", help="write the full report to this file")
+    args = parser.parse_args(argv)
+
+    report = diff_masks(args.golden, args.gds, args.workers or None, args.tile, args.tolerance, args.min_area)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    print(f"{report['differing_tiles']} of {report['tiles']} tiles differ in their polygons")
+    for layer, entry in report["layers"].items():
+        print(f"{layer:>5} {entry['regions']:8} regions, {entry['missing_um2']:12.4f} um^2 missing, {entry['extra_um2']:12.4f} um^2 extra")
+    for cell, entry in sorted(report["devices"].items(), key=lambda item: -item[1]["area_um2"])[:20]:
+        print(f"  device {entry['device']:6} {cell}: {entry['area_um2']:.4f} um^2 in {entry['regions']} regions")
+    if not report["regions"]:
+        print(f"{args.gds} matches {args.golden}")
+    return 1 if report["regions"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
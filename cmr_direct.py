@@ -0,0 +1,331 @@
+'''Direct device backend: CMR polygons as NumPy arrays, written as flat gdstk cells without gdsfactory.
+
+The gdsfactory builders make a tree of Components per device (bus, tether, connect_parts, pad_and_bus,
+pad_and_bus_mirrored, CMR_component, CMR_and_label, final_component) with their ports, only for the mask to
+be flattened later. Here a device is a DeviceRecord (builder, arguments and cell name in __slots__) and its
+geometry a DevicePolygons: every vertex of the device in one contiguous (n, 2) array with the polygon
+offsets and layers beside it, so placing, rotating and moving a device are single array operations and a
+device costs a handful of objects however many polygons it has. Each device becomes one gdstk cell named
+like the gdsfactory device (All_components_CMR.device_name), referencing the cells devices share (its IDT
+combs, the route bend, the label glyphs), and is dropped once written.
+
+Every outline comes from the same closed-form functions the analytic builders use (cmr_geometry and the
+*_outlines functions of All_components_CMR); the pad route is the one gf.routing.get_route lays out, taken
+once per tether width from a reference build. The gdsfactory path stays the reference: devices this backend
+cannot write (idt_mode = "aref", outline_engine = "boolean", routes that are not a single bend, other
+builders) are built by it, and check_direct() compares the two.
+
+    python cmr_direct.py all_components.gds --spec my_sweep.json'''
+
+import argparse
+import functools
+import inspect
+import math
+import sys
+
+import numpy as np
+import gdstk
+
+import cmr_parallel
+from cmr_profile import stage
+
+#####################################################
+#                    Records                        #
+#####################################################
+
+class DeviceRecord:
+    '''One device of a sweep: builder name, arguments bound to the builder's parameters, and its cell name.'''
+    __slots__ = ("builder", "args", "name")
+
+    def __init__(self, builder, args, cmr):
+        self.builder = builder
+        bound = inspect.signature(cmr.builders[builder]).bind(*args)
+        bound.apply_defaults()
+        self.args = dict(bound.arguments)
+        self.name = cmr.device_name(builder, args)
+
+class DevicePolygons:
+    '''The polygons of a device, vertices of polygon i being points[offsets[i]:offsets[i + 1]] on layers[i], and its
+    references to shared cells: cells[j] at ref_origins[j], rotated by ref_rotations[j] (radians), mirrored about
+    the y axis first where ref_mirrors[j].'''
+    __slots__ = ("points", "offsets", "layers", "cells", "ref_origins", "ref_rotations", "ref_mirrors")
+
+    def __init__(self, outlines, layers):
+        self.points = np.concatenate(outlines) if outlines else np.zeros((0, 2))
+        self.offsets = np.concatenate(([0], np.cumsum([len(outline) for outline in outlines], dtype=np.int64)))
+        self.layers = np.asarray(layers, dtype=np.int16).reshape(-1, 2)
+        self.cells = []
+        self.ref_origins = np.zeros((0, 2))
+        self.ref_rotations = np.zeros(0)
+        self.ref_mirrors = np.zeros(0, dtype=bool)
+
+    def extend(self, outlines, layers):
+        #append polygons
+        if outlines:
+            self.offsets = np.concatenate((self.offsets, self.offsets[-1] + np.cumsum([len(outline) for outline in outlines])))
+            self.points = np.concatenate([self.points] + list(outlines))
+            self.layers = np.concatenate((self.layers, np.asarray(layers, dtype=np.int16).reshape(-1, 2)))
+
+    def reference(self, cells, origins, mirror=False):
+        #append references to shared cells
+        self.cells += cells
+        self.ref_origins = np.concatenate((self.ref_origins, np.asarray(origins, dtype=float).reshape(-1, 2)))
+        self.ref_rotations = np.concatenate((self.ref_rotations, np.full(len(cells), math.pi if mirror else 0.0)))
+        self.ref_mirrors = np.concatenate((self.ref_mirrors, np.full(len(cells), mirror)))
+
+    def bbox(self):
+        #of the polygons and the referenced cells, as placed
+        points = [self.points]
+        for cell, origin, rotation, mirror in zip(self.cells, self.ref_origins, self.ref_rotations, self.ref_mirrors):
+            c, s = math.cos(rotation), math.sin(rotation)
+            for polygon in cell.polygons:
+                local = polygon.points*((1, -1) if mirror else (1, 1)) #x_reflection, then rotation
+                points.append(local @ np.array([[c, s], [-s, c]]) + origin)
+        points = np.concatenate(points)
+        return np.array([points.min(axis=0), points.max(axis=0)])
+
+    def transform(self, rotation=0.0, translation=(0.0, 0.0)):
+        #rotate polygons and references (radians, about the origin), then move them
+        if rotation:
+            c, s = math.cos(rotation), math.sin(rotation)
+            self.points = self.points @ np.array([[c, s], [-s, c]])
+            self.ref_origins = self.ref_origins @ np.array([[c, s], [-s, c]])
+            self.ref_rotations = self.ref_rotations + rotation
+        self.points += translation
+        self.ref_origins += translation
+
+#####################################################
+#                 Device outlines                   #
+#####################################################
+
+_routes = {} #(tether width, geometry constants) -> (polygon arrays, bend cell, taper port y, pad port y, bend height)
+
+def _route_template(tether_width, cmr):
+    #tether, taper, pad and route of a reference pad_and_bus cell; routes for other bus lengths only move the parts below the pad
+    key = (tether_width, cmr.geometry_constants())
+    if key not in _routes:
+        bus_length = 2*tether_width
+        cell = cmr.pad_and_bus_cell(bus_length, tether_width, False)._cell
+        polygons = [polygon.points for polygon in cell.get_polygons()]
+        bend = polygons.pop(max(range(len(polygons)), key=lambda i: len(polygons[i])))
+        pad_y = cmr.originy + cmr.pad_route_height #pad_cell's pad_originy, where the route meets the pad
+        _routes[key] = (polygons, bend_cell(bend - (0, bus_length/2), cmr), bus_length/2, pad_y, bend[:, 1].max() - bus_length/2)
+    return _routes[key]
+
+def pad_outlines(device, bus_length, tether_width, cmr):
+    '''Add the tether, taper, pad and route on both sides of the IDT (pad_and_bus_mirrored_cell without the bus) to
+    device, the bends as references. False where gf.routing.get_route would not route with a single bend.'''
+    polygons, bend, template_y, pad_y, bend_height = _route_template(tether_width, cmr)
+    port_y = float(np.round(bus_length/2, 3)) #gdsfactory snaps the bus port to the 1 nm grid before routing
+    if port_y + bend_height >= pad_y - 1e-6 or template_y + bend_height >= pad_y - 1e-6:
+        return False
+    shift = port_y - template_y
+    #the pad stays, every vertex below it follows the taper, so the vertical leg of the route stretches
+    side = [np.column_stack((p[:, 0], np.where(p[:, 1] < pad_y - 1e-9, p[:, 1] + shift, p[:, 1]))) for p in polygons]
+    mirror_x = cmr.originx + cmr.bus_width + (cmr.electrode_length + cmr.electrode_end_margin)/2
+    outlines = side + [cmr.cmr_geometry.mirror_x(p, mirror_x) for p in side]
+    device.extend(outlines, [cmr.metal_layer]*len(outlines))
+    device.reference([bend], [(0, port_y)])
+    device.reference([bend], [(2*mirror_x, port_y)], mirror=True)
+    return True
+
+def _label(record, kind, cmr, shift):
+    #glyphs and their origins, or the glyph polygons themselves with label_engine = "polygons"
+    a = record.args
+    values = dict(pairs=a["electrode_number"]/2, period=2*(a["electrode_width"] + a["electrode_separation"]),
+                  tether=a["tether_width"] + 2*cmr.etch_buffer)
+    if kind == "biconvex_cmr":
+        values["k"] = a["k"]
+    placed = [(character, x + shift[0], y + shift[1]) for character, x, y in cmr.label_glyphs(cmr.label_text(kind, **values))]
+    if cmr.label_engine == "glyphs":
+        return [], [glyph_cell(character, cmr) for character, _, _ in placed], [(x, y) for _, x, y in placed]
+    outlines = [glyph + (x, y) for character, x, y in placed for glyph in _glyph_outlines(character, cmr.label_size)]
+    return outlines, [], []
+
+def _cmr_polygons(record, cmr):
+    a = record.args
+    if (a["idt_mode"] or cmr.default_idt_mode) != "union" or cmr.outline_engine != "analytic":
+        return None
+    number, separation, width, tether = a["electrode_number"], a["electrode_separation"], a["electrode_width"], a["tether_width"]
+    bus_length = number*(width + separation) - separation
+    if record.builder == "biconvex_cmr":
+        windows = cmr.biconvex_window_outlines(bus_length, tether, a["k"])
+    else:
+        windows = cmr.flat_window_outlines(bus_length, tether) if a["undercut"] else []
+    if windows is None:
+        return None
+    device = DevicePolygons(windows, [cmr.resist_layer]*len(windows))
+    device.reference([comb_cell(number, separation, width, cmr.geometry_constants(), cmr)], [(0, 0)])
+    if not pad_outlines(device, bus_length, tether, cmr):
+        return None
+    (x0, y0), (x1, y1) = np.round(device.bbox(), 3) #gdsfactory's bbox, on the 1 nm grid (the bends lie inside it)
+
+    shift = (0.0, 0.0)
+    if a["angle"] % 360: #as place_with_label: the CMR about its centre, origin on the grid, the label below its bounding box
+        rotation = math.radians(a["angle"])
+        centre = np.array([(x0 + x1)/2, (y0 + y1)/2])
+        c, s = math.cos(rotation), math.sin(rotation)
+        origin = centre - np.array([c*centre[0] - s*centre[1], s*centre[0] + c*centre[1]])
+        device.transform(rotation, np.round(origin, 3))
+        xmin, ymin = device.bbox()[0]
+        shift = tuple(np.round((xmin - x0, ymin - y0), 3))
+    outlines, glyphs, origins = _label(record, record.builder, cmr, shift)
+    device.extend(outlines, [cmr.metal_layer]*len(outlines))
+    device.reference(glyphs, origins)
+    return device
+
+def _ring_polygons(record, cmr):
+    a = record.args
+    frame = cmr.ring_frame_outlines(a["radius"], a["width"], a["tether_width"], a["angle_resolution"])
+    if frame is None:
+        return None
+    return DevicePolygons(frame, [cmr.resist_layer]*len(frame))
+
+def device_polygons(record, cmr):
+    '''The DevicePolygons of a device at its destination, None if only the gdsfactory builder can make it.'''
+    if record.builder in ("flat_cmr", "biconvex_cmr"):
+        device = _cmr_polygons(record, cmr)
+    elif record.builder == "undercut_ring":
+        device = _ring_polygons(record, cmr)
+    else:
+        return None
+    if device is not None:
+        device.transform(translation=(record.args["destinationx"] - cmr.originx, record.args["destinationy"] - cmr.originy))
+    return device
+
+#####################################################
+#                  gdstk cells                      #
+#####################################################
+
+_glyph_cells = {} #(character, size, layer, geometry constants) -> gdstk.Cell
+
+@functools.lru_cache(maxsize=64)
+def comb_cell(electrode_number, electrode_separation, electrode_width, constants, cmr):
+    '''The two IDT combs (bus and fingers) of a CMR, referenced by every device with the same IDT. Only the most
+    recent ones are kept: the mask writer writes a cell name once, so a rebuilt comb is simply not written again.'''
+    params = (electrode_number, electrode_separation, electrode_width)
+    cell = gdstk.Cell(cmr.cell_name(cmr.cell_key("idt_comb_cell", params, constants), "idt_comb"))
+    cell.add(*(gdstk.Polygon(outline, *cmr.metal_layer) for outline in
+               cmr.cmr_geometry.idt_outlines(cmr.originx, cmr.originy, cmr.bus_width, cmr.electrode_length, cmr.electrode_end_margin,
+                                             electrode_width, electrode_separation, electrode_number)))
+    return cell
+
+_bend_cells = {} #geometry constants -> gdstk.Cell
+
+def bend_cell(points, cmr):
+    '''The bend of the pad routes, starting at the taper side on the x axis, shared by every device.'''
+    constants = cmr.geometry_constants()
+    if constants not in _bend_cells:
+        cell = gdstk.Cell(cmr.cell_name(cmr.cell_key("route_bend_cell", (), constants), "route_bend"))
+        cell.add(gdstk.Polygon(points, *cmr.metal_layer))
+        _bend_cells[constants] = cell
+    return _bend_cells[constants]
+
+def _glyph_outlines(character, size):
+    from gdsfactory.components.text import _glyph
+    scaling = size/1000 #as glyph_cell
+    return [np.array(points, dtype=float)*scaling for points in _glyph[ord(character)]]
+
+def glyph_cell(character, cmr):
+    '''gdstk twin of All_components_CMR.glyph_cell, with the same name and polygons.'''
+    constants = cmr.geometry_constants()
+    key = (character, cmr.label_size, cmr.metal_layer, constants)
+    if key not in _glyph_cells:
+        name = cmr.cell_name(cmr.cell_key("glyph_cell", (character, cmr.label_size, cmr.metal_layer), constants), "glyph")
+        cell = gdstk.Cell(name)
+        layer, datatype = cmr.metal_layer
+        cell.add(*(gdstk.Polygon(points, layer, datatype) for points in _glyph_outlines(character, cmr.label_size)))
+        _glyph_cells[key] = cell
+    return _glyph_cells[key]
+
+def device_cell(record, polygons, cmr):
+    '''(top cell, cells) of a device for cmr_stream.stream_devices: one flat cell and the shared cells it references.'''
+    cell = gdstk.Cell(record.name)
+    points, offsets = polygons.points, polygons.offsets
+    cell.add(*(gdstk.Polygon(points[start:end], int(layer), int(datatype))
+               for start, end, (layer, datatype) in zip(offsets[:-1], offsets[1:], polygons.layers.tolist())))
+    cell.add(*(gdstk.Reference(shared, origin=origin, rotation=rotation, x_reflection=bool(mirror))
+               for shared, origin, rotation, mirror in zip(polygons.cells, polygons.ref_origins.tolist(),
+                                                          polygons.ref_rotations.tolist(), polygons.ref_mirrors.tolist())))
+    return cell, list({shared.name: shared for shared in polygons.cells}.values()) + [cell]
+
+#####################################################
+#                 Device sources                    #
+#####################################################
+
+def direct_devices(jobs, cmr, counts=None):
+    '''(top cell, cells) of every (builder name, args) job for cmr_stream.stream_devices, written directly
+    where possible and by the gdsfactory builder otherwise. counts, if given, receives {"direct", "gf"}.'''
+    import cmr_stream
+    counts = {"direct": 0, "gf": 0} if counts is None else counts
+    counts.update(direct=0, gf=0)
+    for builder, args in jobs:
+        record = DeviceRecord(builder, args, cmr)
+        with stage("direct_device"):
+            polygons = device_polygons(record, cmr)
+        if polygons is not None:
+            counts["direct"] += 1
+            yield device_cell(record, polygons, cmr)
+            continue
+        if counts["gf"] and counts["gf"] % cmr_stream.clear_cache_every == 0:
+            cmr_parallel.clear_gf_cache(cmr.gf)
+        counts["gf"] += 1
+        device = cmr.builders[builder](*args)
+        cells = cmr_parallel.content_rename(device._cell)
+        yield cells[-1], cells
+        del device, cells
+
+def check_direct(jobs, cmr=None, tolerance=1e-3):
+    '''Build every job with both backends and return the XOR area per layer of each directly written device.
+
+    Raises ValueError if on any layer the XOR area divided by the outline perimeter exceeds tolerance (um).'''
+    import cmr_geometry
+    if cmr is None:
+        import All_components_CMR as cmr
+    areas = []
+    for builder, args in jobs:
+        record = DeviceRecord(builder, args, cmr)
+        polygons = device_polygons(record, cmr)
+        if polygons is None:
+            continue
+        direct, _ = device_cell(record, polygons, cmr)
+        reference = cmr.builders[builder](*args)._cell
+        layouts = [{}, {}]
+        for layout, cell in zip(layouts, (direct, reference)):
+            for polygon in cell.get_polygons():
+                layout.setdefault((polygon.layer, polygon.datatype), []).append(polygon.points)
+        area = cmr_geometry.xor_area(*layouts)
+        mismatched = {layer: value for layer, value in area.items()
+                      if value > tolerance*max(sum(cmr_geometry.perimeter(p) for p in layouts[1].get(layer, [])), 1.0)}
+        if mismatched:
+            raise ValueError(f"{record.name} differs from the gdsfactory build (XOR area per layer in um^2): {mismatched}")
+        areas.append(area)
+    return areas
+
+#####################################################
+#                     Main                          #
+#####################################################
+
+def main(argv=None):
+    import All_components_CMR as cmr
+    import cmr_stream
+    import cmr_sweep
+
+    parser = argparse.ArgumentParser(description="Stream a sweep mask with the direct array backend.")
+    parser.add_argument("out", nargs="?", default="all_components.gds", help="output GDS path")
+    parser.add_argument("--spec", default=cmr.sweep_spec, help="sweep spec file (.json, .toml or .yaml)")
+    parser.add_argument("--check", action="store_true", help="compare every direct device with its gdsfactory build instead")
+    args = parser.parse_args(argv)
+
+    jobs = cmr_sweep.load_sweep(args.spec, cmr)
+    if args.check:
+        areas = check_direct(jobs, cmr)
+        print(f"{len(areas)} devices checked, largest XOR area {max((max(a.values(), default=0) for a in areas), default=0):.3g} um^2")
+        return areas
+    counts = {}
+    cmr_stream.stream_devices(direct_devices(jobs, cmr, counts), args.out, **cmr_stream.mask_layout(cmr, jobs))
+    print(f"{counts['direct']} devices written directly, {counts['gf']} built by gdsfactory -> {args.out}")
+    return counts
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,243 @@
+'''Spatially indexed design-rule checks for an assembled CMR mask.
+
+The mask is flattened once (gdstk) and cut into tiles; every tile takes the polygons within the largest rule
+distance of it (the halo) and checks them in a worker process. Inside a tile the polygons go into an STRtree
+and each rule is one bulk query of the bounding boxes grown by the rule, so exact distances are only computed
+between near neighbours; a violation is kept by the tile holding the middle of its shortest line, which
+reports it exactly once.
+
+    metal_spacing           gap between metal shapes, i.e. the IDT finger gap (electrode_separation)
+    tether_width            gap between resist windows, i.e. the unetched tether (tether_width + 2*etch_buffer)
+    metal_resist_clearance  metal to resist window distance (etch_buffer); overlapping metal and resist is 0
+    pad_spacing             gap between pads, the parts of the metal at least pad_size wide
+
+Shapes that touch or overlap on the same layer count as one shape, so the spacing rules only compare
+separate shapes, as a merged-layer DRC would.
+
+    python cmr_drc.py all_components.gds --workers 4 --json drc.json'''
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import math
+import sys
+
+import numpy as np
+
+from cmr_exposure import device_references, _top_cell
+from cmr_profile import stage
+
+metal_layer = (1, 0)
+resist_layer = (2, 0)
+
+rules = {
+    "metal_spacing": 0.125, #um, finest electrode_separation in the sweep
+    "tether_width": 2.0,
+    "metal_resist_clearance": 1.0, #etch_buffer
+    "pad_spacing": 20.0,
+}
+pad_size = 50.0 #narrowest pad side; metal that wide is a pad
+tile_size = 2000.0 #um
+tolerance = 1e-6 #um, distances this close to the rule pass
+
+#####################################################
+#                 Tile geometry                     #
+#####################################################
+
+def _pack(polygons):
+    #concatenated vertices, per-polygon counts and first vertex: cheap to slice and to pickle to the workers
+    if not polygons:
+        return np.zeros((0, 2)), np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    counts = np.fromiter((len(p) for p in polygons), dtype=int, count=len(polygons))
+    return np.concatenate(polygons), counts, np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+def _take(packed, index):
+    #vertices and counts of the packed polygons at index, without a Python loop over them
+    points, counts, starts = packed
+    counts = counts[index]
+    shift = np.repeat(starts[index] - np.concatenate(([0], np.cumsum(counts)[:-1])), counts)
+    return points[shift + np.arange(counts.sum())], counts
+
+def _geometries(points, counts):
+    import shapely
+    if len(counts) == 0:
+        return np.empty(0, dtype=object)
+    rings = shapely.linearrings(points, indices=np.repeat(np.arange(len(counts)), counts))
+    return shapely.polygons(rings)
+
+def _pads(metal):
+    #opening by pad_size/2 keeps only the parts of the metal at least pad_size wide
+    import shapely
+    bounds = shapely.bounds(metal)
+    candidates = metal[(bounds[:, 2] - bounds[:, 0] >= pad_size) & (bounds[:, 3] - bounds[:, 1] >= pad_size)]
+    r = 0.495*pad_size #just under half, an exact half would erode a pad_size-wide pad away
+    cores = shapely.buffer(candidates, -r, join_style="mitre")
+    cores = cores[~shapely.is_empty(cores)]
+    return shapely.get_parts(shapely.buffer(cores, r, join_style="mitre"))
+
+def _near_pairs(first, second, distance, same):
+    '''Pairs of first/second shapes closer than distance: their distance, shortest line and extent, the overlap
+    of their bounding boxes grown by distance/2, which holds every point where the two come too close.
+
+    same=True checks one set against itself: each pair once, and touching shapes (distance within tolerance) are the same shape.'''
+    import shapely
+    if len(first) == 0 or len(second) == 0:
+        return np.zeros(0), np.zeros((0, 2, 2)), np.zeros((0, 4))
+    #bounding boxes grown by the rule find the candidates (much cheaper than a "dwithin" query), exact distances only for those
+    first_bounds, second_bounds = shapely.bounds(first), shapely.bounds(second)
+    i, j = shapely.STRtree(second).query(shapely.box(*(first_bounds + (-distance, -distance, distance, distance)).T))
+    if same:
+        keep = i < j
+        i, j = i[keep], j[keep]
+    gaps = shapely.distance(first[i], second[j])
+    keep = gaps < distance - tolerance
+    if same:
+        keep &= gaps > tolerance #abutting shapes of rotated devices are ~1e-14 apart after rounding
+    i, j, gaps = i[keep], j[keep], gaps[keep]
+    if len(gaps) == 0:
+        return gaps, np.zeros((0, 2, 2)), np.zeros((0, 4))
+    lines = shapely.get_coordinates(shapely.shortest_line(first[i], second[j])).reshape(-1, 2, 2)
+    a, b = first_bounds[i], second_bounds[j]
+    reach = distance/2
+    extents = np.concatenate([np.maximum(a[:, :2], b[:, :2]) - reach, np.minimum(a[:, 2:], b[:, 2:]) + reach], axis=1)
+    return gaps, lines, extents
+
+def _check_tile(job):
+    '''Violations of every rule owned by the tile ((x0, y0), (x1, y1)).'''
+    tile, metal, resist, tile_rules = job
+    metal, resist = _geometries(*metal), _geometries(*resist)
+    checks = [("metal_spacing", metal, metal, True),
+              ("tether_width", resist, resist, True),
+              ("metal_resist_clearance", metal, resist, False)]
+    if "pad_spacing" in tile_rules:
+        pads = _pads(metal)
+        checks.append(("pad_spacing", pads, pads, True))
+
+    (x0, y0), (x1, y1) = tile
+    found = []
+    for rule, first, second, same in checks:
+        if rule not in tile_rules:
+            continue
+        gaps, lines, extents = _near_pairs(first, second, tile_rules[rule], same)
+        middle = lines.mean(axis=1)
+        owned = (middle[:, 0] >= x0) & (middle[:, 0] < x1) & (middle[:, 1] >= y0) & (middle[:, 1] < y1)
+        for gap, line, extent, location in zip(gaps[owned].tolist(), lines[owned].tolist(), extents[owned].tolist(), middle[owned].tolist()):
+            found.append({"rule": rule, "limit": tile_rules[rule], "distance": gap, "location": location,
+                          "line": line, "extent": [extent[:2], extent[2:]]})
+    return found
+
+#####################################################
+#                   Mask checks                     #
+#####################################################
+
+def tiles(bbox, size, halo):
+    '''Tiles of size covering bbox, with the bounds of the halo around each. Returns (tiles, halos), both (n, 2, 2).'''
+    (x0, y0), (x1, y1) = bbox
+    columns, rows = max(1, math.ceil((x1 - x0)/size)), max(1, math.ceil((y1 - y0)/size))
+    corners = np.stack(np.meshgrid(x0 + size*np.arange(columns), y0 + size*np.arange(rows)), axis=-1).reshape(-1, 2)
+    boxes = np.stack([corners, corners + size], axis=1)
+    boxes[:, 1] = np.minimum(boxes[:, 1], (x1 + tolerance, y1 + tolerance)) #last row and column close on the bbox
+    return boxes, boxes + np.array([[-halo, -halo], [halo, halo]])
+
+def _tile_members(packed, halos):
+    #indices of the polygons whose bounding box reaches into each tile's halo
+    import shapely
+    points, counts, starts = packed
+    if len(counts) == 0:
+        return [np.zeros(0, dtype=int)]*len(halos)
+    low, high = np.minimum.reduceat(points, starts), np.maximum.reduceat(points, starts)
+    tree = shapely.STRtree(shapely.box(low[:, 0], low[:, 1], high[:, 0], high[:, 1]))
+    tile, index = tree.query(shapely.box(halos[:, 0, 0], halos[:, 0, 1], halos[:, 1, 0], halos[:, 1, 1]), predicate="intersects")
+    return np.split(index, np.searchsorted(tile, np.arange(1, len(halos)))) #results come sorted by tile
+
+def _tile_jobs(metal, resist, tile_boxes, halos, tile_rules):
+    for tile, metal_index, resist_index in zip(tile_boxes, _tile_members(metal, halos), _tile_members(resist, halos)):
+        if len(metal_index) or len(resist_index):
+            yield tile.tolist(), _take(metal, metal_index), _take(resist, resist_index), tile_rules
+
+def check_mask(layout, tile_rules=None, workers=1, size=None):
+    '''Design-rule violations of a mask, each {"rule", "limit", "distance", "location", "line", "extent", "device"}.
+
+    One violation per pair of shapes: distance, location and line are at the closest approach, extent is
+    the bounding box of everything closer than the limit (all the fingers of two combs that are too close).
+
+    layout is a GDS path, a gdstk.Cell or a gf Component; tile_rules defaults to rules. Tiles are checked in
+    `workers` processes (None for one per core). device is the index of the device holding the violation
+    (see cmr_exposure.device_references), -1 outside every device and None between two devices.'''
+    import shapely
+    tile_rules = dict(rules if tile_rules is None else tile_rules)
+    size = tile_size if size is None else size
+
+    with stage("drc_flatten"):
+        top = _top_cell(layout)
+        metal = _pack([p.points for p in top.get_polygons(layer=metal_layer[0], datatype=metal_layer[1])])
+        resist = _pack([p.points for p in top.get_polygons(layer=resist_layer[0], datatype=resist_layer[1])])
+    if len(metal[1]) + len(resist[1]) == 0:
+        return []
+    bbox = top.bounding_box()
+    halo = max(tile_rules.values(), default=0.0) + (pad_size if "pad_spacing" in tile_rules else 0.0)
+    tile_boxes, halos = tiles(bbox, size, halo)
+
+    with stage("drc_tiles"):
+        jobs = _tile_jobs(metal, resist, tile_boxes, halos, tile_rules)
+        if workers == 1:
+            results = [_check_tile(job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_check_tile, jobs))
+    violations = [violation for found in results for violation in found]
+
+    with stage("drc_attribute"):
+        devices = device_references(top)
+        if violations and devices:
+            boxes = np.array([np.array(ref.bounding_box()) + offset for ref, offset in devices]).reshape(-1, 2, 2)
+            tree = shapely.STRtree(shapely.box(boxes[:, 0, 0], boxes[:, 0, 1], boxes[:, 1, 0], boxes[:, 1, 1]))
+            ends = np.array([violation["line"] for violation in violations]).reshape(-1, 2)
+            point, box = tree.query(shapely.points(ends), predicate="intersects")
+            owner = np.full(len(ends), -1)
+            owner[point[::-1]] = box[::-1]
+            for violation, (a, b) in zip(violations, owner.reshape(-1, 2).tolist()):
+                violation["device"] = a if a == b else None
+        else:
+            for violation in violations:
+                violation["device"] = -1
+    violations.sort(key=lambda violation: (violation["rule"], violation["location"][1], violation["location"][0]))
+    return violations
+
+def summary(violations):
+    '''Rule -> number of violations and the smallest distance found.'''
+    counts = {}
+    for violation in violations:
+        entry = counts.setdefault(violation["rule"], {"count": 0, "limit": violation["limit"], "min_distance": math.inf})
+        entry["count"] += 1
+        entry["min_distance"] = min(entry["min_distance"], violation["distance"])
+    return counts
+
+#####################################################
+#                     Main                          #
+#####################################################
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the CMR design rules on a mask GDS.")
+    parser.add_argument("gds")
+    parser.add_argument("--workers", type=int, default=1, help="processes checking tiles, 0 for one per core")
+    parser.add_argument("--tile", type=float, default=tile_size, help="tile size in um")
+    for rule, value in rules.items():
+        parser.add_argument("--" + rule.replace("_", "-"), type=float, default=value, metavar="UM")
+    parser.add_argument("--json", help="write every violation to this file")
+    args = parser.parse_args(argv)
+
+    violations = check_mask(args.gds, {rule: getattr(args, rule) for rule in rules}, args.workers or None, args.tile)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(violations, f, indent=2)
+    for rule, entry in summary(violations).items():
+        print(f"{rule:24} {entry['count']:8} violations, limit {entry['limit']} um, closest {entry['min_distance']:.4f} um")
+    for violation in violations[:20]:
+        print("  {rule} {distance:.4f} um at ({location[0]:.3f}, {location[1]:.3f}), device {device}".format(**violation))
+    if not violations:
+        print("no violations")
+    return 1 if violations else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,171 @@
+'''Exposure area, shot count and write time estimates for a mask, per device and per write field.
+
+The whole mask is flattened once (gdstk) and every metric is computed on the concatenated vertex arrays:
+area and perimeter per polygon with np.add.reduceat, polygons assigned to devices by a single bulk STRtree
+query of their centroids against the device bounding boxes and to write fields by integer division.
+
+Shots follow a Gaussian beam tool that exposes every beam_step x beam_step pixel once; the write time is the
+dose time area*dose/current plus a settling time per written field.
+
+    python cmr_exposure.py all_components.gds --field 500 --current 2 --json exposure.json'''
+
+import argparse
+import json
+import math
+import re
+import sys
+
+import numpy as np
+import gdstk
+
+device_cell_names = ("flat_cmr", "biconvex_cmr", "undercut_ring", "final_component", "ring_and_resist") #top cells returned by the builders (and their names before cmr_cache.name_cells)
+marker_cell_names = ("alignment_marker", "local_marker", "all corners", "all_corners")
+
+dose = {(1, 0): 300.0, (2, 0): 300.0} #uC/cm^2 per layer
+beam_step = 0.01 #um
+beam_current = 1.0 #nA
+field_settle = 0.05 #s per written field (stage move and settling)
+
+#####################################################
+#                 Mask traversal                    #
+#####################################################
+
+def _base_name(name):
+    #strip gdsfactory's $n suffix and the content hash added by cmr_parallel.content_rename
+    return re.sub(r"_[0-9a-f]{10}$", "", name.split("$")[0])
+
+def device_references(cell, offset=(0.0, 0.0)):
+    '''(reference, offset) of every device placed in cell, looking through the grid/placement cells in between.
+
+    Devices are references to builder top cells (device_cell_names); markers are skipped. The cells in between
+    are expected to place their children by translation only, which is all gf.grid and the placers do.'''
+    found = []
+    for ref in cell.references:
+        name = _base_name(ref.cell if isinstance(ref.cell, str) else ref.cell.name)
+        if name in device_cell_names:
+            found.append((ref, offset))
+        elif name not in marker_cell_names and not isinstance(ref.cell, str):
+            found += device_references(ref.cell, (offset[0] + ref.origin[0], offset[1] + ref.origin[1]))
+    return found
+
+def _top_cell(layout):
+    if isinstance(layout, str):
+        tops = gdstk.read_gds(layout).top_level()
+        if len(tops) != 1:
+            raise ValueError(f"{layout} has {len(tops)} top-level cells {[cell.name for cell in tops]}, expected one")
+        return tops[0]
+    return getattr(layout, "_cell", layout) #gf Component or gdstk.Cell
+
+#####################################################
+#               Polygon metrics                     #
+#####################################################
+
+def polygon_metrics(polygons):
+    '''Area, perimeter, vertex count and centroid of every polygon, from one concatenated vertex array.'''
+    if not polygons:
+        return np.zeros(0), np.zeros(0), np.zeros(0, dtype=int), np.zeros((0, 2))
+    counts = np.fromiter((len(p.points) for p in polygons), dtype=int, count=len(polygons))
+    points = np.concatenate([p.points for p in polygons])
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    following = np.roll(points, -1, axis=0)
+    following[starts + counts - 1] = points[starts] #close every polygon on its own first vertex
+    cross = points[:, 0]*following[:, 1] - following[:, 0]*points[:, 1]
+    area = np.abs(np.add.reduceat(cross, starts))/2
+    perimeter = np.add.reduceat(np.hypot(*(following - points).T), starts)
+    centroid = np.add.reduceat(points, starts)/counts[:, None] #vertex mean, enough to pick the device and field
+    return area, perimeter, counts, centroid
+
+def _summary(area, perimeter, vertices, layer):
+    total = float(area.sum())
+    return {
+        "area_um2": total,
+        "perimeter_um": float(perimeter.sum()),
+        "polygons": int(len(area)),
+        "vertices": int(vertices.sum()),
+        "shots": int(math.ceil(total/beam_step**2)),
+        "dose_time_s": total*dose.get(layer, 0.0)/beam_current*1e-5, #um^2*uC/cm^2/nA in s
+    }
+
+def _grouped(keys, area, perimeter, vertices, layer):
+    #per key summaries, keys sorted; one argsort instead of a mask per key
+    order = np.argsort(keys, kind="stable")
+    unique, starts = np.unique(keys[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    return {key: _summary(area[order[s:e]], perimeter[order[s:e]], vertices[order[s:e]], layer)
+            for key, s, e in zip(unique.tolist(), starts, ends)}
+
+#####################################################
+#                    Report                         #
+#####################################################
+
+def exposure_report(layout, field_size=None, layers=((1, 0), (2, 0)), origin=(0.0, 0.0)):
+    '''Per layer totals, per device and (with field_size) per write field exposure estimates of a mask.
+
+    layout is a GDS path, a gdstk.Cell or a gf Component. Devices are numbered in reference order and polygons
+    outside every device (markers) are counted under device -1. Write fields of field_size tile the plane from
+    origin and are keyed "column,row".'''
+    import shapely
+
+    top = _top_cell(layout)
+    devices = device_references(top)
+    boxes = np.array([np.array(ref.bounding_box()) + offset for ref, offset in devices]).reshape(-1, 2, 2)
+    tree = shapely.STRtree(shapely.box(boxes[:, 0, 0], boxes[:, 0, 1], boxes[:, 1, 0], boxes[:, 1, 1]))
+
+    report = {"devices": [{"index": i, "cell": ref.cell.name, "bbox": box.tolist()} for i, ((ref, _), box) in enumerate(zip(devices, boxes))],
+              "fields": {}, "total": {}}
+    written_fields = set()
+    for layer in layers:
+        polygons = top.get_polygons(layer=layer[0], datatype=layer[1])
+        area, perimeter, vertices, centroid = polygon_metrics(polygons)
+
+        device = np.full(len(polygons), -1)
+        if len(polygons) and len(devices):
+            point, box = tree.query(shapely.points(centroid), predicate="intersects")
+            device[point[::-1]] = box[::-1] #first box wins where boxes touch
+        for index, summary in _grouped(device, area, perimeter, vertices, layer).items():
+            if index >= 0:
+                report["devices"][index][f"{layer[0]}/{layer[1]}"] = summary
+
+        if field_size is not None and len(polygons):
+            cells = np.floor((centroid - origin)/field_size).astype(int)
+            unique_cells, keys = np.unique(cells, axis=0, return_inverse=True)
+            for key, summary in _grouped(keys.ravel(), area, perimeter, vertices, layer).items():
+                field = "{},{}".format(*unique_cells[key])
+                report["fields"].setdefault(field, {})[f"{layer[0]}/{layer[1]}"] = summary
+                written_fields.add(field)
+        report["total"][f"{layer[0]}/{layer[1]}"] = _summary(area, perimeter, vertices, layer)
+
+    dose_time = sum(summary["dose_time_s"] for summary in report["total"].values())
+    report["total"]["fields"] = len(written_fields) if field_size is not None else None
+    report["total"]["write_time_s"] = dose_time + field_settle*len(written_fields)
+    return report
+
+#####################################################
+#                     Main                          #
+#####################################################
+
+def main(argv=None):
+    global beam_step, beam_current, field_settle
+    parser = argparse.ArgumentParser(description="Estimate the EBL exposure of a mask GDS.")
+    parser.add_argument("gds")
+    parser.add_argument("--field", type=float, nargs="+", metavar="UM", help="write field width [height] in um")
+    parser.add_argument("--step", type=float, default=beam_step, help="beam step in um")
+    parser.add_argument("--current", type=float, default=beam_current, help="beam current in nA")
+    parser.add_argument("--settle", type=float, default=field_settle, help="seconds per written field")
+    parser.add_argument("--json", help="write the full report to this file")
+    args = parser.parse_args(argv)
+    beam_step, beam_current, field_settle = args.step, args.current, args.settle
+
+    field = (args.field[0], args.field[-1]) if args.field else None
+    report = exposure_report(args.gds, field)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    for layer, summary in report["total"].items():
+        if isinstance(summary, dict):
+            print(f"{layer:>5} {summary['area_um2']:14.1f} um^2 {summary['polygons']:8} polygons {summary['vertices']:10} vertices {summary['shots']:14} shots")
+    print(f"{len(report['devices'])} devices, {report['total']['fields'] or '-'} fields, estimated write time {report['total']['write_time_s']/3600:.2f} h")
+    return report
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
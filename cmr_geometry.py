@@ -0,0 +1,200 @@
+'''Closed-form outlines for the CMR metal and resist layers.
+
+Every shape of a CMR is a rectangle, a mirrored rectangle or an ellipse arc, so the merged outlines
+that the builders used to get from gf.geometry.union / gf.geometry.boolean can be written down directly.
+All functions take and return NumPy (n,2) vertex arrays in um and never touch gdsfactory.'''
+
+import functools
+
+import numpy as np
+
+#####################################################
+#                 Basic operations                  #
+#####################################################
+
+def rectangle(x1, y1, x2, y2):
+    return np.array([(x1, y1), (x1, y2), (x2, y2), (x2, y1)], dtype=float)
+
+def mirror_x(points, x):
+    #mirror about the vertical line through x
+    points = np.array(points, dtype=float)
+    points[:, 0] = 2*x - points[:, 0]
+    return points
+
+def mirror_y(points, y):
+    #mirror about the horizontal line through y
+    points = np.array(points, dtype=float)
+    points[:, 1] = 2*y - points[:, 1]
+    return points
+
+def perimeter(points):
+    points = np.asarray(points, dtype=float)
+    return float(np.hypot(*(np.roll(points, -1, axis=0) - points).T).sum())
+
+def simplify(points, eps=1e-9):
+    '''Drop repeated and collinear vertices of a closed outline.'''
+    points = np.asarray(points, dtype=float)
+    keep = np.any(np.abs(points - np.roll(points, 1, axis=0)) > eps, axis=1)
+    points = points[keep]
+    while len(points) > 2:
+        prev = np.roll(points, 1, axis=0)
+        nxt = np.roll(points, -1, axis=0)
+        cross = (points[:, 0]-prev[:, 0])*(nxt[:, 1]-points[:, 1]) - (points[:, 1]-prev[:, 1])*(nxt[:, 0]-points[:, 0])
+        keep = np.abs(cross) > eps
+        if keep.all():
+            break
+        points = points[keep]
+    return points
+
+#####################################################
+#                   IDT combs                       #
+#####################################################
+
+def comb_outline(x0, y0, bus_width, bus_length, electrode_length, electrode_width, electrode_separation, electrode_number, parity=0):
+    '''Bus [x0,x0+bus_width] x [y0,y0+bus_length] merged with every finger i with i%2 == parity.'''
+    xb = x0 + bus_width
+    ys = y0 + np.arange(parity, electrode_number, 2)*(electrode_width + electrode_separation)
+
+    #each finger contributes four vertices walking up the right edge of the bus
+    fingers = np.empty((len(ys), 4, 2))
+    fingers[:, 0] = np.column_stack([np.full_like(ys, xb), ys])
+    fingers[:, 1] = np.column_stack([np.full_like(ys, xb + electrode_length), ys])
+    fingers[:, 2] = np.column_stack([np.full_like(ys, xb + electrode_length), ys + electrode_width])
+    fingers[:, 3] = np.column_stack([np.full_like(ys, xb), ys + electrode_width])
+
+    outline = np.concatenate([
+        [(x0, y0), (xb, y0)],
+        fingers.reshape(-1, 2),
+        [(xb, y0 + bus_length), (x0, y0 + bus_length)],
+    ])
+    return simplify(outline)
+
+def idt_outlines(x0, y0, bus_width, electrode_length, electrode_end_margin, electrode_width, electrode_separation, electrode_number):
+    '''Both interleaved combs: even fingers on the left bus, odd fingers on the mirrored right bus.'''
+    bus_length = electrode_number*(electrode_width + electrode_separation) - electrode_separation
+    left = comb_outline(x0, y0, bus_width, bus_length, electrode_length, electrode_width, electrode_separation, electrode_number, parity=0)
+    right = comb_outline(x0, y0, bus_width, bus_length, electrode_length, electrode_width, electrode_separation, electrode_number, parity=1)
+    right = mirror_x(right, x0 + bus_width + (electrode_length + electrode_end_margin)/2)
+    return [left, right[::-1]]
+
+#####################################################
+#                  Etch windows                     #
+#####################################################
+
+def window_outline(x1, x2, leg_bottom, top, leg_width, inner_edge):
+    '''Inverted-U etch window: two legs of leg_width hanging from a bar whose lower edge is inner_edge.
+
+    inner_edge runs from (x1+leg_width, y) to (x2-leg_width, y'); the legs end at leg_bottom.'''
+    inner_edge = np.asarray(inner_edge, dtype=float)
+    leg_bottom = min(leg_bottom, inner_edge[0, 1], inner_edge[-1, 1]) #legs shorter than zero collapse into the bar
+    outline = np.concatenate([
+        [(x1, leg_bottom), (x1 + leg_width, leg_bottom)],
+        inner_edge,
+        [(x2 - leg_width, leg_bottom), (x2, leg_bottom), (x2, top), (x1, top)],
+    ])
+    return simplify(outline)
+
+def ellipse_cap(length, k, angle_resolution=2.5):
+    '''Upper half of the ellipse with radii (length/2, k) centred on (length/2, 0), left to right.
+
+    Sampled like gf.components.ellipse (polar angle steps of angle_resolution degrees) so the outline
+    matches the rectangle-minus-ellipse boolean exactly.'''
+    a = length/2
+    t = np.linspace(0, 360, int(360/angle_resolution) + 1)*np.pi/180
+    t = t[t <= np.pi + 1e-12][::-1]
+    r = a*k/np.sqrt((k*np.cos(t))**2 + (a*np.sin(t))**2)
+    return np.column_stack([a + r*np.cos(t), r*np.sin(t)])
+
+@functools.lru_cache(maxsize=None)
+def ellipse_cap_adaptive(length, k, tolerance=1e-3):
+    '''The ellipse_cap curve with as few vertices as keep every chord within tolerance (um) of the true ellipse.
+
+    The ellipse is the unit circle scaled by (a, k), so a chord spanning the parameter step d around t strays
+    a*k*(1-cos(d/2))/|(a*sin(t), k*cos(t))| from the curve. The steps follow that bound, which puts the vertices
+    at the sharp ends and leaves shallow caps with a handful. Memoized; the returned array is read-only.'''
+    a = length/2
+    t = np.linspace(np.pi, 0, 4097)
+    speed = np.hypot(a*np.sin(t), k*np.cos(t))
+    largest_step = 4*np.arcsin(np.sqrt(np.minimum(tolerance*speed/(2*a*k), 1)))
+    density = 1/largest_step
+    cumulative = np.concatenate(([0], np.cumsum((density[1:] + density[:-1])/2*(t[:-1] - t[1:]))))
+
+    segments = max(1, int(np.ceil(cumulative[-1])))
+    while True:
+        s = np.interp(np.linspace(0, cumulative[-1], segments + 1), cumulative, t)
+        s[0], s[-1] = np.pi, 0
+        middle, step = (s[:-1] + s[1:])/2, s[:-1] - s[1:]
+        error = 2*a*k*np.sin(step/4)**2/np.hypot(a*np.sin(middle), k*np.cos(middle))
+        if error.max() <= tolerance:
+            break
+        segments += max(1, segments//10)
+
+    curve = np.column_stack([a + a*np.cos(s), k*np.sin(s)])
+    curve[[0, -1], 1] = 0
+    curve.setflags(write=False)
+    return curve
+
+#####################################################
+#               Ring test structures                #
+#####################################################
+
+def circle_points(radius, angle_resolution=2.5):
+    '''Vertices of gf.components.ring's circles: angles 0 to 360 degrees in round(360/angle_resolution) steps, last = first.'''
+    t = np.linspace(0, 2*np.pi, int(np.round(360/angle_resolution)) + 1)
+    return radius*np.column_stack([np.cos(t), np.sin(t)])
+
+def _tether_entry(arc, x_inner, half_width):
+    #arc runs from the +x axis upwards; returns where the tether's upper edge meets it and the next arc vertex
+    above = int(np.argmax(arc[:, 1] >= half_width))
+    (xa, ya), (xb, yb) = arc[above-1], arc[above]
+    x_cross = xa + (half_width - ya)*(xb - xa)/(yb - ya)
+    if x_cross >= x_inner:
+        return [(x_cross, half_width)], above
+    #the tether corner sticks out of the chord, so its inner edge meets the ring lower down
+    inside = int(np.argmax(arc[:, 0] < x_inner))
+    (xa, ya), (xb, yb) = arc[inside-1], arc[inside]
+    return [(x_inner, half_width), (x_inner, ya + (x_inner - xa)*(yb - ya)/(xb - xa))], inside
+
+def ring_frame(outer_radius, width, tether_width, tether_length, tether_overlap, margin, angle_resolution=2.5):
+    '''Resist frame of a ring held by two horizontal tethers, centred on the origin.
+
+    The frame is the bounding box of ring and tethers, margin taller at top and bottom, minus ring and tethers:
+    the disk inside the ring and the parts above and below the tethers. The tethers are tether_width wide and
+    tether_length long and reach tether_overlap into the ring. Returns [upper, lower, inner disk].'''
+    outer = circle_points(outer_radius, angle_resolution)
+    half = tether_width/2
+    x_inner = outer_radius - tether_overlap
+    x_end = x_inner + tether_length
+    top = outer[:, 1].max() + margin
+
+    right, right_vertex = _tether_entry(outer, x_inner, half)
+    half_turn = (len(outer) - 1)//2 #last vertex at or before 180 degrees
+    left, left_vertex = _tether_entry(mirror_x(outer[half_turn::-1], 0), x_inner, half)
+    left_vertex = half_turn - left_vertex
+
+    upper = np.concatenate([
+        [(x_end, top), (-x_end, top), (-x_end, half)],
+        mirror_x(np.array(left), 0),
+        outer[left_vertex:right_vertex-1:-1],
+        np.array(right)[::-1],
+        [(x_end, half)],
+    ])
+    upper = simplify(upper)
+    return [upper, mirror_y(upper, 0), simplify(circle_points(outer_radius - width, angle_resolution)[:-1])]
+
+#####################################################
+#               Engine comparison                   #
+#####################################################
+
+def xor_area(polygons_a, polygons_b, precision=1e-4):
+    '''Area of the symmetric difference of two {layer: [points]} dicts, per layer.
+
+    Only used to check the closed-form outlines against the boolean path, so gdstk is imported lazily.'''
+    import gdstk
+
+    areas = {}
+    for layer in sorted(set(polygons_a) | set(polygons_b)):
+        a = [gdstk.Polygon(p) for p in polygons_a.get(layer, [])]
+        b = [gdstk.Polygon(p) for p in polygons_b.get(layer, [])]
+        areas[layer] = sum(p.area() for p in gdstk.boolean(a, b, "xor", precision=precision))
+    return areas
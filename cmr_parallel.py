@@ -0,0 +1,143 @@
+'''Process-pool sweep builder.
+
+Each device of a sweep is built in a worker process and written to its own GDS fragment. The builders
+name their cells after their parameters (cmr_cache.name_cells) and any cell left with a gdsfactory name
+is renamed after a hash of its contents, so cell names do not depend on which worker built what, and
+cells shared between devices (buses, pads, labels...) collapse into one definition when the parent merges the fragments. The parent returns the devices
+in job order, ready for gf.grid.'''
+
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import os
+import re
+import tempfile
+
+import numpy as np
+import gdstk
+
+import cmr_cache
+
+max_points = 8190 #largest polygon GDSII can hold; gdstk's default of 199 would fracture curved routes
+
+#####################################################
+#          Content-addressed cell names             #
+#####################################################
+
+def _ordered_cells(top):
+    #children before parents, each cell once
+    ordered, seen = [], set()
+    def visit(cell):
+        if id(cell) in seen:
+            return
+        seen.add(id(cell))
+        for ref in cell.references:
+            if isinstance(ref.cell, gdstk.Cell):
+                visit(ref.cell)
+        ordered.append(cell)
+    visit(top)
+    return ordered
+
+def _cell_digest(cell):
+    h = hashlib.sha256()
+    polygons = cell.polygons + [p for path in cell.paths for p in path.to_polygons()]
+    for polygon in sorted(polygons, key=lambda p: (p.layer, p.datatype, p.points.tobytes())):
+        h.update(f"P{polygon.layer}/{polygon.datatype}".encode())
+        h.update(np.round(polygon.points, 6).tobytes())
+    for ref in cell.references:
+        name = ref.cell if isinstance(ref.cell, str) else ref.cell.name
+        rep = ref.repetition
+        h.update(f"R{name}{np.round(ref.origin, 6).tolist()}{ref.rotation}{ref.magnification}{ref.x_reflection}".encode())
+        h.update(f"{rep.columns}{rep.rows}{rep.spacing}{rep.v1}{rep.v2}".encode())
+    for label in cell.labels:
+        h.update(f"L{label.text}{np.round(label.origin, 6).tolist()}{label.layer}/{label.texttype}".encode())
+    return h.hexdigest()[:10]
+
+_content_named = set() #cells renamed in this process; cached cells shared by several devices keep their first name
+_gf_hash = re.compile(r"_[0-9a-f]{8}(?=_|$)") #gdsfactory's hash of a cell's arguments, e.g. union_8a490b08
+
+def content_rename(top):
+    '''Rename top and every cell below it to <base name>_<content hash>. Returns the cells, children first.
+
+    The base name is gdsfactory's without its $n counter and argument hashes, so the name follows from the content
+    alone: the same cell rebuilt after gf.clear_cache() gets the same name. Cells already named after their
+    parameters (cmr_cache.name_cells) are stable as they are and keep their names.'''
+    cells = _ordered_cells(top)
+    for cell in cells:
+        if cell.name in _content_named or cmr_cache.is_stable(cell.name):
+            continue
+        base = _gf_hash.sub("", cell.name.split("$")[0].replace(" ", "_"))
+        if base.startswith("Unnamed"): #gdsfactory's placeholder, e.g. the filler of empty gf.grid slots
+            base = "cell"
+        cell.name = f"{base}_{_cell_digest(cell)}"
+        _content_named.add(cell.name)
+    return cells
+
+def clear_gf_cache(gf):
+    '''gf.clear_cache(), forgetting the cells renamed so far as well: gdsfactory hands out their old names again.'''
+    gf.clear_cache()
+    _content_named.clear()
+
+#####################################################
+#                    Workers                        #
+#####################################################
+
+def _build_fragment(job):
+    builder, args, settings, path = job
+    import All_components_CMR as cmr
+
+    vars(cmr).update(settings)  #module globals of the parent (outline engine, idt mode, dimensions...)
+    device = cmr.builders[builder](*args)
+
+    cells = content_rename(device._cell)
+    library = gdstk.Library()
+    library.add(*{cell.name: cell for cell in cells}.values())
+    partial = f"{path}.{os.getpid()}.tmp" #readers never see a half-written fragment
+    library.write_gds(partial, max_points=max_points)
+    os.replace(partial, path)
+    return path
+
+#####################################################
+#                  Parallel sweep                   #
+#####################################################
+
+def build_fragments(jobs, paths, max_workers=None, settings=None):
+    '''Build every (builder name, args) job into the GDS fragment at the matching path. Returns the paths.'''
+    settings = settings or {}
+    tasks = [(builder, tuple(args), settings, path) for (builder, args), path in zip(jobs, paths)]
+    if max_workers == 1:
+        return [_build_fragment(task) for task in tasks]
+    chunksize = max(1, len(tasks)//(4*(max_workers or os.cpu_count() or 1)))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_build_fragment, tasks, chunksize=chunksize))
+
+def merge_fragments(paths, gdspath, top_name="sweep_devices"):
+    '''Merge device fragments into one GDS whose top cell references every device in order.'''
+    library = gdstk.Library()
+    names = set()
+    top = gdstk.Cell(top_name)
+    for path in paths:
+        fragment = gdstk.read_gds(path)
+        for cell in fragment.cells:
+            if cell.name not in names: #same name means same content
+                names.add(cell.name)
+                library.add(cell)
+        top.add(gdstk.Reference(fragment.top_level()[0].name))
+    library.add(top)
+    partial = f"{gdspath}.{os.getpid()}.tmp"
+    library.write_gds(partial, max_points=max_points)
+    os.replace(partial, gdspath)
+    return gdspath
+
+def load_devices(gdspath):
+    '''Import a merged sweep as gdsfactory components, in the order of the top cell references.'''
+    import gdsfactory as gf
+
+    sweep = gf.import_gds(gdspath, unique_names=False)
+    return [ref.parent for ref in sweep.references]
+
+def build_sweep_parallel(jobs, max_workers=None, settings=None, workdir=None):
+    '''Build a sweep across a process pool and return the devices as components, in job order.'''
+    with tempfile.TemporaryDirectory(prefix="cmr_sweep_", dir=workdir) as tmp:
+        paths = [os.path.join(tmp, f"device_{i:06d}.gds") for i in range(len(jobs))]
+        build_fragments(jobs, paths, max_workers=max_workers, settings=settings)
+        return load_devices(merge_fragments(paths, os.path.join(tmp, "sweep.gds")))
@@ -0,0 +1,80 @@
+'''Incremental mask writer: rebuild only the devices a sweep edit changed.
+
+Every device's top cell is named after its builder, arguments and the geometry constants
+(All_components_CMR.device_name), and the cells below it after that name, so the name of a device can be
+computed without building it. patch_mask() reads the cells of an existing mask verbatim
+(gdstk.read_rawcells, no polygons are parsed) and streams the new mask: a device whose name is already in
+the file is copied over as raw GDS records together with its subcells, only the others are built. Cells
+no longer referenced are dropped and cells are written in the same order as cmr_stream writes them, so a
+small sweep edit on a large mask takes seconds and leaves a small binary diff.
+
+    python cmr_patch.py all_components.gds --spec my_sweep.json'''
+
+import argparse
+import sys
+
+import cmr_parallel
+import cmr_stream
+from cmr_profile import stage
+
+#####################################################
+#                 Device sources                    #
+#####################################################
+
+def _patched_devices(jobs, cmr, raw, parsed, counts):
+    #(top, cells) per job: raw cells of the old mask where the device name is known, built cells otherwise
+    for builder, args in jobs:
+        name = cmr.device_name(builder, args)
+        if name in raw:
+            counts["reused"] += 1
+            yield parsed[name], [raw[cell.name] for cell in cmr_parallel._ordered_cells(parsed[name])]
+            continue
+        if counts["built"] and counts["built"] % cmr_stream.clear_cache_every == 0:
+            cmr_parallel.clear_gf_cache(cmr.gf)
+        counts["built"] += 1
+        device = cmr.builders[builder](*args)
+        cells = cmr_parallel.content_rename(device._cell)
+        #subcells the old mask already holds (shared buses, pads, labels...) are copied rather than re-encoded
+        yield cells[-1], [raw.get(cell.name, cell) for cell in cells]
+        del device, cells
+
+#####################################################
+#                   Patching                        #
+#####################################################
+
+def patch_mask(jobs, gdspath, out=None, cmr=None):
+    '''Write the mask of the sweep `jobs` to out (gdspath by default), reusing the cells of the mask at gdspath.
+
+    Placement and markers are those of cmr_stream.write_mask_streaming. Returns {"reused", "built"} device counts.'''
+    import gdstk
+    if cmr is None:
+        import All_components_CMR as cmr
+
+    with stage("patch_read"):
+        raw = gdstk.read_rawcells(gdspath)
+        parsed = {cell.name: cell for cell in gdstk.read_gds(gdspath).cells} #only for the device bounding boxes
+    counts = {"reused": 0, "built": 0}
+    with stage("patch_mask"):
+        cmr_stream.stream_devices(_patched_devices(jobs, cmr, raw, parsed, counts), out or gdspath, **cmr_stream.mask_layout(cmr, jobs))
+    return counts
+
+#####################################################
+#                     Main                          #
+#####################################################
+
+def main(argv=None):
+    import All_components_CMR as cmr
+    import cmr_sweep
+
+    parser = argparse.ArgumentParser(description="Rewrite a mask GDS for an edited sweep, building only the new devices.")
+    parser.add_argument("gds", help="mask to patch")
+    parser.add_argument("--spec", default=cmr.sweep_spec, help="sweep spec file (.json, .toml or .yaml)")
+    parser.add_argument("--out", help="write the patched mask here instead of over gds")
+    args = parser.parse_args(argv)
+
+    counts = patch_mask(cmr_sweep.load_sweep(args.spec, cmr), args.gds, args.out, cmr)
+    print(f"{counts['reused']} devices reused, {counts['built']} built -> {args.out or args.gds}")
+    return counts
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
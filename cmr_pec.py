@@ -0,0 +1,240 @@
+'''Proximity-effect correction: per-polygon dose classes from an FFT convolution with a double-Gaussian PSF.
+
+The energy deposited at r by a unit point exposure is modelled as
+
+    psf(r) = (exp(-r^2/alpha^2)/(pi alpha^2) + eta exp(-r^2/beta^2)/(pi beta^2))/(1 + eta)
+
+Each layer is rasterized tile by tile (cmr_raster, exact pixel coverage, with a halo of halo_betas*beta
+around the tile) and the coverage is convolved with both Gaussians by rfft2. A feature edge then
+receives (1/2 + eta*B)/(1 + eta) of its dose, B being the backscattered coverage, so the dose that brings
+every edge to the same level is
+
+    dose = (1 + eta)/(1 + 2*eta*B)
+
+from 1 + eta for an isolated finger down to (1 + eta)/(1 + 2*eta) inside a large pad. Polygons are cut
+on a fracture_size grid (fingers apart from their bus, pads into patches), every piece gets the dose at
+its centre, rounded to one of dose_classes levels, and is written on datatype datatype_offset + class.
+Tiles are independent and can be corrected in worker processes; the output is streamed, one cell per
+tile and layer, so memory stays bounded on a full mask.
+
+    python cmr_pec.py all_components.gds all_components_pec.gds --beta 10 --eta 0.7 --workers 4'''
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import json
+import math
+import os
+import sys
+
+import numpy as np
+import gdstk
+
+import cmr_parallel
+import cmr_raster
+from cmr_drc import _pack, _take, _tile_members, tiles
+from cmr_exposure import _top_cell
+from cmr_profile import stage
+
+layers = ((1, 0), (2, 0))
+alpha = 0.02 #um, forward scattering range
+beta = 10.0 #um, backscattering range
+eta = 0.7 #backscattered to forward energy ratio
+
+pixel = 2.0 #um, beta/5; the coverage is exact at any pixel size, so fingers far below it still count with their true density
+tile_size = 500.0 #um
+halo_betas = 3 #halo around each tile in units of beta
+fracture_size = 10.0 #um
+dose_classes = 16
+datatype_offset = 1 #datatype of dose class 0
+
+settings_names = ("alpha", "beta", "eta", "pixel", "fracture_size", "dose_classes") #sent with every tile, worker processes do not see the caller's values
+
+@contextlib.contextmanager
+def _settings(values):
+    #the module globals of settings_names set to values for the duration of a correction
+    saved = [globals()[name] for name in settings_names]
+    globals().update(zip(settings_names, values))
+    try:
+        yield
+    finally:
+        globals().update(zip(settings_names, saved))
+
+#####################################################
+#                     PSF                           #
+#####################################################
+
+_erf = np.frompyfunc(math.erf, 1, 1)
+
+def _gaussian(n, sigma):
+    #exp(-x^2/sigma^2), normalized, integrated over each pixel; index 0 is the centre, negative offsets wrap
+    offsets = (np.arange(n) + n//2) % n - n//2
+    edges = (offsets[:, None] + (-0.5, 0.5))*pixel/sigma
+    return (_erf(edges[:, 1]) - _erf(edges[:, 0])).astype(float)/2
+
+def psf_spectra(shape):
+    '''rfft2 of the forward and backscatter Gaussians on a raster of shape, each normalized to 1.'''
+    rows, columns = shape
+    return tuple(np.fft.rfft2(np.outer(_gaussian(rows, sigma), _gaussian(columns, sigma))) for sigma in (alpha, beta))
+
+def dose_levels():
+    '''Relative dose of every class, evenly spread between the full-area and the isolated-feature dose.'''
+    low, high = (1 + eta)/(1 + 2*eta), 1 + eta
+    return low + (np.arange(dose_classes) + 0.5)*(high - low)/dose_classes
+
+def dose_class(dose):
+    low, high = (1 + eta)/(1 + 2*eta), 1 + eta
+    return np.clip(((dose - low)/(high - low)*dose_classes).astype(int), 0, dose_classes - 1)
+
+def exposure_maps(points, counts, origin, shape, spectra=None):
+    '''Coverage, absorbed energy (double-Gaussian PSF) and corrected dose on a raster of shape from origin.'''
+    coverage = cmr_raster.rasterize(points, counts, origin, pixel, shape)
+    forward, backscatter = psf_spectra(shape) if spectra is None else spectra
+    spectrum = np.fft.rfft2(coverage)
+    backscattered = np.fft.irfft2(spectrum*backscatter, s=shape)
+    energy = (np.fft.irfft2(spectrum*forward, s=shape) + eta*backscattered)/(1 + eta)
+    return coverage, energy, (1 + eta)/(1 + 2*eta*np.clip(backscattered, 0, 1))
+
+#####################################################
+#                 Tile correction                   #
+#####################################################
+
+def _slice(polygons, axis):
+    #cut the polygons crossing a fracture_size grid line along axis; most (fingers, glyphs) cross none and are kept
+    index = 0 if axis == "x" else 1
+    low = np.array([p.points[:, index].min() for p in polygons])
+    high = np.array([p.points[:, index].max() for p in polygons])
+    crossing = np.floor(low/fracture_size) < np.ceil(high/fracture_size) - 1
+    kept = [p for p, cut in zip(polygons, crossing) if not cut]
+    cut = [p for p, cut in zip(polygons, crossing) if cut]
+    if not cut:
+        return kept
+    lines = np.arange(math.floor(low[crossing].min()/fracture_size) + 1, math.ceil(high[crossing].max()/fracture_size))*fracture_size
+    return kept + [piece for band in gdstk.slice(cut, lines.tolist(), axis) for piece in band]
+
+def fracture(polygons):
+    '''gdstk polygons of points, cut on the fracture_size grid lines.'''
+    polygons = [gdstk.Polygon(points) for points in polygons]
+    if not polygons:
+        return []
+    return _slice(_slice(polygons, "x"), "y")
+
+def _correct_tile(job):
+    #dose-classed pieces of the polygons in the tile, one (points, counts, classes) per layer
+    tile, halo, per_layer, settings = job
+    with _settings(settings):
+        return _correct_pieces(tile, halo, per_layer)
+
+def _correct_pieces(tile, halo, per_layer):
+    (x0, y0), (x1, y1) = tile
+    origin = np.asarray(halo[0])
+    shape = (math.ceil((halo[1][1] - halo[0][1])/pixel), math.ceil((halo[1][0] - halo[0][0])/pixel))
+    spectra = psf_spectra(shape)
+    results = []
+    for (points, counts), (own_points, own_counts) in per_layer:
+        dose = exposure_maps(points, counts, origin, shape, spectra)[2]
+        starts = np.concatenate(([0], np.cumsum(own_counts)[:-1])).astype(int)
+        pieces, counts, starts = _pack([p.points for p in fracture([own_points[s:s + n] for s, n in zip(starts, own_counts)])])
+        centres = np.add.reduceat(pieces, starts)/counts[:, None] if len(counts) else np.zeros((0, 2))
+        #polygons crossing the tile edge are fractured by both tiles, each keeps the pieces centred on it
+        inside = (centres[:, 0] >= x0) & (centres[:, 0] < x1) & (centres[:, 1] >= y0) & (centres[:, 1] < y1)
+        points, counts = _take((pieces, counts, starts), np.flatnonzero(inside))
+        pixels = np.floor((centres[inside] - origin)/pixel).astype(int)
+        classes = dose_class(dose[np.clip(pixels[:, 1], 0, shape[0] - 1), np.clip(pixels[:, 0], 0, shape[1] - 1)])
+        results.append((points, counts, classes))
+    return results
+
+def _tile_jobs(packed_layers, tile_boxes, halos, settings):
+    members = [(_tile_members(packed, halos), _tile_members(packed, tile_boxes)) for packed in packed_layers]
+    for t, (tile, halo) in enumerate(zip(tile_boxes, halos)):
+        per_layer = [(_take(packed, near[t]), _take(packed, own[t])) for packed, (near, own) in zip(packed_layers, members)]
+        if any(len(own[1]) for _, own in per_layer):
+            yield tile.tolist(), halo.tolist(), per_layer, settings
+
+def correct_mask(layout, gdspath, workers=1, top_name="pec_mask", alpha=None, beta=None, eta=None, pixel=None,
+                 tile_size=None, fracture_size=None, dose_classes=None):
+    '''Write the proximity-corrected mask to gdspath: the layers' polygons fractured and sorted into dose
+    classes (datatypes). Returns {"doses": {datatype: relative dose}, "pieces": {layer: count per class}}.
+
+    The PSF, raster and fracture settings default to the module's; the module itself is left as it was.'''
+    given = dict(alpha=alpha, beta=beta, eta=eta, pixel=pixel, fracture_size=fracture_size, dose_classes=dose_classes)
+    settings = tuple(globals()[name] if given[name] is None else given[name] for name in settings_names)
+    with _settings(settings):
+        return _write_corrected(layout, gdspath, workers, top_name, globals()["tile_size"] if tile_size is None else tile_size, settings)
+
+def _write_corrected(layout, gdspath, workers, top_name, tile_size, settings):
+    with stage("pec_flatten"):
+        top = _top_cell(layout)
+        packed_layers = [_pack([p.points for p in top.get_polygons(layer=layer, datatype=datatype)]) for layer, datatype in layers]
+    bbox = top.bounding_box() or ((0, 0), (0, 0))
+    origin = np.floor(np.asarray(bbox[0])/fracture_size)*fracture_size #tile edges on the fracture grid
+    size = math.ceil(tile_size/fracture_size)*fracture_size
+    tile_boxes = tiles((origin, bbox[1]), size, 0)[0]
+    tile_boxes[:, 1] = tile_boxes[:, 0] + size #whole tiles, so their edges stay on the fracture grid
+    halos = tile_boxes + np.array([[-1, -1], [1, 1]])*halo_betas*beta
+
+    pieces = {f"{layer}/{datatype}": np.zeros(dose_classes, dtype=int) for layer, datatype in layers}
+    partial = f"{gdspath}.{os.getpid()}.tmp"
+    writer = gdstk.GdsWriter(partial, unit=1e-6, precision=1e-9, max_points=cmr_parallel.max_points)
+    mask = gdstk.Cell(top_name)
+    def write(results): #tile by tile as the results come in
+        for t, result in enumerate(results):
+            for (layer, datatype), (points, counts, classes) in zip(layers, result):
+                cell = gdstk.Cell(f"pec_{layer}_{datatype}_{t}")
+                starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(int)
+                for s, n, c in zip(starts, counts, classes):
+                    cell.add(gdstk.Polygon(points[s:s + n], layer=layer, datatype=datatype_offset + int(c)))
+                pieces[f"{layer}/{datatype}"] += np.bincount(classes, minlength=dose_classes)
+                if cell.polygons:
+                    writer.write(cell)
+                    mask.add(gdstk.Reference(cell.name))
+
+    try:
+        with stage("pec_tiles"):
+            jobs = _tile_jobs(packed_layers, tile_boxes, halos, settings)
+            if workers == 1:
+                write(map(_correct_tile, jobs))
+            else:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    write(executor.map(_correct_tile, jobs))
+        writer.write(mask)
+        writer.close()
+        os.replace(partial, gdspath)
+    finally:
+        if os.path.exists(partial): #a tile failed half way
+            writer.close()
+            os.remove(partial)
+    return {"doses": {datatype_offset + i: level for i, level in enumerate(dose_levels().tolist())},
+            "pieces": {layer: counts.tolist() for layer, counts in pieces.items()}}
+
+#####################################################
+#                     Main                          #
+#####################################################
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Proximity-correct a mask GDS into dose classes (datatypes).")
+    parser.add_argument("gds")
+    parser.add_argument("out")
+    parser.add_argument("--alpha", type=float, default=alpha, help="forward scattering range in um")
+    parser.add_argument("--beta", type=float, default=beta, help="backscattering range in um")
+    parser.add_argument("--eta", type=float, default=eta, help="backscattered to forward energy ratio")
+    parser.add_argument("--pixel", type=float, default=pixel, help="raster pixel in um")
+    parser.add_argument("--tile", type=float, default=tile_size, help="tile size in um")
+    parser.add_argument("--fracture", type=float, default=fracture_size, help="fracture grid in um")
+    parser.add_argument("--classes", type=int, default=dose_classes, help="number of dose classes")
+    parser.add_argument("--workers", type=int, default=1, help="processes correcting tiles, 0 for one per core")
+    parser.add_argument("--json", help="write the dose table and piece counts to this file")
+    args = parser.parse_args(argv)
+    summary = correct_mask(args.gds, args.out, args.workers or None, alpha=args.alpha, beta=args.beta, eta=args.eta, pixel=args.pixel,
+                           tile_size=args.tile, fracture_size=args.fracture, dose_classes=args.classes)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+    for layer, counts in summary["pieces"].items():
+        print(f"{layer:>5} {sum(counts):8} pieces")
+    for datatype, level in summary["doses"].items():
+        print(f"datatype {datatype:3} dose x{level:.3f}")
+    return summary
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,165 @@
+'''Write-field-aware device placement.
+
+gf.grid needs its shape updated by hand as a sweep grows and ignores the EBL write fields, so devices may
+straddle a field boundary and have their fingers stitched. field_offsets places every device entirely inside
+one write field instead: devices are shelf-packed tallest first into the usable part of each field (clear of
+the local marks at the field corners), fields are filled in serpentine order so the stage only ever steps to
+a neighbouring field, and boxes that must stay clear (global alignment marks...) are looked up in a spatial
+index. Sorting dominates, so placing n devices takes O(n log n).
+
+A device larger than the usable field is placed by its core instead (the IDT fingers and buses of a CMR,
+see All_components_CMR.device_core), which is all that has to be written in one field: a stitch error of
+a few tens of nm shifts a 250 nm finger against its neighbours, but not a 100 um pad. These devices get
+fields of their own above the packed ones, their pads and routes crossing into the fields around.
+
+    offsets, fields = field_offsets(bboxes, field_size=(500, 500), margin=25, spacing=(20, 20))'''
+
+import math
+
+import numpy as np
+
+#####################################################
+#                 Spatial index                     #
+#####################################################
+
+def box_index(boxes):
+    '''STRtree over ((xmin, ymin), (xmax, ymax)) boxes.'''
+    import shapely
+    return shapely.STRtree([shapely.box(x0, y0, x1, y1) for (x0, y0), (x1, y1) in boxes])
+
+def overlapping_pairs(boxes, eps=1e-6):
+    '''Index pairs (i, j), i < j, of boxes whose interiors overlap (touching edges do not count).'''
+    import shapely
+    if len(boxes) == 0:
+        return []
+    boxes = np.asarray(boxes, dtype=float)
+    shrunk = shapely.box(boxes[:, 0, 0] + eps, boxes[:, 0, 1] + eps, boxes[:, 1, 0] - eps, boxes[:, 1, 1] - eps)
+    first, second = shapely.STRtree(shrunk).query(shrunk, predicate="intersects")
+    keep = first < second
+    return list(zip(first[keep].tolist(), second[keep].tolist()))
+
+#####################################################
+#                 Field placement                   #
+#####################################################
+
+def serpentine(index, columns):
+    '''(column, row) of the index-th field when rows of `columns` fields are walked alternately left and right.'''
+    row, column = divmod(index, columns)
+    return (columns - 1 - column if row % 2 else column), row
+
+def check_fit(sizes, field_size, margin=0.0, what="device"):
+    '''Raise ValueError for the first (width, height) of sizes larger than a field of field_size less margin on every side.'''
+    sizes = np.asarray(sizes, dtype=float).reshape(-1, 2)
+    too_big = np.flatnonzero((sizes[:, 0] > field_size[0] - 2*margin) | (sizes[:, 1] > field_size[1] - 2*margin))
+    if len(too_big):
+        raise ValueError(f"{what} {too_big[0]} ({sizes[too_big[0]].tolist()} um) does not fit in a {tuple(field_size)} write field with margin {margin}")
+
+def _field_start(value, core, start, field, margin):
+    #smallest position >= value at which [position + core[0], position + core[1]] lies in the usable part of one field
+    index = math.floor((value + core[0] - start)/field)
+    if value + core[0] < start + index*field + margin:
+        return start + index*field + margin - core[0]
+    if value + core[1] > start + (index + 1)*field - margin:
+        return start + (index + 1)*field + margin - core[0]
+    return value
+
+def field_offsets(bboxes, field_size, margin=0.0, spacing=(5.0, 5.0), keepouts=(), origin=(0.0, 0.0), field_columns=None, cores=None):
+    '''Translation of every device that puts it entirely inside one write field, or failing that its core.
+
+    bboxes are the devices' ((xmin, ymin), (xmax, ymax)); fields of field_size tile the plane from origin, devices keep
+    margin from the field edges, spacing from each other and from the keepouts boxes. field_columns defaults to a
+    roughly square block of fields. cores are the boxes, in the same coordinates as bboxes, that must not be stitched
+    (the whole device by default). Returns the (n, 2) offsets and the (n,) serpentine index of each device's field,
+    i.e. the order the fields are written in. Raises ValueError for a core that cannot fit in a field.'''
+    n = len(bboxes)
+    if n == 0:
+        return np.zeros((0, 2)), np.zeros(0, dtype=int)
+    boxes = np.asarray(bboxes, dtype=float).reshape(n, 2, 2)
+    cores = boxes if cores is None else np.asarray(cores, dtype=float).reshape(n, 2, 2)
+    sizes = boxes[:, 1] - boxes[:, 0]
+    field_x, field_y = field_size
+    usable_x, usable_y = field_x - 2*margin, field_y - 2*margin
+    check_fit(cores[:, 1] - cores[:, 0], field_size, margin, "core of device")
+    whole = (sizes[:, 0] <= usable_x) & (sizes[:, 1] <= usable_y)
+
+    index = box_index(keepouts) if len(keepouts) else None
+    keepout_right = np.asarray([x1 for (_, _), (x1, _) in keepouts], dtype=float)
+
+    def blocker(x0, y0, x1, y1):
+        #right edge of the keepouts within spacing of the box, None if it is clear
+        if index is None:
+            return None
+        import shapely
+        eps = 1e-6 #a keepout exactly spacing away is clear, which also guarantees the skip below moves right
+        hits = index.query(shapely.box(x0 - spacing[0] + eps, y0 - spacing[1] + eps, x1 + spacing[0] - eps, y1 + spacing[1] - eps))
+        return keepout_right[hits].max() if len(hits) else None
+
+    order = np.lexsort((-sizes[:, 0], -sizes[:, 1])) #tallest first, widest first among equals
+    stitched = order[~whole[order]]
+    order = order[whole[order]]
+
+    def pack(columns):
+        offsets = np.zeros((n, 2))
+        fields = np.zeros(n, dtype=int)
+        field, shelf_y, shelf_height, x = 0, 0.0, 0.0, 0.0
+        for i in order:
+            width, height = sizes[i]
+            while True:
+                if x + width > usable_x: #next shelf
+                    shelf_y, shelf_height, x = shelf_y + shelf_height + spacing[1], 0.0, 0.0
+                if shelf_y + height > usable_y: #next field
+                    field, shelf_y, shelf_height, x = field + 1, 0.0, 0.0, 0.0
+                column, row = serpentine(field, columns)
+                left = origin[0] + column*field_x + margin
+                bottom = origin[1] + row*field_y + margin
+                right_edge = blocker(left + x, bottom + shelf_y, left + x + width, bottom + shelf_y + height)
+                if right_edge is None:
+                    break
+                x = max(x, right_edge + spacing[0] - left) #skip past the keepout, opening a new shelf if needed
+            offsets[i] = (left + x, bottom + shelf_y) - boxes[i, 0]
+            fields[i] = field
+            x += width + spacing[0]
+            shelf_height = max(shelf_height, height)
+        return offsets, fields
+
+    padded = (sizes[:, 0] + spacing[0])*(sizes[:, 1] + spacing[1])
+    if field_columns is not None:
+        columns = field_columns
+        offsets, fields = pack(columns)
+    elif len(order) == 0:
+        columns = max(1, math.ceil(math.sqrt(padded.sum())/field_x))
+        offsets, fields = pack(columns)
+    else: #start from the fields the padded device area needs, then square up the block actually used
+        columns = max(1, math.ceil(math.sqrt(padded[order].sum()/(usable_x*usable_y))))
+        offsets, fields = pack(columns)
+        square = math.ceil(math.sqrt(fields[order].max() + 1))
+        if square != columns:
+            columns = square
+            offsets, fields = pack(columns)
+
+    #devices too large for a field: rows above the packed fields, each device's core moved into a field of its own
+    used = fields[order].max() + 1 if len(order) else 0
+    x, row_y, row_height = 0.0, origin[1] + math.ceil(used/columns)*field_y + (max(spacing[1] - margin, 0.0) if used else 0.0), 0.0
+    for field, i in enumerate(stitched, used):
+        width, height = sizes[i]
+        core = cores[i] - boxes[i, 0] #relative to the device's lower left corner
+        while True:
+            if x > 0 and x + width > columns*field_x: #next row
+                x, row_y, row_height = 0.0, row_y + row_height + spacing[1], 0.0
+            left = _field_start(origin[0] + x, core[:, 0], origin[0], field_x, margin)
+            bottom = _field_start(row_y, core[:, 1], origin[1], field_y, margin)
+            right_edge = blocker(left, bottom, left + width, bottom + height)
+            if right_edge is None:
+                break
+            x = max(x, right_edge + spacing[0] - origin[0])
+        offsets[i] = (left, bottom) - boxes[i, 0]
+        fields[i] = field
+        x = left + width + spacing[0] - origin[0]
+        row_height = max(row_height, bottom + height - row_y)
+
+    placed = boxes + offsets[:, None, :]
+    overlaps = [(i, j) for i, j in overlapping_pairs(np.concatenate([placed, np.asarray(keepouts, dtype=float).reshape(-1, 2, 2)]))
+                if i < n] #pairs with at least one device
+    if overlaps:
+        raise RuntimeError(f"placement overlaps at device pairs {overlaps[:5]}")
+    return offsets, fields
@@ -0,0 +1,203 @@
+'''Headless raster preview of a mask: an overview PNG, a Deep Zoom tile pyramid and per-device thumbnails.
+
+Layers are rendered with cmr_raster, so every pixel is shaded by the exact fraction of it each layer covers:
+a coarse overview shows the finger gratings as their true grey level rather than moire, and the finest level
+(finest_pixel, half the narrowest finger gap by default) resolves the individual fingers. Every tile only
+rasterizes the polygons an STRtree finds under it, and tiles with nothing on them are not written.
+
+The pyramid is a Deep Zoom Image (mask.dzi plus mask_files/<level>/<column>_<row>.png), which OpenSeadragon
+and most slide viewers open directly; PNGs are written with zlib, no imaging library needed.
+
+    python cmr_preview.py all_components.gds preview --thumbnails --workers 4'''
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import math
+import os
+import struct
+import sys
+import zlib
+
+import numpy as np
+
+import cmr_raster
+from cmr_drc import _pack, _take, _tile_members
+from cmr_exposure import device_references, _top_cell
+from cmr_profile import stage
+
+layer_colors = {(1, 0): (230, 160, 20), (2, 0): (40, 90, 220)} #drawn in this order
+layer_opacity = 0.7
+background = (255, 255, 255)
+
+finest_pixel = 0.0625 #um
+tile_pixels = 256
+overview_pixels = 2048 #longest side of the overview
+thumbnail_pixels = 256
+
+#####################################################
+#                      PNG                          #
+#####################################################
+
+def _chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+def write_png(path, image):
+    '''Write an (rows, columns, 3) uint8 array as an 8-bit RGB PNG, row 0 at the top.'''
+    rows, columns = image.shape[:2]
+    scanlines = np.concatenate([np.zeros((rows, 1), dtype=np.uint8), image.reshape(rows, -1)], axis=1) #filter 0 per row
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(_chunk(b"IHDR", struct.pack(">IIBBBBB", columns, rows, 8, 2, 0, 0, 0)))
+        f.write(_chunk(b"IDAT", zlib.compress(scanlines.tobytes(), 1)))
+        f.write(_chunk(b"IEND", b""))
+
+#####################################################
+#                   Rendering                       #
+#####################################################
+
+def render(packed_layers, origin, pixel, shape):
+    '''RGB image of the packed (points, counts) layers on a raster of shape from origin, row 0 at the top.'''
+    image = np.empty(shape + (3,))
+    image[:] = background
+    for (points, counts), color in zip(packed_layers, layer_colors.values()):
+        coverage = cmr_raster.rasterize(points, counts, origin, pixel, shape)[::-1, :, None]*layer_opacity
+        image += (np.asarray(color, dtype=float) - image)*coverage
+    return np.rint(image).astype(np.uint8)
+
+def _render_tile(job):
+    #one tile of the pyramid, written to path; jobs come without polygons for empty tiles
+    path, origin, pixel, shape, packed_layers = job
+    write_png(path, render(packed_layers, origin, pixel, shape))
+    return path
+
+class _Layout:
+    '''The layers of a flattened mask, packed, with a spatial index per layer to pick the polygons under a tile.'''
+
+    def __init__(self, layout):
+        self.top = _top_cell(layout)
+        self.layers = [_pack([p.points for p in self.top.get_polygons(layer=layer, datatype=datatype)])
+                       for layer, datatype in layer_colors]
+        self.bbox = np.array(self.top.bounding_box() or ((0, 0), (0, 0)), dtype=float)
+
+    def under(self, boxes):
+        '''Per box, the (points, counts) of every layer under it, or None if all are empty.'''
+        members = [_tile_members(packed, boxes) for packed in self.layers]
+        for t in range(len(boxes)):
+            if any(len(indices[t]) for indices in members):
+                yield [_take(packed, indices[t]) for packed, indices in zip(self.layers, members)]
+            else:
+                yield None
+
+def load_layout(layout):
+    '''The flattened, indexed mask of a GDS path, gdstk.Cell or gf Component; load it once to render several outputs.'''
+    return layout if isinstance(layout, _Layout) else _Layout(layout)
+
+def render_box(layout, box, pixels):
+    '''RGB image of box ((x0, y0), (x1, y1)) with its longest side pixels long.'''
+    layout = load_layout(layout)
+    box = np.asarray(box, dtype=float)
+    pixel = max((box[1] - box[0]).max()/pixels, 1e-9)
+    shape = tuple(np.maximum(np.ceil((box[1] - box[0])[::-1]/pixel).astype(int), 1))
+    packed_layers = next(layout.under(box[None]))
+    if packed_layers is None:
+        packed_layers = [(np.zeros((0, 2)), np.zeros(0, dtype=int))]*len(layer_colors)
+    return render(packed_layers, box[0], pixel, shape)
+
+#####################################################
+#                    Outputs                        #
+#####################################################
+
+def write_overview(layout, path, pixels=None):
+    with stage("preview_overview"):
+        layout = load_layout(layout)
+        write_png(path, render_box(layout, layout.bbox, pixels or overview_pixels))
+    return path
+
+def write_thumbnails(layout, directory, pixels=None):
+    '''One PNG per device (cmr_exposure.device_references order) and thumbnails.json with their cells and boxes.'''
+    layout = load_layout(layout)
+    os.makedirs(directory, exist_ok=True)
+    index = []
+    with stage("preview_thumbnails"):
+        for i, (ref, offset) in enumerate(device_references(layout.top)):
+            box = np.array(ref.bounding_box()) + offset
+            name = f"device_{i:05d}.png"
+            write_png(os.path.join(directory, name), render_box(layout, box, pixels or thumbnail_pixels))
+            index.append({"index": i, "cell": ref.cell.name, "bbox": box.tolist(), "png": name})
+    with open(os.path.join(directory, "thumbnails.json"), "w") as f:
+        json.dump(index, f, indent=2)
+    return index
+
+def write_pyramid(layout, directory, name="mask", pixel=None, workers=1, levels=None):
+    '''Deep Zoom pyramid of the mask in directory: name.dzi and name_files/<level>/<column>_<row>.png.
+
+    The finest level has pixel um pixels. levels limits the output to the coarsest levels (all by default);
+    a viewer shows the deepest level written when zoomed further in. Returns the path of the .dzi.'''
+    layout = load_layout(layout)
+    pixel = pixel or finest_pixel
+    (x0, y0), (x1, y1) = layout.bbox
+    width, height = max(1, math.ceil((x1 - x0)/pixel)), max(1, math.ceil((y1 - y0)/pixel))
+    top_level = math.ceil(math.log2(max(width, height)))
+    last = top_level if levels is None else min(top_level, levels - 1)
+
+    def jobs():
+        for level in range(last + 1):
+            scale = 2**(top_level - level)
+            level_pixel = pixel*scale
+            columns, rows = math.ceil(width/scale), math.ceil(height/scale)
+            folder = os.path.join(directory, f"{name}_files", str(level))
+            os.makedirs(folder, exist_ok=True)
+            tiles = [(c, r) for r in range(math.ceil(rows/tile_pixels)) for c in range(math.ceil(columns/tile_pixels))]
+            boxes = []
+            for c, r in tiles: #image rows run down from the top of the mask
+                left, top = x0 + c*tile_pixels*level_pixel, y0 + height*pixel - r*tile_pixels*level_pixel
+                shape = (min(tile_pixels, rows - r*tile_pixels), min(tile_pixels, columns - c*tile_pixels))
+                boxes.append(((left, top - shape[0]*level_pixel), (left + shape[1]*level_pixel, top), shape))
+            corners = np.array([box[:2] for box in boxes])
+            for (c, r), (low, _, shape), packed_layers in zip(tiles, boxes, layout.under(corners)):
+                if packed_layers is not None:
+                    yield os.path.join(folder, f"{c}_{r}.png"), low, level_pixel, shape, packed_layers
+
+    os.makedirs(directory, exist_ok=True)
+    with stage("preview_pyramid"):
+        if workers == 1:
+            written = sum(1 for _ in map(_render_tile, jobs()))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                written = sum(1 for _ in executor.map(_render_tile, jobs(), chunksize=16))
+    dzi = os.path.join(directory, f"{name}.dzi")
+    with open(dzi, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{tile_pixels}" Overlap="0" Format="png">\n'
+                f'  <Size Width="{width}" Height="{height}"/>\n</Image>\n')
+    with open(os.path.join(directory, f"{name}.json"), "w") as f:
+        json.dump({"origin": [x0, y1], "finest_pixel_um": pixel, "levels": last + 1, "top_level": top_level,
+                   "tiles_written": written, "layers": {f"{l}/{d}": color for (l, d), color in layer_colors.items()}}, f, indent=2)
+    return dzi
+
+#####################################################
+#                     Main                          #
+#####################################################
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render a mask GDS to PNG: overview, zoomable tile pyramid and device thumbnails.")
+    parser.add_argument("gds")
+    parser.add_argument("directory")
+    parser.add_argument("--pixel", type=float, default=finest_pixel, help="pixel size of the finest pyramid level in um")
+    parser.add_argument("--levels", type=int, help="only write this many of the coarsest pyramid levels")
+    parser.add_argument("--no-pyramid", action="store_true", help="only write the overview (and thumbnails)")
+    parser.add_argument("--thumbnails", action="store_true", help="also write one thumbnail per device")
+    parser.add_argument("--workers", type=int, default=1, help="processes rendering pyramid tiles, 0 for one per core")
+    args = parser.parse_args(argv)
+
+    layout = load_layout(args.gds)
+    os.makedirs(args.directory, exist_ok=True)
+    print(write_overview(layout, os.path.join(args.directory, "overview.png")))
+    if args.thumbnails:
+        print(len(write_thumbnails(layout, os.path.join(args.directory, "thumbnails"))), "thumbnails")
+    if not args.no_pyramid:
+        print(write_pyramid(layout, args.directory, pixel=args.pixel, workers=args.workers or None, levels=args.levels))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,136 @@
+'''Optional per-stage timing and memory instrumentation for the CMR builders.
+
+The builders wrap their named stages (routing, unions, ellipse boolean, labels, grid, write_gds...) in
+`with stage("name"):`. While profiling is disabled stage() hands back one shared no-op context manager,
+so the instrumentation costs a function call per stage. Once enabled, every stage records its call
+count, inclusive and exclusive time and, with memory=True, the net traced allocation (tracemalloc).
+Nested stages are kept apart by their full stack, e.g. "biconvex_cmr;etch_window;ellipse_boolean".
+
+Only stages run in this process are recorded; devices built in sweep worker processes are not.
+
+    import cmr_profile
+    cmr_profile.enable(memory=True)
+    ...build...
+    cmr_profile.write_json("profile.json")          #per-stage report
+    cmr_profile.write_collapsed("profile.folded")   #input for flamegraph.pl / speedscope'''
+
+import contextlib
+import functools
+import json
+import time
+
+enabled = False
+_memory = False
+_stack = []
+_stats = {} #stack tuple -> [calls, inclusive seconds, allocated bytes]
+
+_disabled = contextlib.nullcontext()
+
+class _Stage:
+    __slots__ = ("path", "start", "allocated")
+
+    def __init__(self, name):
+        _stack.append(name)
+        self.path = tuple(_stack)
+
+    def __enter__(self):
+        self.allocated = _traced() if _memory else 0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        allocated = _traced() - self.allocated if _memory else 0
+        record = _stats.setdefault(self.path, [0, 0.0, 0])
+        record[0] += 1
+        record[1] += elapsed
+        record[2] += allocated
+        _stack.pop()
+        return False
+
+def _traced():
+    import tracemalloc
+    return tracemalloc.get_traced_memory()[0]
+
+def stage(name):
+    '''Context manager timing the stage `name`; a shared no-op while profiling is disabled.'''
+    if not enabled:
+        return _disabled
+    return _Stage(name)
+
+def profiled(name):
+    '''Decorator form of stage().'''
+    def decorator(function):
+        @functools.wraps(function) #keeps the signature the sweep specs are expanded against
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+#####################################################
+#                   Control                         #
+#####################################################
+
+def enable(memory=False):
+    global enabled, _memory
+    reset()
+    if memory:
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+    enabled, _memory = True, memory
+
+def disable():
+    global enabled, _memory
+    if _memory:
+        import tracemalloc
+        tracemalloc.stop()
+    enabled, _memory = False, False
+
+def reset():
+    _stats.clear()
+    _stack.clear()
+
+#####################################################
+#                   Reports                         #
+#####################################################
+
+def report():
+    '''Per-stage records, sorted by stack: calls, inclusive/exclusive seconds and allocated bytes.'''
+    children = {}
+    for path, (_, seconds, _) in _stats.items():
+        children[path[:-1]] = children.get(path[:-1], 0.0) + seconds
+    stages = []
+    for path in sorted(_stats):
+        calls, seconds, allocated = _stats[path]
+        stages.append({
+            "stack": ";".join(path),
+            "stage": path[-1],
+            "calls": calls,
+            "total_s": seconds,
+            "self_s": max(seconds - children.get(path, 0.0), 0.0),
+            "alloc_bytes": allocated if _memory else None,
+        })
+    return {"memory": _memory, "stages": stages}
+
+def totals():
+    '''Stage name -> summed calls and inclusive seconds over all stacks it appears in (outermost occurrence only).'''
+    summary = {}
+    for path, (calls, seconds, _) in _stats.items():
+        if path[-1] in path[:-1]:
+            continue #recursion would count the same time twice
+        entry = summary.setdefault(path[-1], {"calls": 0, "total_s": 0.0})
+        entry["calls"] += calls
+        entry["total_s"] += seconds
+    return summary
+
+def write_json(path):
+    with open(path, "w") as f:
+        json.dump(dict(report(), totals=totals()), f, indent=2)
+
+def write_collapsed(path):
+    '''Brendan Gregg's collapsed stack format, exclusive microseconds per stack.'''
+    with open(path, "w") as f:
+        for record in report()["stages"]:
+            f.write(f"{record['stack']} {round(record['self_s']*1e6)}\n")
@@ -0,0 +1,188 @@
+'''Analytic pre-screen of CMR designs: frequency, static capacitance and tether loss before any layout.
+
+Every metric is a closed-form NumPy expression of the builder parameters, so millions of candidates are
+scored at once and only the selected ones become sweep jobs:
+
+    frequency_mhz     f = v/lambda, lambda = 2*(electrode_width + electrode_separation) (the label's Period)
+                      and v the S0 plate velocity of the film stack, sqrt(sum E_i t_i c_i/sum rho_i t_i c_i)
+                      with plate moduli E/(1 - nu^2), the finger layer counted with coverage c = its
+                      metallization ratio (the other layers 1)
+    c0_ff             static capacitance of the IDT, (electrode_number/2)*electrode_length*Cs with the
+                      periodic-IDT capacitance per period Cs = eps0*(1 + eps_eff)*K(sin(pi eta/2))/K(cos(pi eta/2))
+                      and eps_eff = 1 + (eps_r - 1)*tanh(2 pi t/lambda) for a film of thickness t, thin against lambda
+    impedance_ohm     1/(2 pi f C0), to compare with the 50 ohm probes
+    tether_loss       share of the resonator's tethered edges clamped by the two tethers,
+                      2*(tether_width + 2*etch_buffer)/bus_length, the anchor loss rising with it
+    tether_mismatch   |cos(2 pi tether_length/lambda)|, 0 for a quarter-wave (odd multiple) tether
+
+These are first-order estimates (no dispersion, electrode mass only through the averages); use them to
+throw out clearly out-of-band variants, not to trim a design. A sweep family selects with "screen", the
+allowed [low, high] of any metric (null for no bound):
+
+    {"builder": "biconvex_cmr",
+     "grid": {"electrode_width": [0.1, 0.125, 0.15, 0.2, 0.25], "electrode_number": [20, 40, 60, 80]},
+     "screen": {"frequency_mhz": [8000, 12000], "impedance_ohm": [25, 200]}}
+
+    python cmr_screen.py default_sweep.json'''
+
+import argparse
+import inspect
+import math
+import sys
+
+import numpy as np
+
+#film stack: (name, thickness um, Young's modulus GPa, density kg/m^3, Poisson ratio)
+film_stack = [("Al", 0.1, 70.0, 2700.0, 0.35), ("AlN", 1.0, 345.0, 3260.0, 0.24)]
+finger_layer = "Al" #patterned into the IDT fingers
+piezo_layer = "AlN"
+relative_permittivity = 9.5 #of the piezo layer
+
+metrics = ("period_um", "frequency_mhz", "c0_ff", "impedance_ohm", "tether_loss", "tether_mismatch")
+parameters = ("electrode_number", "electrode_width", "electrode_separation", "tether_width")
+_constants = ("electrode_length", "etch_buffer", "tether_length")
+
+#####################################################
+#                     Model                         #
+#####################################################
+
+def _ellipk(k):
+    #complete elliptic integral of the first kind K(k) (modulus k) by the arithmetic-geometric mean
+    a, b = np.ones_like(k), np.sqrt(1 - k**2)
+    for _ in range(8): #quadratic convergence, double precision after 5 steps for k < 1 - 1e-12
+        a, b = (a + b)/2, np.sqrt(a*b)
+    return math.pi/(2*a)
+
+def plate_velocity(eta):
+    '''S0 plate velocity (m/s) of the film stack with the finger layer covering eta of the surface.'''
+    stiffness, mass = 0.0, 0.0
+    for name, thickness, modulus, density, poisson in film_stack:
+        coverage = eta if name == finger_layer else 1.0
+        stiffness = stiffness + modulus*1e9/(1 - poisson**2)*thickness*coverage
+        mass = mass + density*thickness*coverage
+    return np.sqrt(stiffness/mass)
+
+def evaluate(electrode_number, electrode_width, electrode_separation, tether_width,
+             electrode_length, etch_buffer, tether_length):
+    '''Every metric for the parameters given (arrays broadcast against each other, lengths in um).
+
+    Returns {metric: array} in the broadcast shape of the inputs.'''
+    electrode_number, electrode_width, electrode_separation, tether_width = np.broadcast_arrays(
+        *(np.asarray(value, dtype=float) for value in (electrode_number, electrode_width, electrode_separation, tether_width)))
+    pitch = electrode_width + electrode_separation
+    wavelength = 2*pitch
+    eta = electrode_width/pitch
+    frequency = plate_velocity(eta)/(wavelength*1e-6)
+
+    thickness = sum(layer[1] for layer in film_stack if layer[0] == piezo_layer)
+    permittivity = 1 + (relative_permittivity - 1)*np.tanh(2*math.pi*thickness/wavelength)
+    per_period = 8.8541878128e-12*(1 + permittivity)*_ellipk(np.sin(math.pi*eta/2))/_ellipk(np.cos(math.pi*eta/2)) #F/m
+    c0 = electrode_number/2*electrode_length*1e-6*per_period
+
+    bus_length = electrode_number*pitch - electrode_separation
+    return {
+        "period_um": wavelength,
+        "frequency_mhz": frequency/1e6,
+        "c0_ff": c0*1e15,
+        "impedance_ohm": 1/(2*math.pi*frequency*c0),
+        "tether_loss": np.minimum(2*(tether_width + 2*etch_buffer)/bus_length, 1.0),
+        "tether_mismatch": np.abs(np.cos(2*math.pi*tether_length/wavelength)),
+    }
+
+def select(scores, criteria):
+    '''Boolean array of the candidates whose metrics all lie in criteria {metric: (low, high)}, None for no bound.
+
+    A NaN metric is not screened and passes: screen_jobs gives NaN to devices without electrodes (undercut
+    rings), which are test structures a frequency band says nothing about.'''
+    unknown = set(criteria) - set(metrics)
+    if unknown:
+        raise ValueError(f"unknown screen metrics {sorted(unknown)}, expected some of {list(metrics)}")
+    keep = np.ones(np.shape(scores[metrics[0]]), dtype=bool)
+    for metric, (low, high) in criteria.items():
+        values = scores[metric]
+        unscored = np.isnan(values)
+        if low is not None:
+            keep &= unscored | (values >= low)
+        if high is not None:
+            keep &= unscored | (values <= high)
+    return keep
+
+#####################################################
+#                 Sweep screening                   #
+#####################################################
+
+def _value(name, point, builder, namespace):
+    #a parameter as the sweep would pass it: fixed or swept value, builder default, else module global
+    if name in point:
+        value = point[name]
+        return namespace.get(value, value) if isinstance(value, str) else value
+    default = inspect.signature(builder).parameters[name].default
+    return namespace[name] if default is inspect.Parameter.empty else default
+
+def screened_points(builder, params, grid, criteria, cmr):
+    '''The grid points (tuples of axis values, outermost axis first) of a sweep family that pass the screen.
+
+    The grid is scored as one broadcast array; only the kept points are expanded.'''
+    function = cmr.builders[builder]
+    namespace = vars(cmr)
+    missing = [name for name in parameters if name not in inspect.signature(function).parameters]
+    if missing:
+        raise ValueError(f"{builder} has no {missing}, it cannot be screened")
+    axes = list(grid)
+    shape = tuple(len(values) for values in grid.values())
+    values = {}
+    for name in parameters:
+        if name in grid:
+            column = [_value(name, {name: v}, function, namespace) for v in grid[name]]
+            values[name] = np.reshape(np.asarray(column, dtype=float), [-1 if axis == name else 1 for axis in axes])
+        else:
+            values[name] = _value(name, params, function, namespace)
+    scores = evaluate(**values, **{name: namespace[name] for name in _constants})
+    keep = np.broadcast_to(select(scores, criteria), shape)
+    return [tuple(grid[axis][i] for axis, i in zip(axes, point)) for point in np.argwhere(keep).tolist()] #itertools.product order
+
+def screen_jobs(jobs, cmr):
+    '''Metrics of (builder name, args) jobs as {metric: array}, NaN for builders without electrodes.'''
+    columns = {name: np.full(len(jobs), np.nan) for name in parameters}
+    for i, (builder, args) in enumerate(jobs):
+        names = list(inspect.signature(cmr.builders[builder]).parameters)
+        if all(name in names for name in parameters):
+            for name in parameters:
+                columns[name][i] = args[names.index(name)]
+    return evaluate(**columns, **{name: getattr(cmr, name) for name in _constants})
+
+#####################################################
+#                     Main                          #
+#####################################################
+
+def main(argv=None):
+    import time
+    import All_components_CMR as cmr
+    import cmr_sweep
+
+    parser = argparse.ArgumentParser(description="Score the devices of a sweep spec with the analytic CMR model.")
+    parser.add_argument("spec", nargs="?", default=cmr.sweep_spec, help="sweep spec file (.json, .toml or .yaml)")
+    parser.add_argument("--candidates", type=int, metavar="N",
+                        help="also time scoring N random candidates (electrode number, width, gap and tether width)")
+    args = parser.parse_args(argv)
+
+    spec = cmr_sweep.load_spec(args.spec)
+    jobs = cmr_sweep.expand_spec(spec, cmr)
+    scores = screen_jobs(jobs, cmr)
+    print(f"{len(jobs)} devices after screening")
+    print(f"{'builder':14}" + "".join(f"{metric:>17}" for metric in metrics))
+    for i, (builder, _) in enumerate(jobs):
+        print(f"{builder:14}" + "".join(f"{scores[metric][i]:17.4g}" for metric in metrics))
+
+    if args.candidates:
+        rng = np.random.default_rng(0)
+        n = args.candidates
+        start = time.perf_counter()
+        scores = evaluate(2*rng.integers(5, 100, n), rng.uniform(0.1, 2, n), rng.uniform(0.1, 2, n), rng.uniform(1, 20, n),
+                          cmr.electrode_length, cmr.etch_buffer, cmr.tether_length)
+        elapsed = time.perf_counter() - start
+        print(f"{n} candidates scored in {elapsed:.3f} s, {np.median(scores['frequency_mhz']):.0f} MHz median")
+    return scores
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
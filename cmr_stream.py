@@ -0,0 +1,201 @@
+'''Streaming mask writer: bounded memory for wafer-scale sweeps.
+
+assemble_mask() keeps every device, the grid and the mask in memory until write_gds. Here each device
+is written to the GDS stream (gdstk.GdsWriter) as soon as it is built and then dropped; only its top
+cell name and bounding box are kept. Cells are renamed after their contents first (see cmr_parallel),
+so cells shared between devices are written once. When all devices are out, the placement (the grid
+gf.grid would compute, or the write field packing) is derived from the bounding boxes and the top cell,
+holding one reference per device plus the alignment markers, is written last.
+
+    import All_components_CMR as cmr, cmr_stream
+    cmr_stream.write_mask_streaming(cmr.default_sweep(), "all_components.gds")
+
+With workers != 1 or a cache_dir the devices are built into GDS fragments as in build_sweep and the
+fragments are streamed into the mask one at a time. With device_backend = "direct" they are written from
+NumPy arrays instead (cmr_direct).'''
+
+import math
+import os
+import tempfile
+
+import numpy as np
+import gdstk
+
+import cmr_parallel
+from cmr_profile import stage
+
+clear_cache_every = 256 #devices between gf.clear_cache() calls, which keeps gdsfactory's cell cache bounded
+
+#####################################################
+#                 Grid placement                    #
+#####################################################
+
+def grid_shape(n, shape=None):
+    '''(rows, columns) of a gf.grid of n components in shape, resolving a -1. Raises ValueError like gf.grid if
+    the shape cannot hold them, so a sweep can be checked before any device is built.'''
+    if shape is None:
+        shape = (n, 1)
+    rows, columns = shape
+    if rows == -1:
+        rows = math.ceil(n/columns)
+    elif columns == -1:
+        columns = math.ceil(n/rows)
+    if rows*columns < n:
+        raise ValueError(f"Shape {shape} is too small for all {n} components")
+    return rows, columns
+
+def _snap(values):
+    #gf.snap.snap_to_grid: gdsfactory reads reference bounding boxes and moves groups on the 1 nm grid
+    return np.round(np.asarray(values, dtype=float)*1e3)/1e3
+
+def grid_offsets(bboxes, shape=None, spacing=(5.0, 5.0)):
+    '''Translation of every device that gf.grid(separation=True, align_x="x", align_y="y") would apply.
+
+    bboxes is a sequence of ((xmin, ymin), (xmax, ymax)) in device order, shape is (rows, columns) as in
+    gf.grid (one of them may be -1). Returns an (n, 2) array. The moves are made in gf.grid's order from
+    bounding boxes snapped to 1 nm as gdsfactory reads them, so the offsets are the same floats gf.grid gives
+    its references, not merely close to them.'''
+    n = len(bboxes)
+    rows, columns = grid_shape(n, shape)
+
+    raw = np.zeros((rows*columns, 2, 2))
+    raw[:n] = np.asarray(bboxes, dtype=float).reshape(n, 2, 2)
+    raw = raw.reshape(rows, columns, 2, 2)
+    filled = (np.arange(rows*columns) < n).reshape(rows, columns, 1, 1)
+    offsets = np.zeros((rows, columns, 2))
+    def boxes(): #empty grid slots are gf's empty dummies, whose bounding box stays ((0, 0), (0, 0)) wherever they move
+        return np.where(filled, _snap(raw + offsets[:, :, None, :]), 0.0)
+
+    for axis, group in ((1, 1), (0, 0)): #centre every element on its row (y), then on its column (x)
+        box = boxes()
+        center = (box[..., 0, axis].min(axis=group, keepdims=True) + box[..., 1, axis].max(axis=group, keepdims=True))/2
+        offsets[..., axis] += center - (box[..., 0, axis] + box[..., 1, axis])/2
+    for axis, group in ((0, 0), (1, 1)): #stack the columns left to right, then the rows from the last one upwards
+        box = boxes()
+        lo, hi = box[..., 0, axis].min(axis=group), box[..., 1, axis].max(axis=group)
+        if axis == 1:
+            lo, hi = lo[::-1], hi[::-1]
+        positions = np.cumsum(np.concatenate(([lo[0]], spacing[axis] + (hi - lo))))[:len(lo)]
+        moves = _snap(positions) - lo
+        if axis == 1:
+            moves = moves[::-1]
+        offsets[..., axis] += moves[None, :] if axis == 0 else moves[:, None]
+    return offsets.reshape(-1, 2)[:n]
+
+#####################################################
+#                 Device sources                    #
+#####################################################
+
+def _built_devices(jobs, cmr):
+    for i, (builder, args) in enumerate(jobs):
+        if i and i % clear_cache_every == 0:
+            cmr_parallel.clear_gf_cache(cmr.gf)
+        device = cmr.builders[builder](*args)
+        cells = cmr_parallel.content_rename(device._cell)
+        yield cells[-1], cells
+        del device, cells
+
+def _fragment_devices(paths):
+    for path in paths:
+        fragment = gdstk.read_gds(path)
+        yield fragment.top_level()[0], fragment.cells
+        del fragment
+
+#####################################################
+#                 Streaming writer                  #
+#####################################################
+
+def stream_devices(devices, gdspath, placement, markers=(), field_markers=None, top_name="all_components"):
+    '''Write (top cell, cells) pairs to gdspath as they come, then a top cell placing the tops.
+
+    placement(bboxes) returns the offset of every device and the order to reference them in. markers is a sequence of (cell, origin, columns, rows, spacing) referenced in the top cell as well, and
+    field_markers(bbox) returns more of them once the bounding box of the placed devices is known. Returns gdspath.
+
+    cells holds the cells to write for a top (a cell of it may be a gdstk.RawCell); only those reached from the top
+    through cells that are not out yet are written. A subcell of a cell already written (same name, same content)
+    would otherwise end up in the file as an extra top-level cell.'''
+    partial = f"{gdspath}.{os.getpid()}.tmp"
+    writer = gdstk.GdsWriter(partial, unit=1e-6, precision=1e-9, max_points=cmr_parallel.max_points)
+    written = set()
+    def write(top, cells):
+        fresh, pending = set(), [top]
+        while pending:
+            cell = pending.pop()
+            if cell.name in written or cell.name in fresh: #same name means same content
+                continue
+            fresh.add(cell.name)
+            pending += [ref.cell for ref in cell.references if not isinstance(ref.cell, str)]
+        for cell in cells:
+            if cell.name in fresh:
+                fresh.discard(cell.name)
+                written.add(cell.name)
+                writer.write(cell)
+
+    try:
+        names, bboxes = [], []
+        for top, cells in devices:
+            write(top, cells)
+            names.append(top.name)
+            bboxes.append(top.bounding_box() or ((0, 0), (0, 0)))
+
+        mask = gdstk.Cell(top_name)
+        offsets, order = placement(bboxes)
+        for i in order:
+            mask.add(gdstk.Reference(names[i], origin=tuple(offsets[i])))
+        if field_markers is not None and names:
+            placed = np.asarray(bboxes, dtype=float) + offsets[:, None, :]
+            markers = list(markers) + list(field_markers((placed[:, 0].min(axis=0), placed[:, 1].max(axis=0))))
+        for cell, origin, columns, rows, marker_spacing in markers:
+            write(cell, cmr_parallel.content_rename(cell))
+            mask.add(gdstk.Reference(cell.name, origin=origin, columns=columns, rows=rows, spacing=marker_spacing))
+        writer.write(mask)
+        writer.close()
+        os.replace(partial, gdspath)
+    finally:
+        if os.path.exists(partial): #the build failed half way
+            writer.close()
+            os.remove(partial)
+    return gdspath
+
+def mask_layout(cmr, jobs=None):
+    '''The stream_devices placement, markers and field_markers that reproduce assemble_mask(devices, jobs) under cmr's settings.'''
+    def placed(marker, x, y): #marker cells are built around (originx, originy)
+        return (cmr.marker_library[marker]()._cell, (x - cmr.originx, y - cmr.originy))
+
+    markers = [placed("global", x, y) + (1, 1, (0, 0)) for x, y in cmr.mask_markers]
+    def field_markers(bbox):
+        if cmr.write_field is None:
+            return []
+        arrays = cmr.write_field_marker_arrays(bbox, cmr.write_field, cmr.local_marker_inset)
+        return [placed("local", x, y) + (columns, rows, spacing) for (x, y), columns, rows, spacing in arrays]
+    def placement(bboxes):
+        if cmr.mask_placement == "fields":
+            offsets, fields = cmr.field_offsets(bboxes, None if jobs is None else cmr.device_cores(jobs))
+            return offsets, np.argsort(fields, kind="stable")
+        return grid_offsets(bboxes, cmr.mask_grid_shape, cmr.mask_grid_spacing), range(len(bboxes))
+    return dict(placement=placement, markers=markers, field_markers=field_markers)
+
+def write_mask_streaming(jobs, gdspath, workers=1, cache_dir=None, cmr=None, top_name="all_components"):
+    '''Build the sweep `jobs` and stream the assembled mask (grid and alignment markers as in assemble_mask) to gdspath.'''
+    if cmr is None:
+        import All_components_CMR as cmr
+
+    layout = dict(mask_layout(cmr, jobs), top_name=top_name)
+    if cmr.mask_placement == "fields": #fail before building, not once every device is out
+        cmr.check_field_fit(jobs)
+    else:
+        grid_shape(len(jobs), cmr.mask_grid_shape)
+    with stage("stream_mask"):
+        if cmr.device_backend == "direct":
+            import cmr_direct
+            return stream_devices(cmr_direct.direct_devices(jobs, cmr), gdspath, **layout)
+        if cache_dir is not None:
+            import cmr_sweep
+            paths = cmr_sweep.build_fragments_cached(jobs, cache_dir, max_workers=workers, settings=cmr.build_settings())
+            return stream_devices(_fragment_devices(paths), gdspath, **layout)
+        if workers == 1:
+            return stream_devices(_built_devices(jobs, cmr), gdspath, **layout)
+        with tempfile.TemporaryDirectory(prefix="cmr_sweep_") as tmp:
+            paths = [os.path.join(tmp, f"device_{i:06d}.gds") for i in range(len(jobs))]
+            cmr_parallel.build_fragments(jobs, paths, max_workers=workers, settings=cmr.build_settings())
+            return stream_devices(_fragment_devices(paths), gdspath, **layout)
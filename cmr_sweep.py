@@ -0,0 +1,150 @@
+'''Declarative sweep specifications and incremental, on-disk cached sweep builds.
+
+A spec file (JSON, TOML or YAML) lists device families, each a builder with fixed parameters and a
+parameter grid, plus optional overrides of the global dimensions:
+
+    {
+      "constants": {"electrode_number": 40},
+      "families": [
+        {"builder": "biconvex_cmr",
+         "params": {"undercut": true},
+         "grid": {"k": [0.5, 1, 1.5], "tether_width": [1.25, 2.5, "bus_length"]}}
+      ]
+    }
+
+Grid axes are expanded in the order they are written, the first one outermost. A family with a
+"screen" only keeps the grid points whose analytic metrics (cmr_screen.py) fall in the given ranges. Parameters that are
+neither fixed nor swept take the module global of the same name (destinationx/y default to the origin),
+and any string value naming a module global (e.g. "bus_length") is replaced by that global.
+
+Each device is written to <cache_dir>/<digest>.gds, where the digest covers the builder, its arguments,
+the global dimensions/settings and the source of the builder modules. Rebuilding a sweep only builds
+the devices whose fragment is missing.'''
+
+import hashlib
+import inspect
+import itertools
+import json
+import os
+
+from cmr_cache import cell_key, key_digest
+import cmr_parallel
+
+#####################################################
+#                  Spec files                       #
+#####################################################
+
+def load_spec(path):
+    '''Read a sweep spec from a .json, .toml or .yaml/.yml file.'''
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix == ".json":
+        with open(path) as f:
+            return json.load(f)
+    if suffix == ".toml":
+        import tomllib
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    if suffix in (".yaml", ".yml"):
+        import yaml
+        with open(path) as f:
+            return yaml.safe_load(f)
+    raise ValueError(f"unknown sweep spec format {suffix!r}, use .json, .toml or .yaml")
+
+def _resolve(value, namespace):
+    if isinstance(value, str) and value in namespace:
+        return namespace[value]
+    return value
+
+def expand_family(family, cmr):
+    '''Turn one spec family into (builder name, args) jobs for the builders of module `cmr`.'''
+    builder = family["builder"]
+    if builder not in cmr.builders:
+        raise ValueError(f"unknown builder {builder!r}, expected one of {sorted(cmr.builders)}")
+    namespace = vars(cmr)
+    parameters = inspect.signature(cmr.builders[builder]).parameters
+    params = dict(family.get("params", {}))
+    grid = family.get("grid", {})
+    unknown = (set(params) | set(grid)) - set(parameters)
+    if unknown:
+        raise ValueError(f"{builder} has no parameters {sorted(unknown)}")
+
+    points = itertools.product(*grid.values())
+    if family.get("screen"): #score the grid analytically and expand only the points that pass
+        import cmr_screen
+        points = cmr_screen.screened_points(builder, params, grid, family["screen"], cmr)
+
+    jobs = []
+    for values in points:
+        point = dict(params, **dict(zip(grid, values)))
+        args = []
+        for name, parameter in parameters.items():
+            if name in point:
+                args.append(_resolve(point[name], namespace))
+            elif parameter.default is not inspect.Parameter.empty:
+                args.append(parameter.default)
+            elif name in ("destinationx", "destinationy"):
+                args.append(namespace["originx" if name == "destinationx" else "originy"])
+            elif name in namespace:
+                args.append(namespace[name])
+            else:
+                raise ValueError(f"no value for {builder} parameter {name!r}")
+        jobs.append((builder, tuple(args)))
+    return jobs
+
+def expand_spec(spec, cmr):
+    '''Apply the spec's constant overrides to module `cmr` and return the jobs of all its families.'''
+    if spec.get("constants"):
+        cmr.set_constants(**spec["constants"])
+    return [job for family in spec["families"] for job in expand_family(family, cmr)]
+
+def load_sweep(path, cmr):
+    return expand_spec(load_spec(path), cmr)
+
+#####################################################
+#              Incremental cached build             #
+#####################################################
+
+_source_modules = ("All_components_CMR.py", "cmr_geometry.py", "cmr_cache.py")
+
+def source_digest():
+    '''Hash of the builder sources, so editing a builder invalidates every cached device.'''
+    h = hashlib.sha256()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in _source_modules:
+        with open(os.path.join(here, name), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+def device_digest(job, settings, source=None):
+    builder, args = job
+    return key_digest(cell_key(builder, args, (sorted(settings.items()), source or source_digest())), length=24)
+
+def fragment_paths(jobs, cache_dir, settings):
+    source = source_digest()
+    return [os.path.join(cache_dir, f"{device_digest(job, settings, source)}.gds") for job in jobs]
+
+def stale_jobs(jobs, cache_dir, settings):
+    '''Indices of the jobs whose device is not in the cache yet.'''
+    return [i for i, path in enumerate(fragment_paths(jobs, cache_dir, settings)) if not os.path.exists(path)]
+
+def build_fragments_cached(jobs, cache_dir, max_workers=1, settings=None):
+    '''Build only the devices missing from cache_dir. Returns the fragment path of every job, in job order.'''
+    settings = settings or {}
+    os.makedirs(cache_dir, exist_ok=True)
+    paths = fragment_paths(jobs, cache_dir, settings)
+
+    stale = {}
+    for job, path in zip(jobs, paths): #a device repeated in the sweep is built once
+        if not os.path.exists(path):
+            stale[path] = job
+    if stale:
+        cmr_parallel.build_fragments(list(stale.values()), list(stale), max_workers=max_workers, settings=settings)
+    return paths
+
+def build_sweep_cached(jobs, cache_dir, max_workers=1, settings=None):
+    '''Build only the devices missing from cache_dir, then load the whole sweep in job order.'''
+    paths = build_fragments_cached(jobs, cache_dir, max_workers, settings)
+    merged = os.path.join(cache_dir, f"sweep_{key_digest(tuple(paths))}.gds")
+    if not os.path.exists(merged):
+        cmr_parallel.merge_fragments(paths, merged)
+    return cmr_parallel.load_devices(merged)
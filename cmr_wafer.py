@@ -0,0 +1,252 @@
+'''Wafer stepping: the die (the assembled mask) repeated across a wafer with GDS array references.
+
+Every die type is built once, streamed like a single die (cmr_stream) and its cells copied into the wafer
+GDS verbatim; devices shared between die types are written once, as their cells have the same names. The
+wafer top cell then places the default die with one array reference per run of consecutive sites in a
+row, and the other dies by single references, so a 100-die wafer holds the same cells as one die plus a
+few dozen references. Sites are the pitch grid (die size plus street) centred on the wafer, kept when the
+die lies inside the edge exclusion and above the flat.
+
+A wafer spec (JSON, TOML or YAML) names die types and assigns them to sites, keyed "column,row" from
+the bottom left site (python cmr_wafer.py wafer.json --map prints them):
+
+    {
+      "wafer": {"diameter": 100000, "edge_exclusion": 3000, "street": 200},
+      "dies": {"default": "default_sweep.json",
+               "dose_test": {"spec": "default_sweep.json", "datatype": 5}},
+      "sites": {"4,0": "dose_test", "4,8": "dose_test", "0,4": null}
+    }
+
+A die type is a sweep spec, relative to the wafer spec; "datatype" moves all its polygons to that
+datatype (a separate dose class, see cmr_pec), null leaves a site empty. Without "dies" every site gets
+the sweep of All_components_CMR.sweep_spec.
+
+    python cmr_wafer.py wafer.json wafer.gds --workers 4'''
+
+import argparse
+import math
+import os
+import sys
+import tempfile
+
+import numpy as np
+import gdstk
+
+import cmr_parallel
+import cmr_stream
+from cmr_profile import stage
+
+wafer_diameter = 100000.0 #um, 100 mm
+edge_exclusion = 3000.0 #um, no die closer to the wafer edge
+flat_length = 32500.0 #um, primary flat of a 100 mm wafer, 0 for none
+street = 200.0 #um between neighbouring dies, for dicing
+outline_layer = (99, 0) #wafer outline, not exposed
+
+#####################################################
+#                   Wafer map                       #
+#####################################################
+
+def _geometry(wafer):
+    #diameter, edge exclusion, flat and street of the "wafer" section of a spec, module defaults for what it leaves out
+    wafer = wafer or {}
+    return (wafer.get("diameter", wafer_diameter), wafer.get("edge_exclusion", edge_exclusion),
+            wafer.get("flat", flat_length), wafer.get("street", street))
+
+def _flat_y(diameter, flat):
+    #height of the flat below the wafer centre
+    radius = diameter/2
+    return -math.sqrt(radius**2 - (flat/2)**2) if flat else -radius
+
+def wafer_outline(wafer=None):
+    '''The wafer as a gdstk polygon on outline_layer, centred on the origin, flat at the bottom. wafer is the
+    "wafer" section of a spec, the module settings filling in what it leaves out.'''
+    diameter, _, flat, _ = _geometry(wafer)
+    radius = diameter/2
+    disc = gdstk.ellipse((0, 0), radius, tolerance=radius*1e-5, layer=outline_layer[0], datatype=outline_layer[1])
+    if not flat:
+        return [disc]
+    cut = gdstk.rectangle((-radius, -radius), (radius, _flat_y(diameter, flat)))
+    return gdstk.boolean(disc, cut, "not", layer=outline_layer[0], datatype=outline_layer[1])
+
+def die_sites(pitch, wafer=None):
+    '''Centre of every die site, {"column,row": (x, y)} in row order from the bottom left.
+
+    Sites are the pitch grid centred on the wafer, kept when a whole pitch cell (die plus half the street
+    around it) fits inside the edge exclusion and above the flat. wafer as in wafer_outline.'''
+    diameter, exclusion, flat, _ = _geometry(wafer)
+    radius = diameter/2 - exclusion
+    bottom = _flat_y(diameter, flat) + exclusion
+    px, py = pitch
+    columns, rows = int(2*radius//px), int(2*radius//py)
+    x = (np.arange(columns) - (columns - 1)/2)*px
+    y = (np.arange(rows) - (rows - 1)/2)*py
+    centres = np.stack(np.meshgrid(x, y), axis=-1) #(rows, columns, 2)
+    far = np.hypot(np.abs(centres[..., 0]) + px/2, np.abs(centres[..., 1]) + py/2) #farthest corner of each cell
+    inside = (far <= radius) & (centres[..., 1] - py/2 >= bottom)
+    used_rows, used_columns = np.flatnonzero(inside.any(axis=1)), np.flatnonzero(inside.any(axis=0))
+    if not len(used_rows):
+        return {}
+    return {f"{c - used_columns[0]},{r - used_rows[0]}": tuple(centres[r, c].tolist())
+            for r, c in zip(*np.nonzero(inside))}
+
+def wafer_map(assignment):
+    '''Text map of the sites {"column,row": die type}, one character per site: "o" for the default die, the
+    first letter of any other die type, "." for empty sites; the bottom row last.'''
+    keys = [tuple(map(int, key.split(","))) for key in assignment]
+    columns, rows = max(c for c, _ in keys) + 1, max(r for _, r in keys) + 1
+    lines = [[" "]*columns for _ in range(rows)]
+    for (c, r), die in zip(keys, assignment.values()):
+        lines[r][c] = "o" if die == "default" else die[0] if die else "."
+    return "\n".join("".join(line).rstrip() for line in reversed(lines))
+
+def _runs(keys):
+    #(first key, length) of every run of consecutive columns in a row, keys in row order
+    runs = []
+    for key in keys:
+        c, r = map(int, key.split(","))
+        if runs and runs[-1][2] == r and runs[-1][1] + runs[-1][3] == c:
+            runs[-1][3] += 1
+        else:
+            runs.append([key, c, r, 1])
+    return [(key, length) for key, _, _, length in runs]
+
+#####################################################
+#                  Die types                        #
+#####################################################
+
+def _die_types(spec, spec_dir, cmr):
+    #{name: (sweep spec path, datatype or None)}
+    dies = spec.get("dies") or {"default": cmr.sweep_spec}
+    types = {}
+    for name, die in dies.items():
+        die = {"spec": die} if isinstance(die, str) else dict(die)
+        types[name] = (os.path.join(spec_dir, die["spec"]), die.get("datatype"))
+    if "default" not in types:
+        raise ValueError("the wafer spec needs a 'default' die type")
+    return types
+
+def _build_die(name, sweep_path, path, workers, cache_dir, cmr):
+    #stream the die to path and put the module globals its sweep spec overrides back afterwards
+    import cmr_sweep
+    sweep = cmr_sweep.load_spec(sweep_path)
+    saved = {constant: getattr(cmr, constant) for constant in sweep.get("constants", {})}
+    try:
+        cmr_stream.write_mask_streaming(cmr_sweep.expand_spec(sweep, cmr), path, workers, cache_dir, cmr, top_name=f"die_{name}")
+    finally:
+        if saved:
+            cmr.set_constants(**saved)
+    return path
+
+def _die_cells(path, datatype):
+    '''The cells of a die GDS, children first, and its top cell. With datatype, copies on that datatype under new names.'''
+    top = gdstk.read_gds(path).top_level()[0]
+    cells = cmr_parallel._ordered_cells(top)
+    if datatype is None:
+        raw = gdstk.read_rawcells(path) #copied verbatim
+        return [raw[cell.name] for cell in cells], top
+    for cell in cells:
+        for polygon in cell.polygons:
+            polygon.datatype = datatype
+        cell.name = f"{cell.name}_dt{datatype}"
+    return cells, top
+
+#####################################################
+#                    Wafer                          #
+#####################################################
+
+def write_wafer(spec, gdspath, workers=1, cache_dir=None, cmr=None, top_name="wafer"):
+    '''Build the die types of the wafer spec (a path or a dict) and write the stepped wafer to gdspath.
+
+    Returns {"pitch", "sites": {key: die type or None}, "dies": {die type: count}}.'''
+    import cmr_sweep
+    if cmr is None:
+        import All_components_CMR as cmr
+    spec_dir = os.path.dirname(os.path.abspath(spec)) if isinstance(spec, str) else os.getcwd()
+    spec = cmr_sweep.load_spec(spec) if isinstance(spec, str) else spec
+    wafer = spec.get("wafer", {})
+    types = _die_types(spec, spec_dir, cmr)
+    overrides = spec.get("sites", {})
+    missing = {die for die in overrides.values() if die is not None} - set(types)
+    if missing:
+        raise ValueError(f"unknown die types {sorted(missing)}")
+
+    with tempfile.TemporaryDirectory(prefix="cmr_wafer_") as tmp:
+        dies = {}
+        for name, (sweep_path, datatype) in types.items():
+            with stage("wafer_die"):
+                dies[name] = _die_cells(_build_die(name, sweep_path, os.path.join(tmp, f"{name}.gds"), workers, cache_dir, cmr), datatype)
+        tops = {name: (top.name, np.array(top.bounding_box() or ((0, 0), (0, 0)), dtype=float)) for name, (_, top) in dies.items()}
+
+        #the sites depend on the die size, but are checked before anything is written
+        sizes = {name: box[1] - box[0] for name, (_, box) in tops.items()}
+        pitch = tuple((sizes["default"] + _geometry(wafer)[3]).tolist())
+        for name, size in sizes.items():
+            if np.any(size > sizes["default"] + 1e-6):
+                raise ValueError(f"die {name!r} ({size[0]:.0f} x {size[1]:.0f} um) is larger than the default die")
+        sites = die_sites(pitch, wafer)
+        unknown = [key for key in overrides if key not in sites]
+        if unknown:
+            raise ValueError(f"no die sites {unknown} on this wafer, whose sites are (column 0 left, row 0 at the bottom):\n"
+                             + wafer_map(dict.fromkeys(sites, "default")))
+        assignment = {key: overrides.get(key, "default") for key in sites}
+
+        partial = f"{gdspath}.{os.getpid()}.tmp"
+        writer = gdstk.GdsWriter(partial, unit=1e-6, precision=1e-9, max_points=cmr_parallel.max_points)
+        try:
+            written = set()
+            for cells, _ in dies.values():
+                for cell in cells:
+                    if cell.name not in written: #same name means same content
+                        written.add(cell.name)
+                        writer.write(cell)
+            with stage("wafer_top"):
+                outline = gdstk.Cell("wafer_outline")
+                outline.add(*wafer_outline(wafer))
+                writer.write(outline)
+                mask = gdstk.Cell(top_name)
+                mask.add(gdstk.Reference(outline))
+                def origin(name, key): #die bounding box centred on the site
+                    (x0, y0), (x1, y1) = tops[name][1]
+                    x, y = sites[key]
+                    return (x - (x0 + x1)/2, y - (y0 + y1)/2)
+                defaults = [key for key in sites if assignment[key] == "default"]
+                for key, length in _runs(defaults):
+                    mask.add(gdstk.Reference(tops["default"][0], origin=origin("default", key), columns=length, rows=1, spacing=pitch))
+                for key in sites:
+                    if assignment[key] not in (None, "default"):
+                        mask.add(gdstk.Reference(tops[assignment[key]][0], origin=origin(assignment[key], key)))
+                writer.write(mask)
+            writer.close()
+            os.replace(partial, gdspath)
+        finally:
+            if os.path.exists(partial): #failed half way
+                writer.close()
+                os.remove(partial)
+    counts = {}
+    for die in assignment.values():
+        if die is not None:
+            counts[die] = counts.get(die, 0) + 1
+    return {"pitch": pitch, "sites": assignment, "dies": counts}
+
+#####################################################
+#                     Main                          #
+#####################################################
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Step the CMR die across a wafer with array references.")
+    parser.add_argument("spec", help="wafer spec file (.json, .toml or .yaml)")
+    parser.add_argument("out", nargs="?", default="wafer.gds", help="output GDS path")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes building each die, 0 for one per core")
+    parser.add_argument("--cache-dir", help="reuse per-device GDS fragments from this directory")
+    parser.add_argument("--map", action="store_true", help="print the wafer map with the site keys")
+    args = parser.parse_args(argv)
+
+    summary = write_wafer(args.spec, args.out, args.workers or None, args.cache_dir)
+    print(f"{args.out}: pitch {summary['pitch'][0]:.0f} x {summary['pitch'][1]:.0f} um, "
+          + ", ".join(f"{count} {die}" for die, count in summary["dies"].items()))
+    if args.map:
+        print(wafer_map(summary["sites"]))
+    return summary
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,20 @@
+'''Screening a sweep that mixes CMRs with undercut rings, which have no electrodes to score.
+
+    python -m pytest test_cmr_screen.py'''
+
+import numpy as np
+
+import All_components_CMR as cmr
+import cmr_screen
+
+def test_rings_pass_the_screen_cmrs_are_selected():
+    jobs = [("flat_cmr", (0, 0, 40, 0.25, 0.25, 5, 0, True)),
+            ("undercut_ring", (0, 0, cmr.radius, 5)),
+            ("flat_cmr", (0, 0, 40, 1.0, 1.0, 5, 0, True)),
+            ("undercut_ring", (0, 0, cmr.radius, 20))]
+    scores = cmr_screen.screen_jobs(jobs, cmr)
+    assert np.isnan(scores["frequency_mhz"][[1, 3]]).all()
+
+    in_band = scores["frequency_mhz"][0]
+    keep = cmr_screen.select(scores, {"frequency_mhz": [0.9*in_band, 1.1*in_band], "impedance_ohm": [None, None]})
+    assert keep.tolist() == [True, True, False, True]
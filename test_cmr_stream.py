@@ -0,0 +1,35 @@
+'''The streamed mask (cmr_stream) against the mask assemble_mask builds in memory, geometry compared with cmr_diff.
+
+    python -m pytest test_cmr_stream.py'''
+
+import pytest
+
+import All_components_CMR as cmr
+import cmr_diff
+import cmr_stream
+
+def rotated_sweep(n=216):
+    #rotated devices have bounding boxes off the 1 nm grid, which is where gf.grid's snapping shows
+    tethers = [1.25, 2.5, 5, 10]
+    jobs = []
+    for i in range(n):
+        angle, tether_width = (7*i) % 90, tethers[i % 4]
+        if i % 9 == 0:
+            jobs.append(("undercut_ring", (0, 0, cmr.radius, [2.5, 5, 10][i % 3], tether_width, [2.5, 3][i % 2])))
+        elif i % 2:
+            jobs.append(("flat_cmr", (0, 0, cmr.electrode_number, 0.25, 0.25, tether_width, angle, True)))
+        else:
+            jobs.append(("biconvex_cmr", (0, 0, cmr.electrode_number, 0.25, 0.25, tether_width, angle, [0.5, 1.5][i % 2])))
+    return jobs
+
+@pytest.fixture(scope="module")
+def in_memory(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("mask") / "in_memory.gds")
+    cmr.assemble_mask(cmr.build_sweep(rotated_sweep())).write_gds(path)
+    return path
+
+@pytest.mark.parametrize("backend", ["gf", "direct"])
+def test_streamed_grid_matches_in_memory(in_memory, tmp_path, monkeypatch, backend):
+    monkeypatch.setattr(cmr, "device_backend", backend)
+    streamed = cmr_stream.write_mask_streaming(rotated_sweep(), str(tmp_path / "streamed.gds"))
+    assert cmr_diff.diff_masks(in_memory, streamed)["regions"] == []